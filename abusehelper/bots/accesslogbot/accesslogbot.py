@@ -2,17 +2,19 @@
 Maintainer: AbuseSA team <contact@abusesa.com>
 """
 
-from abusehelper.core import bot, events
+from abusehelper.core import bot, events, utils
 from abusehelper.bots.tailbot.tailbot import TailBot
 
 import re
 import time
-from calendar import timegm
 
 
 DATE_REX = re.compile(
     r"^(\d{1,2}/.+?/\d{4}:\d{1,2}:\d{1,2}:\d{1,2})\s+([+-]\d{4})$")
 
+# Consecutive log lines tend to share timestamps.
+DATE_PARSER = utils.TimeParser("%d/%b/%Y:%H:%M:%S", cache_size=1024)
+
 
 def convert_date(datestring, to_format="%Y-%m-%d %H:%M:%SZ"):
     """
@@ -33,7 +35,7 @@ def convert_date(datestring, to_format="%Y-%m-%d %H:%M:%SZ"):
 
     datetime, timezone = match.groups()
     try:
-        timestamp = timegm(time.strptime(datetime, "%d/%b/%Y:%H:%M:%S"))
+        timestamp = DATE_PARSER.parse(datetime)
     except ValueError:
         return datestring
 
@@ -32,7 +32,15 @@ class DataplaneBot(bot.PollingBot):
 
         charset = info.get_param("charset")
         filtered = (x for x in fileobj if x.strip() and not x.startswith("#"))
-        yield utils.csv_to_events(filtered,
-                                  delimiter="|",
-                                  columns=self.COLUMNS,
-                                  charset=charset)
+
+        # Without the per-event whois augmentation the rows can be passed
+        # on in columnar batches.
+        if self.use_cymru_whois:
+            to_events = utils.csv_to_events
+        else:
+            to_events = utils.csv_to_event_batches
+
+        yield to_events(filtered,
+                        delimiter="|",
+                        columns=self.COLUMNS,
+                        charset=charset)
@@ -1,9 +1,92 @@
+import time
+
 import idiokit
-from ...core import events, cymruwhois
+from ...core import bot, events, utils, cymruwhois
 from . import Expert
 
 
+@idiokit.stream
+def _tag_ips(ip_key):
+    while True:
+        eid, event = yield idiokit.next()
+
+        for ip in event.values(ip_key):
+            yield idiokit.send(eid, ip)
+
+
+@idiokit.stream
+def _augmentations(prefix):
+    while True:
+        eid, _, items = yield idiokit.next()
+        if not items:
+            continue
+
+        augmentation = events.Event()
+        for key, value in items:
+            augmentation.add(prefix + key, value)
+        yield idiokit.send(eid, augmentation)
+
+
 class CymruWhoisExpert(Expert):
+    cache_file = bot.Param("""
+        path to an SQLite file for caching the lookup results over
+        restarts, can be shared by several bots on the same host
+        (default: no persistent caching)
+        """, default=None)
+    max_in_flight = bot.IntParam("""
+        the maximum number of DNS queries in flight at once
+        (default: %default)
+        """, default=16)
+    window = bot.IntParam("""
+        the maximum number of IP addresses being looked up at once,
+        a lookup can get overtaken by at most this many later ones
+        (default: %default)
+        """, default=32)
+    stats_interval = bot.FloatParam("""
+        how often (in seconds) the lookup statistics get logged,
+        0 disables the logging (default: %default)
+        """, default=300.0)
+
+    def __init__(self, *args, **keys):
+        Expert.__init__(self, *args, **keys)
+
+        self._whois = cymruwhois.CymruWhois(
+            max_in_flight=self.max_in_flight,
+            window=self.window,
+            cache_file=self.cache_file)
+
+    @idiokit.stream
+    def main(self, state):
+        # Flush the cache file regularly even when no new lookup results
+        # trigger a flush, and close it on the way out so that restarting
+        # doesn't lose the latest results.
+        stats_time = time.time()
+        try:
+            while True:
+                yield idiokit.sleep(utils.PersistentCache.FLUSH_INTERVAL)
+                self._whois.flush()
+
+                if self.stats_interval > 0.0 and time.time() >= stats_time + self.stats_interval:
+                    stats_time = time.time()
+                    self._log_stats()
+        finally:
+            self._whois.close()
+
+    def _log_stats(self):
+        stats = self._whois.stats()
+        self.log.info(
+            u"Lookups: {0} cache hits, {1} misses, {2} coalesced (hit ratio {3:.3f}), {4} queries in flight, {5} waiting".format(
+                stats["cache hits"],
+                stats["cache misses"],
+                stats["coalesced lookups"],
+                stats["cache hit ratio"],
+                stats["queries in flight"],
+                stats["queries waiting"]),
+            event=events.Event(dict(
+                (key, unicode(value)) for key, value in stats.iteritems()
+            ), type="lookup stats", service=self.bot_name)
+        )
+
     def augment_keys(self, keys=["ip"], **_):
         for key in keys:
             if isinstance(key, basestring):
@@ -12,20 +95,11 @@ class CymruWhoisExpert(Expert):
                 key, prefix = key
             yield key, prefix
 
-    @idiokit.stream
     def augment(self, ip_key, prefix):
-        while True:
-            eid, event = yield idiokit.next()
-
-            for ip in event.values(ip_key):
-                items = yield cymruwhois.lookup(ip)
-                if not items:
-                    continue
-
-                augmentation = events.Event()
-                for key, value in items:
-                    augmentation.add(prefix + key, value)
-                yield idiokit.send(eid, augmentation)
+        return idiokit.pipe(
+            _tag_ips(ip_key),
+            self._whois.lookup_many(),
+            _augmentations(prefix))
 
 
 if __name__ == "__main__":
@@ -11,9 +11,12 @@ Pygeoip can currently use only the IPv4 version of the DB.
 Maintainer: Lari Huttunen <mit-code@huttu.net>
 """
 
+import os
+import time
 import socket
+import collections
 import idiokit
-from ...core import events, bot
+from ...core import events, bot, utils
 from . import Expert
 
 
@@ -25,6 +28,223 @@ def is_ipv4(ip):
     return True
 
 
+def _ip_key(ip):
+    r"""
+    Return an integer key for an IPv4 or IPv6 address. The keys of IPv6
+    addresses are offset to keep them apart from the IPv4 ones. Other
+    strings are returned as they are.
+
+    >>> _ip_key(u"192.0.2.1")
+    3221225985
+    >>> _ip_key(u"::1") == 2 ** 32 + 1
+    True
+    >>> _ip_key(u"not an ip")
+    u'not an ip'
+    """
+
+    for family, offset in [(socket.AF_INET, 0), (socket.AF_INET6, 2 ** 32)]:
+        try:
+            packed = socket.inet_pton(family, ip)
+        except (ValueError, UnicodeError, socket.error):
+            continue
+        return int(packed.encode("hex"), 16) + offset
+    return ip
+
+
+class _Batcher(object):
+    """
+    Collect items into batches of at most the given size. A batch is
+    handed out when it gets full, when it is flushed or when the batcher
+    gets closed. Adding waits while a full batch is still waiting to be
+    taken.
+    """
+
+    def __init__(self, size):
+        self._size = max(size, 1)
+        self._batch = []
+        self._ready = collections.deque()
+        self._closed = False
+
+        self._input = utils.Waiter()
+        self._output = utils.Waiter()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @idiokit.stream
+    def add(self, item):
+        while self._ready:
+            yield self._input.wait()
+
+        self._batch.append(item)
+        if len(self._batch) >= self._size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self._ready.append(self._batch)
+            self._batch = []
+            self._output.wake()
+
+    def close(self):
+        self.flush()
+        self._closed = True
+        self._output.wake()
+
+    @idiokit.stream
+    def take(self):
+        """
+        Return the next batch, or None when the batcher has been closed
+        and all the batches have been taken.
+        """
+
+        while not self._ready:
+            if self._closed:
+                idiokit.stop(None)
+            yield self._output.wait()
+
+        batch = self._ready.popleft()
+        self._input.wake()
+        idiokit.stop(batch)
+
+
+@idiokit.stream
+def _collect_batches(batcher):
+    try:
+        while True:
+            item = yield idiokit.next()
+            yield batcher.add(item)
+    finally:
+        batcher.close()
+
+
+@idiokit.stream
+def _flush_batches(batcher, interval):
+    while not batcher.closed:
+        yield idiokit.sleep(interval)
+        batcher.flush()
+
+
+class _CachedLookups(object):
+    """
+    Look up several IP addresses at a time with the given read function.
+    The results are kept in memory, keyed by integer IP addresses, and
+    optionally in a utils.PersistentCache. The in-memory cache evicts the
+    least recently used results first, so a burst of one-off addresses
+    doesn't push out the frequently seen ones. A cache_size of 0 disables
+    the in-memory caching.
+
+    With use_thread the reads happen in a separate thread. Only the reads
+    go to the thread, as the caches are not shared between threads.
+    """
+
+    def __init__(self, read, cache_time, cache_size, persistent_cache=None, use_thread=False):
+        self._read = read
+        self._memory_cache = utils.TimedCache(cache_time, max(cache_size, 0))
+        self._persistent_cache = persistent_cache
+        self._use_thread = use_thread
+
+    def _cached(self, ip, key):
+        result = self._memory_cache.get(key, None)
+        if result is not None or self._persistent_cache is None:
+            return result
+
+        entry = self._persistent_cache.get_entry(ip)
+        if entry is None:
+            return None
+
+        result, expires = entry
+        self._memory_cache.set(key, result, cache_time=expires - time.time())
+        return result
+
+    def flush(self):
+        if self._persistent_cache is not None:
+            self._persistent_cache.flush()
+
+    def close(self):
+        if self._persistent_cache is not None:
+            self._persistent_cache.close()
+
+    def _store(self, ip, key, result):
+        self._memory_cache.set(key, result)
+        if self._persistent_cache is not None:
+            self._persistent_cache.set(ip, result)
+
+    def _read_all(self, ips):
+        return [(ip, self._read(ip)) for ip in ips]
+
+    def lookup(self, ip):
+        """
+        Return the lookup result of a single IP address. Uncached
+        addresses are read in the calling thread.
+        """
+
+        key = _ip_key(ip)
+        result = self._cached(ip, key)
+        if result is None:
+            result = self._read(ip)
+            self._store(ip, key, result)
+        return result
+
+    @idiokit.stream
+    def lookup_many(self, ips):
+        """
+        Return a dict mapping each of the given IP addresses to its
+        lookup result.
+        """
+
+        results = dict()
+
+        missing = []
+        for ip in ips:
+            result = self._cached(ip, _ip_key(ip))
+            if result is None:
+                missing.append(ip)
+            else:
+                results[ip] = result
+
+        if missing:
+            if self._use_thread:
+                found = yield idiokit.thread(self._read_all, missing)
+            else:
+                found = self._read_all(missing)
+
+            for ip, result in found:
+                self._store(ip, _ip_key(ip), result)
+                results[ip] = result
+
+        idiokit.stop(results)
+
+
+@idiokit.stream
+def _augment_batches(batcher, key, lookups):
+    while True:
+        batch = yield batcher.take()
+        if batch is None:
+            break
+
+        # Look up each unique IP address only once per batch and share
+        # the augmentations between the events.
+        ips = set()
+        for _, event in batch:
+            ips.update(event.values(key))
+        results = yield lookups.lookup_many(ips)
+
+        augmentations = dict()
+        for ip, result in results.iteritems():
+            if result:
+                augmentation = events.Event(result)
+                augmentation.add(key, ip)
+                augmentations[ip] = augmentation
+
+        for eid, event in batch:
+            for ip in event.values(key):
+                augmentation = augmentations.get(ip, None)
+                if augmentation is not None:
+                    yield idiokit.send(eid, augmentation)
+
+
 def load_geodb(path, log=None):
     def geoip(reader, ip):
         try:
@@ -106,14 +326,66 @@ class GeoIPExpert(Expert):
     geoip_db = bot.Param("path to the GeoIP database")
     ip_key = bot.Param("key which has IP address as value " +
                        "(default: %default)", default="ip")
+    cache_file = bot.Param("""
+        path to an SQLite file for caching the lookup results over
+        restarts, can be shared by several bots on the same host
+        (default: no persistent caching)
+        """, default=None)
+    cache_time = bot.IntParam("""
+        how many seconds the lookup results are cached, both in memory
+        and in the optional cache file (default: %default)
+        """, default=24 * 60 * 60)
+    cache_size = bot.IntParam("""
+        the maximum number of lookup results kept in memory,
+        0 disables the in-memory caching (default: %default)
+        """, default=65536)
+    batch_size = bot.IntParam("""
+        the maximum number of events whose IP addresses are looked up
+        together (default: %default)
+        """, default=100)
+    batch_latency = bot.FloatParam("""
+        the maximum time (in seconds) events are held back while
+        collecting a batch, 0 disables batching (default: %default)
+        """, default=0.05)
+    lookup_thread = bot.BoolParam("""
+        read the database in a separate thread to keep the lookups
+        from blocking the bot's other work
+        """)
 
     def __init__(self, *args, **keys):
         Expert.__init__(self, *args, **keys)
         self.geoip = load_geodb(self.geoip_db, self.log)
 
+        persistent_cache = None
+        if self.cache_file is not None:
+            # Results cached for other database files (or older versions
+            # of this one) go to different namespaces.
+            namespace = u"geoip {0} {1}".format(
+                os.path.abspath(self.geoip_db),
+                os.path.getmtime(self.geoip_db))
+            persistent_cache = utils.PersistentCache(self.cache_file, namespace, self.cache_time)
+
+        self._lookups = _CachedLookups(
+            self.geoip,
+            self.cache_time,
+            self.cache_size,
+            persistent_cache=persistent_cache,
+            use_thread=self.lookup_thread)
+
+    @idiokit.stream
+    def main(self, state):
+        # Results buffered for the cache file get written out on a timer
+        # and when the bot stops.
+        try:
+            while True:
+                yield idiokit.sleep(utils.PersistentCache.FLUSH_INTERVAL)
+                self._lookups.flush()
+        finally:
+            self._lookups.close()
+
     def geomap(self, event, key):
         for ip in event.values(key):
-            result = self.geoip(ip)
+            result = self._lookups.lookup(ip)
             if not result:
                 continue
 
@@ -123,11 +395,32 @@ class GeoIPExpert(Expert):
 
     @idiokit.stream
     def augment(self):
-        while True:
-            eid, event = yield idiokit.next()
+        if type(self).geomap.im_func is not GeoIPExpert.geomap.im_func:
+            # Keep calling geomap for each event when a subclass has
+            # overridden it, as the batches bypass it.
+            while True:
+                eid, event = yield idiokit.next()
+
+                for augmentation in self.geomap(event, self.ip_key):
+                    yield idiokit.send(eid, augmentation)
+
+        if self.batch_latency > 0.0:
+            batcher = _Batcher(self.batch_size)
+            flusher = _flush_batches(batcher, self.batch_latency)
+        else:
+            batcher = _Batcher(1)
+            flusher = None
 
-            for augmentation in self.geomap(event, self.ip_key):
-                yield idiokit.send(eid, augmentation)
+        try:
+            yield idiokit.pipe(
+                _collect_batches(batcher),
+                _augment_batches(batcher, self.ip_key, self._lookups))
+        finally:
+            # The flush timer runs alongside the pipe and stops once the
+            # batcher has been closed.
+            batcher.close()
+            if flusher is not None:
+                yield flusher
 
 
 if __name__ == "__main__":
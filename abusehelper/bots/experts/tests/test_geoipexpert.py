@@ -0,0 +1,167 @@
+import unittest
+
+import idiokit
+
+from ....core import events
+from .. import geoipexpert
+
+
+@idiokit.stream
+def _feed(items):
+    for item in items:
+        yield idiokit.send(item)
+
+
+@idiokit.stream
+def _collect():
+    results = []
+    while True:
+        try:
+            item = yield idiokit.next()
+        except StopIteration:
+            idiokit.stop(results)
+        else:
+            results.append(item)
+
+
+class _FakeReader(object):
+    def __init__(self):
+        self.reads = []
+
+    def __call__(self, ip):
+        self.reads.append(ip)
+        if ip.startswith("192.0.2."):
+            return {"geoip cc": [u"ZZ"]}
+        return {}
+
+
+class TestBatcher(unittest.TestCase):
+    def test_batches_are_handed_out_when_full_flushed_or_closed(self):
+        batcher = geoipexpert._Batcher(2)
+
+        @idiokit.stream
+        def test():
+            yield batcher.add(1)
+            yield batcher.add(2)
+            batch = yield batcher.take()
+            self.assertEqual([1, 2], batch)
+
+            yield batcher.add(3)
+            batcher.flush()
+            batch = yield batcher.take()
+            self.assertEqual([3], batch)
+
+            yield batcher.add(4)
+            batcher.close()
+            batch = yield batcher.take()
+            self.assertEqual([4], batch)
+            batch = yield batcher.take()
+            self.assertEqual(None, batch)
+        idiokit.main_loop(test())
+
+    def test_adding_waits_for_full_batches_to_be_taken(self):
+        batcher = geoipexpert._Batcher(1)
+        added = []
+
+        @idiokit.stream
+        def add():
+            for item in [1, 2, 3]:
+                yield batcher.add(item)
+                added.append(item)
+
+        @idiokit.stream
+        def test():
+            add()
+            yield idiokit.sleep(0.01)
+            self.assertEqual([1], added)
+
+            batch = yield batcher.take()
+            self.assertEqual([1], batch)
+            yield idiokit.sleep(0.01)
+            self.assertEqual([1, 2], added)
+        idiokit.main_loop(test())
+
+
+class TestCachedLookups(unittest.TestCase):
+    def _test_lookups(self, use_thread):
+        reader = _FakeReader()
+        lookups = geoipexpert._CachedLookups(reader, 60.0, 100, use_thread=use_thread)
+
+        @idiokit.stream
+        def test():
+            results = yield lookups.lookup_many([u"192.0.2.1", u"198.51.100.1"])
+            self.assertEqual({
+                u"192.0.2.1": {"geoip cc": [u"ZZ"]},
+                u"198.51.100.1": {}
+            }, results)
+
+            results = yield lookups.lookup_many([u"192.0.2.1", u"192.0.2.2"])
+            self.assertEqual({
+                u"192.0.2.1": {"geoip cc": [u"ZZ"]},
+                u"192.0.2.2": {"geoip cc": [u"ZZ"]}
+            }, results)
+        idiokit.main_loop(test())
+
+        self.assertEqual(
+            [u"192.0.2.1", u"192.0.2.2", u"198.51.100.1"],
+            sorted(reader.reads))
+
+    def test_each_ip_gets_read_once(self):
+        self._test_lookups(use_thread=False)
+
+    def test_reads_can_happen_in_a_thread(self):
+        self._test_lookups(use_thread=True)
+
+    def test_single_lookups_share_the_caches(self):
+        reader = _FakeReader()
+        lookups = geoipexpert._CachedLookups(reader, 60.0, 100)
+
+        self.assertEqual({"geoip cc": [u"ZZ"]}, lookups.lookup(u"192.0.2.1"))
+        self.assertEqual({}, lookups.lookup(u"198.51.100.1"))
+
+        results = idiokit.main_loop(lookups.lookup_many([u"192.0.2.1", u"198.51.100.1"]))
+        self.assertEqual({u"192.0.2.1": {"geoip cc": [u"ZZ"]}, u"198.51.100.1": {}}, results)
+        self.assertEqual([u"192.0.2.1", u"198.51.100.1"], reader.reads)
+
+    def test_recently_used_results_stay_in_memory(self):
+        reader = _FakeReader()
+        lookups = geoipexpert._CachedLookups(reader, 60.0, 2)
+
+        @idiokit.stream
+        def test():
+            for ip in [u"192.0.2.1", u"192.0.2.2", u"192.0.2.1", u"192.0.2.3", u"192.0.2.1"]:
+                yield lookups.lookup_many([ip])
+        idiokit.main_loop(test())
+
+        self.assertEqual([u"192.0.2.1", u"192.0.2.2", u"192.0.2.3"], reader.reads)
+
+
+class TestAugmentBatches(unittest.TestCase):
+    def test_each_ip_gets_looked_up_once_per_batch(self):
+        reader = _FakeReader()
+        lookups = geoipexpert._CachedLookups(reader, 60.0, 0)
+        batcher = geoipexpert._Batcher(3)
+
+        items = [
+            ("a", events.Event(ip=[u"192.0.2.1", u"198.51.100.1"])),
+            ("b", events.Event(ip=u"192.0.2.1")),
+            ("c", events.Event(ip=u"198.51.100.1")),
+            ("d", events.Event(ip=u"192.0.2.1"))
+        ]
+
+        results = idiokit.main_loop(idiokit.pipe(
+            _feed(items),
+            geoipexpert._collect_batches(batcher),
+            geoipexpert._augment_batches(batcher, "ip", lookups),
+            _collect()))
+
+        self.assertEqual(["a", "b", "d"], [eid for eid, _ in results])
+        for _, augmentation in results:
+            self.assertEqual(
+                events.Event({"geoip cc": u"ZZ", "ip": u"192.0.2.1"}),
+                augmentation)
+
+        # Two batches, and no in-memory caching between them.
+        self.assertEqual(
+            [u"192.0.2.1", u"192.0.2.1", u"198.51.100.1"],
+            sorted(reader.reads))
@@ -27,6 +27,12 @@ class SpamhausDropBot(bot.PollingBot):
             idiokit.stop(False)
         self.log.info("Downloaded")
 
+        # Without the per-netblock whois lookups the whole list is sent
+        # as a single columnar batch.
+        batch = None
+        if not self.use_cymru_whois:
+            batch = events.EventBatch(["netblock", "description url", "feeder", "feed", "type"])
+
         for line in fileobj.readlines():
             if line.startswith(';'):
                 continue
@@ -42,9 +48,14 @@ class SpamhausDropBot(bot.PollingBot):
             if not len(netblock.split('/')) == 2:
                 continue
 
+            description_url = "http://www.spamhaus.org/sbl/query/" + sbl
+            if batch is not None:
+                batch.append([netblock, description_url, 'spamhaus', 'spamhaus drop list', 'hijacked network'])
+                continue
+
             new = events.Event()
             new.add('netblock', netblock)
-            new.add('description url', "http://www.spamhaus.org/sbl/query/" + sbl)
+            new.add('description url', description_url)
             new.add('feeder', 'spamhaus')
             new.add('feed', 'spamhaus drop list')
             new.add('type', 'hijacked network')
@@ -56,6 +67,9 @@ class SpamhausDropBot(bot.PollingBot):
 
             yield idiokit.send(new)
 
+        if batch:
+            yield idiokit.send(batch)
+
 
 if __name__ == "__main__":
     SpamhausDropBot.from_command_line().execute()
@@ -5,7 +5,6 @@ import csv
 import sys
 import time
 import getpass
-import hashlib
 import inspect
 import logging
 import warnings
@@ -389,6 +388,18 @@ class ServiceBot(XMPPBot):
         name of the multi user chat room used for bot control
         """)
     service_mock_session = ListParam(default=None)
+    intern_event_values = IntParam("""
+        share up to the given number of distinct short event values
+        between the events handled by the bot to save memory, 0
+        disables the sharing; the first values seen are the ones
+        that get shared (default: %default)
+        """, default=0)
+    intern_event_keys = IntParam("""
+        share up to the given number of distinct event keys between
+        the events handled by the bot to save memory, 0 disables the
+        sharing; the first keys seen are the ones that get shared
+        (default: %default)
+        """, default=0)
 
     @idiokit.stream
     def _run(self):
@@ -435,7 +446,20 @@ class ServiceBot(XMPPBot):
                 yield idiokit.consume()
             except idiokit.Signal:
                 raise services.Stop()
-        return idiokit.main_loop(throw_stop_on_signal() | self._run())
+
+        interning = self.intern_event_keys > 0 or self.intern_event_values > 0
+        if interning:
+            events.set_interning(max_keys=self.intern_event_keys, max_values=self.intern_event_values)
+            self.log.info("Sharing up to {0} distinct event keys and {1} distinct event values between events".format(
+                max(self.intern_event_keys, 0), max(self.intern_event_values, 0)))
+
+        try:
+            return idiokit.main_loop(throw_stop_on_signal() | self._run())
+        finally:
+            if interning:
+                stats = events.interning_stats()
+                self.log.info("Event value sharing saved approximately {0} bytes ({1} shared keys, {2} shared values)".format(
+                    stats["saved bytes"], stats["keys"], stats["values"]))
 
     def main(self, state):
         return idiokit.consume()
@@ -444,6 +468,17 @@ class ServiceBot(XMPPBot):
         return idiokit.consume()
 
 
+def _older_than(source_times, cutoff, parser):
+    latest = None
+    for value in source_times:
+        try:
+            source_time = parser.parse(value)
+        except ValueError:
+            continue
+        latest = max(latest, source_time)
+    return latest is not None and latest < cutoff
+
+
 class FeedBot(ServiceBot):
     xmpp_rate_limit = FloatParam("""
         how many XMPP stanzas the bot can send per second
@@ -452,6 +487,15 @@ class FeedBot(ServiceBot):
     drop_older_than = IntParam("""
         drop events with source time older that given number of seconds
         """, default=None)
+    compact_events = BoolParam("""
+        send events in the compact event format instead of the legacy
+        one (all receiving bots must support the compact format)
+        """)
+    max_body_length = IntParam("""
+        truncate the human-readable body of the sent events to the
+        given number of characters, 0 drops the body altogether
+        (default: no limit)
+        """, default=None)
 
     def __init__(self, *args, **keys):
         ServiceBot.__init__(self, *args, **keys)
@@ -472,19 +516,27 @@ class FeedBot(ServiceBot):
 
     @idiokit.stream
     def _cutoff(self):
+        # Events of a feed tend to share a handful of source times.
+        parser = utils.TimeParser("%Y-%m-%d %H:%M:%SZ", cache_size=1024)
+
+        tick = None
         while True:
             event = yield idiokit.next()
 
-            latest = None
-            for value in event.values("source time"):
-                try:
-                    source_time = time.strptime(value, "%Y-%m-%d %H:%M:%SZ")
-                except ValueError:
-                    continue
-                latest = max(latest, source_time)
+            now = int(time.time())
+            if now != tick:
+                tick = now
+                cutoff = now - self.drop_older_than
 
-            cutoff = time.gmtime(time.time() - self.drop_older_than)
-            if latest and latest < cutoff:
+            if isinstance(event, events.EventBatch):
+                source_times = event.column_values("source time")
+                indexes = [index for index, values in enumerate(source_times)
+                           if not _older_than(values, cutoff, parser)]
+                if not indexes:
+                    continue
+                if len(indexes) < len(event):
+                    event = event.select(indexes)
+            elif _older_than(event.values("source time"), cutoff, parser):
                 continue
 
             yield idiokit.send(event)
@@ -537,7 +589,12 @@ class FeedBot(ServiceBot):
                 if self.xmpp_rate_limit is not None:
                     tail = self._output_rate_limiter() | tail
 
-                yield head | events.events_to_elements() | tail
+                to_elements = events.events_to_elements(
+                    include_body=self.max_body_length != 0,
+                    compact=self.compact_events,
+                    max_body_length=self.max_body_length
+                )
+                yield head | to_elements | tail
             finally:
                 log.close("Left " + msg, attrs, status="left")
 
@@ -583,6 +640,32 @@ class PollSkipped(Exception):
         return self.args[0]
 
 
+def _upgrade_dedup_state(state):
+    r"""
+    Upgrade deduplication filters saved by earlier versions to
+    utils.FingerprintSet objects. The earliest versions used 128-bit MD5
+    hexdigests of the events as keys. The 64-bit event fingerprints are
+    the 64 most significant bits of the corresponding MD5 keys.
+
+    >>> import hashlib
+    >>> event = events.Event(a="b")
+    >>> state = _upgrade_dedup_state({"key": set([int(events.hexdigest(event, hashlib.md5), 16)])})
+    >>> list(state["key"]) == [events.fingerprint(event)]
+    True
+    """
+
+    for key, dedup_filter in state.items():
+        if isinstance(dedup_filter, utils.FingerprintSet):
+            continue
+
+        if any(event_key >> 64 for event_key in dedup_filter):
+            dedup_filter = set(event_key >> 64 for event_key in dedup_filter)
+        dedup_filter = utils.FingerprintSet(dedup_filter)
+        dedup_filter.compact()
+        state[key] = dedup_filter
+    return state
+
+
 class PollingBot(FeedBot):
     poll_interval = IntParam("""
         wait at least the given amount of seconds before polling
@@ -610,22 +693,34 @@ class PollingBot(FeedBot):
     def dedup(self, key):
         initial_poll = key not in self._poll_dedup
 
-        old_filter = self._poll_dedup.setdefault(key, set())
-        new_filter = set()
+        old_filter = self._poll_dedup.setdefault(key, utils.FingerprintSet())
+        new_filter = utils.FingerprintSet()
 
         while True:
             try:
                 event = yield idiokit.next()
             except StopIteration:
+                new_filter.compact()
                 self._poll_dedup[key] = new_filter
                 raise
 
-            event_key = int(events.hexdigest(event, hashlib.md5), 16)
-            if event_key not in old_filter:
-                if not initial_poll or not self.ignore_initial_poll:
-                    yield idiokit.send(event)
-            old_filter.add(event_key)
-            new_filter.add(event_key)
+            if isinstance(event, events.EventBatch):
+                event_keys = event.fingerprints()
+            else:
+                event_keys = [events.fingerprint(event)]
+
+            indexes = []
+            for index, event_key in enumerate(event_keys):
+                if event_key not in old_filter:
+                    indexes.append(index)
+                    old_filter.add(event_key)
+                new_filter.add(event_key)
+
+            if not indexes or (initial_poll and self.ignore_initial_poll):
+                continue
+            if len(indexes) < len(event_keys):
+                event = event.select(indexes)
+            yield idiokit.send(event)
 
     @idiokit.stream
     def feed(self, *key):
@@ -662,7 +757,7 @@ class PollingBot(FeedBot):
     def main(self, state):
         if state is None:
             state = dict()
-        self._poll_dedup = state
+        self._poll_dedup = _upgrade_dedup_state(state)
 
         if self.ignore_initial_poll:
             self.log.info("Ignoring initial polls")
@@ -1,6 +1,10 @@
 from __future__ import absolute_import
 
+import sys
+import time
 import socket
+import collections
+
 import idiokit
 from idiokit import dns
 
@@ -25,6 +29,104 @@ def _nibbles(ipv6, _hex="0123456789abcdef"):
     return result
 
 
+_BITS = {
+    socket.AF_INET: 32,
+    socket.AF_INET6: 128
+}
+
+
+def _ip_num(family, ip):
+    return int(socket.inet_pton(family, ip).encode("hex"), 16)
+
+
+class _PrefixCache(object):
+    r"""
+    Cache values for IP prefixes, and find the value of the longest
+    cached prefix that contains a given IP.
+
+    >>> cache = _PrefixCache(60.0)
+    >>> cache.set(socket.AF_INET, u"192.0.2.0/24", "a")
+    True
+    >>> cache.set(socket.AF_INET, u"192.0.2.128/25", "b")
+    True
+    >>> cache.get(socket.AF_INET, "192.0.2.1"), cache.get(socket.AF_INET, "192.0.2.129")
+    ('a', 'b')
+    >>> cache.get(socket.AF_INET, "198.51.100.1") is None
+    True
+
+    Each get counts as one hit or miss, however many prefix lengths it
+    has to try.
+
+    >>> stats = cache.stats()
+    >>> stats["hits"], stats["misses"]
+    (2, 1)
+
+    IPv6 prefixes work the same way. Malformed prefixes are ignored.
+
+    >>> cache.set(socket.AF_INET6, u"2001:db8::/32", "c")
+    True
+    >>> cache.get(socket.AF_INET6, "2001:db8:1::1")
+    'c'
+    >>> cache.set(socket.AF_INET, u"2001:db8::/32", "d")
+    False
+    >>> cache.set(socket.AF_INET, u"192.0.2.0/33", "d")
+    False
+    """
+
+    def __init__(self, cache_time, cache_size=None):
+        self._cache = utils.TimedCache(cache_time, cache_size)
+
+        # The prefix lengths seen for each address family, longest first.
+        self._lengths = dict()
+
+    def _parse_prefix(self, family, prefix):
+        ip, _, length = prefix.partition(u"/")
+        try:
+            num = _ip_num(family, ip.strip())
+            length = int(length)
+        except (ValueError, socket.error, UnicodeError):
+            return None
+
+        bits = _BITS[family]
+        if not 0 <= length <= bits:
+            return None
+        return num >> (bits - length), length
+
+    def stats(self):
+        return self._cache.stats()
+
+    def contains(self, family, prefix, ip):
+        parsed = self._parse_prefix(family, prefix)
+        if parsed is None:
+            return False
+        network, length = parsed
+        return _ip_num(family, ip) >> (_BITS[family] - length) == network
+
+    def get(self, family, ip):
+        lengths = self._lengths.get(family, None)
+        if not lengths:
+            return None
+
+        num = _ip_num(family, ip)
+        bits = _BITS[family]
+        keys = [(family, length, num >> (bits - length)) for length in lengths]
+        return self._cache.get_first(keys, None)
+
+    def set(self, family, prefix, value):
+        parsed = self._parse_prefix(family, prefix)
+        if parsed is None:
+            return False
+
+        network, length = parsed
+        self._cache.set((family, length, network), value)
+
+        lengths = self._lengths.setdefault(family, [])
+        if length not in lengths:
+            lengths.append(length)
+            lengths.sort(reverse=True)
+        return True
+
+
 def _split(txt_results, keys):
     results = set()
 
@@ -48,116 +150,437 @@ def _split(txt_results, keys):
     return tuple(tuple(x) for x in results)
 
 
-class ASNameLookup(object):
-    _keys = (None, None, None, "as allocated", "as name")
+class _Limiter(object):
+    """
+    Limit the number of concurrently running operations. Waiting callers
+    get their turns in the order they started waiting.
+    """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.running = 0
+        self.peak = 0
+        self._waiters = collections.deque()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    @idiokit.stream
+    def acquire(self):
+        if 0 < self.limit <= self.running:
+            waiter = idiokit.Event()
+            self._waiters.append(waiter)
+            try:
+                yield waiter
+            except:
+                # Pass on the turn if it was already handed to this waiter.
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                else:
+                    self.release()
+                raise
+        else:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+
+    def release(self):
+        if self._waiters:
+            # Hand the turn directly to the next waiter.
+            self._waiters.popleft().succeed()
+        else:
+            self.running -= 1
+
 
-    def __init__(self, resolver=None, cache_time=4 * 60 * 60, catch_error=True):
+class _TXTLookup(object):
+    def __init__(self, parse, resolver=None, cache_time=4 * 60 * 60, catch_error=True, limiter=None, persistent_cache=None, cache_size=None):
+        self._parse = parse
         self._resolver = resolver
-        self._cache = utils.TimedCache(cache_time)
+        self._cache = utils.TimedCache(cache_time, cache_size)
         self._catch_error = catch_error
+        self._limiter = _Limiter() if limiter is None else limiter
 
-    @idiokit.stream
-    def lookup(self, asn):
-        try:
-            asn = int(asn)
-        except ValueError:
-            idiokit.stop(())
+        # An optional utils.PersistentCache consulted after the in-memory
+        # cache, e.g. to avoid a burst of queries after a restart.
+        self._persistent_cache = persistent_cache
 
-        results = self._cache.get(asn, None)
-        if results is not None:
-            idiokit.stop(results)
+        # Futures for the queries currently in flight, so that concurrent
+        # lookups for the same key wait for the same answer.
+        self._pending = dict()
 
-        try:
-            txt_results = yield dns.txt(
-                "AS{0}.asn.cymru.com".format(asn),
-                resolver=self._resolver)
-        except dns.DNSError:
-            if self._catch_error:
-                idiokit.stop(())
-            else:
-                raise
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
 
-        results = _split(txt_results, self._keys)
-        self._cache.set(asn, results)
-        idiokit.stop(results)
+    def cache_stats(self):
+        return self._cache.stats()
 
+    def _cache_get(self, cache_key):
+        results = self._cache.get(cache_key, None)
+        if results is None:
+            results = self._persistent_get(cache_key)
+        return results
 
-class OriginLookup(object):
-    _keys = ("asn", "bgp prefix", "cc", "registry", "bgp prefix allocated")
+    def _cache_set(self, cache_key, results):
+        self._cache.set(cache_key, results)
+        if self._persistent_cache is not None:
+            self._persistent_cache.set(cache_key, results)
 
-    def __init__(self, resolver=None, cache_time=4 * 60 * 60, catch_error=True):
-        self._resolver = resolver
-        self._cache = utils.TimedCache(cache_time)
-        self._catch_error = catch_error
+    def _persistent_get(self, cache_key):
+        if self._persistent_cache is None:
+            return None
+
+        entry = self._persistent_cache.get_entry(cache_key)
+        if entry is None:
+            return None
+
+        # Keep the answer in memory for the rest of its lifetime.
+        results, expires = entry
+        self._cache.set(cache_key, results, cache_time=expires - time.time())
+        return results
 
     @idiokit.stream
-    def _lookup(self, cache_key, query):
-        results = self._cache.get(cache_key, None)
+    def _cached_lookup(self, cache_key, query):
+        results = self._cache_get(cache_key)
         if results is not None:
+            self.hits += 1
+            idiokit.stop(results)
+
+        pending = self._pending.get(cache_key, None)
+        if pending is not None:
+            self.coalesced += 1
+            results = yield pending.fork()
             idiokit.stop(results)
 
+        self.misses += 1
+        pending = self._pending[cache_key] = idiokit.Event()
+        try:
+            results = yield self._query(cache_key, query)
+        except:
+            del self._pending[cache_key]
+            pending.fail(*sys.exc_info())
+            raise
+        del self._pending[cache_key]
+        pending.succeed(results)
+        idiokit.stop(results)
+
+    @idiokit.stream
+    def _query(self, cache_key, query):
+        yield self._limiter.acquire()
         try:
             txt_results = yield dns.txt(query, resolver=self._resolver)
         except dns.DNSError:
             if self._catch_error:
                 idiokit.stop(())
-            else:
-                raise
+            raise
+        finally:
+            self._limiter.release()
+
+        results = self._parse(txt_results)
+        self._cache_set(cache_key, results)
+        idiokit.stop(results)
+
+
+_ASNAME_KEYS = (None, None, None, "as allocated", "as name")
 
-        results = []
-        for result in _split(txt_results, self._keys):
-            result_dict = dict(result)
-            for asn in result_dict.get("asn", "").split():
-                if not asn:
-                    continue
-                result_dict["asn"] = asn
-                results.append(tuple(result_dict.iteritems()))
+_ORIGIN_KEYS = ("asn", "bgp prefix", "cc", "registry", "bgp prefix allocated")
 
-        self._cache.set(cache_key, tuple(results))
+
+def _parse_asname(txt_results):
+    return _split(txt_results, _ASNAME_KEYS)
+
+
+def _parse_origin(txt_results):
+    results = []
+    for result in _split(txt_results, _ORIGIN_KEYS):
+        result_dict = dict(result)
+        for asn in result_dict.get("asn", "").split():
+            if not asn:
+                continue
+            result_dict["asn"] = asn
+            results.append(tuple(result_dict.iteritems()))
+    return tuple(results)
+
+
+class ASNameLookup(_TXTLookup):
+    _keys = _ASNAME_KEYS
+
+    def __init__(self, resolver=None, cache_time=4 * 60 * 60, catch_error=True, limiter=None, persistent_cache=None, cache_size=None):
+        _TXTLookup.__init__(self, _parse_asname, resolver, cache_time, catch_error, limiter, persistent_cache, cache_size)
+
+    @idiokit.stream
+    def lookup(self, asn):
+        try:
+            asn = int(asn)
+        except ValueError:
+            idiokit.stop(())
+
+        results = yield self._cached_lookup(asn, "AS{0}.asn.cymru.com".format(asn))
         idiokit.stop(results)
 
+
+class OriginLookup(_TXTLookup):
+    """
+    Look up the origin information of IPs. Besides caching the answers by
+    IP, the answers are also cached by the BGP prefix they name, so that
+    later lookups for other IPs within a known prefix are answered
+    without a DNS query.
+
+    The prefix cache can't know about more specific prefixes announced
+    within a cached prefix, so it can answer with the less specific
+    prefix's information until the entry expires. Set prefix_cache to
+    False to cache answers only by IP.
+    """
+
+    _keys = _ORIGIN_KEYS
+
+    def __init__(self, resolver=None, cache_time=4 * 60 * 60, catch_error=True, limiter=None, persistent_cache=None, cache_size=None, prefix_cache=True):
+        _TXTLookup.__init__(self, _parse_origin, resolver, cache_time, catch_error, limiter, persistent_cache, cache_size)
+
+        self._prefixes = _PrefixCache(cache_time, cache_size) if prefix_cache else None
+        self.prefix_hits = 0
+
+    def _cache_get(self, cache_key):
+        results = self._cache.get(cache_key, None)
+        if results is not None:
+            return results
+
+        if self._prefixes is not None:
+            family = socket.AF_INET6 if ":" in cache_key else socket.AF_INET
+            results = self._prefixes.get(family, cache_key)
+            if results is not None:
+                self.prefix_hits += 1
+                return results
+
+        return self._persistent_get(cache_key)
+
+    def _cache_set(self, cache_key, results):
+        _TXTLookup._cache_set(self, cache_key, results)
+        if self._prefixes is None:
+            return
+
+        # Cache by prefix only when all the answers agree on a prefix that
+        # contains the queried IP.
+        prefixes = set(dict(result).get("bgp prefix", None) for result in results)
+        if len(prefixes) != 1:
+            return
+        prefix = prefixes.pop()
+        if prefix is None:
+            return
+
+        family = socket.AF_INET6 if ":" in cache_key else socket.AF_INET
+        if self._prefixes.contains(family, prefix, cache_key):
+            self._prefixes.set(family, prefix, results)
+
     @idiokit.stream
     def lookup(self, ip):
         ipv4 = _parse_ip(ip, families=[socket.AF_INET])
         if ipv4 is not None:
             prefix = ".".join(reversed(ipv4.split(".")))
-            results = yield self._lookup(ipv4, prefix + ".origin.asn.cymru.com")
+            results = yield self._cached_lookup(ipv4, prefix + ".origin.asn.cymru.com")
             idiokit.stop(results)
 
         ipv6 = _parse_ip(ip, families=[socket.AF_INET6])
         if ipv6 is not None:
             prefix = ".".join(reversed(_nibbles(ipv6)))
-            results = yield self._lookup(ipv6, prefix + ".origin6.asn.cymru.com")
+            results = yield self._cached_lookup(ipv6, prefix + ".origin6.asn.cymru.com")
             idiokit.stop(results)
 
         idiokit.stop(())
 
 
+class _Window(object):
+    """
+    Pass on events in the order their augmentation finishes, while
+    keeping at most the given number of events in progress. An event
+    can therefore get overtaken by at most size - 1 later events.
+    """
+
+    def __init__(self, size):
+        self._size = max(size, 1)
+        self._count = 0
+        self._done = collections.deque()
+        self._error = None
+        self._closed = False
+
+        self._input = utils.Waiter()
+        self._output = utils.Waiter()
+
+    @idiokit.stream
+    def acquire(self):
+        while self._count >= self._size:
+            yield self._input.wait()
+        self._count += 1
+
+    def complete(self, event):
+        self._done.append(event)
+        self._output.wake()
+
+    def fail(self, exc_info):
+        if self._error is None:
+            self._error = exc_info
+        self._output.wake()
+
+    def close(self):
+        self._closed = True
+        self._output.wake()
+
+    @idiokit.stream
+    def output(self):
+        while True:
+            if self._error is not None:
+                exc_type, exc_value, exc_tb = self._error
+                raise exc_type, exc_value, exc_tb
+
+            if self._done:
+                event = self._done.popleft()
+                self._count -= 1
+                self._input.wake()
+
+                yield idiokit.send(event)
+                continue
+
+            if self._closed and self._count == 0:
+                break
+
+            yield self._output.wait()
+
+
 class CymruWhois(object):
-    def __init__(self, resolver=None, cache_time=4 * 60 * 60):
-        self._origin_lookup = OriginLookup(resolver, cache_time)
-        self._asname_lookup = ASNameLookup(resolver, cache_time)
+    def __init__(self, resolver=None, cache_time=4 * 60 * 60, max_in_flight=16, window=32, cache_file=None, cache_size=65536):
+        self._limiter = _Limiter(max_in_flight)
+        self._window = window
+
+        origin_cache = None
+        asname_cache = None
+        self._persistent_caches = []
+        if cache_file is not None:
+            origin_cache = utils.PersistentCache(cache_file, "cymru origin", cache_time)
+            asname_cache = utils.PersistentCache(cache_file, "cymru asname", cache_time)
+            self._persistent_caches.extend([origin_cache, asname_cache])
+
+        self._origin_lookup = OriginLookup(
+            resolver, cache_time,
+            limiter=self._limiter,
+            persistent_cache=origin_cache,
+            cache_size=cache_size)
+        self._asname_lookup = ASNameLookup(
+            resolver, cache_time,
+            limiter=self._limiter,
+            persistent_cache=asname_cache,
+            cache_size=cache_size)
+
+    def flush(self):
+        """
+        Write the buffered lookup results to the cache file, if any.
+        """
+
+        for cache in self._persistent_caches:
+            cache.flush()
+
+    def close(self):
+        """
+        Write the buffered lookup results to the cache file and close it.
+        """
+
+        for cache in self._persistent_caches:
+            cache.close()
+
+    def stats(self):
+        """
+        Return a dictionary of the lookup cache statistics and the number
+        of DNS queries in flight and waiting for their turn.
+        """
+
+        lookups = [self._origin_lookup, self._asname_lookup]
+        hits = sum(x.hits for x in lookups)
+        misses = sum(x.misses for x in lookups)
+        coalesced = sum(x.coalesced for x in lookups)
+        total = hits + misses + coalesced
+
+        caches = [x.cache_stats() for x in lookups]
+        if self._origin_lookup._prefixes is not None:
+            caches.append(self._origin_lookup._prefixes.stats())
+
+        return {
+            "cache hits": hits,
+            "cache misses": misses,
+            "coalesced lookups": coalesced,
+            "cache hit ratio": float(hits) / total if total else 0.0,
+            "prefix cache hits": self._origin_lookup.prefix_hits,
+            "memory cache size": sum(x["size"] for x in caches),
+            "memory cache evictions": sum(x["evictions"] for x in caches),
+            "memory cache expirations": sum(x["expirations"] for x in caches),
+            "queries in flight": self._limiter.running,
+            "queries waiting": self._limiter.waiting,
+            "peak queries in flight": self._limiter.peak
+        }
 
     def _ip_values(self, event, keys):
         for key in keys:
             for value in event.values(key, parser=_parse_ip):
                 yield value
 
-    @idiokit.stream
     def augment(self, *ip_keys):
-        while True:
-            event = yield idiokit.next()
+        window = _Window(self._window)
+        return idiokit.pipe(self._augment(ip_keys, window), window.output())
+
+    @idiokit.stream
+    def _augment(self, ip_keys, window):
+        try:
+            while True:
+                event = yield idiokit.next()
+                yield window.acquire()
+                self._augment_event(event, ip_keys, window)
+        finally:
+            window.close()
+
+    @idiokit.stream
+    def _augment_event(self, event, ip_keys, window):
+        try:
             if not ip_keys:
                 values = event.values(parser=_parse_ip)
             else:
-                values = self._ip_values(event, ip_keys)
+                values = list(self._ip_values(event, ip_keys))
 
-            for ip in values:
-                items = yield self.lookup(ip)
+            # Start all the lookups for the event before waiting for any.
+            lookups = [self.lookup(ip) for ip in values]
+            for lookup in lookups:
+                items = yield lookup
                 for key, value in items:
                     event.add(key, value)
+        except Exception:
+            window.fail(sys.exc_info())
+        else:
+            window.complete(event)
 
-            yield idiokit.send(event)
+    def lookup_many(self):
+        """
+        Look up the IPs of (tag, ip) pairs concurrently and pass on
+        (tag, ip, items) tuples in the order the lookups finish.
+        """
+
+        window = _Window(self._window)
+        return idiokit.pipe(self._lookup_many(window), window.output())
+
+    @idiokit.stream
+    def _lookup_many(self, window):
+        try:
+            while True:
+                tag, ip = yield idiokit.next()
+                yield window.acquire()
+                self._lookup_tagged(tag, ip, window)
+        finally:
+            window.close()
+
+    @idiokit.stream
+    def _lookup_tagged(self, tag, ip, window):
+        try:
+            items = yield self.lookup(ip)
+        except Exception:
+            window.fail(sys.exc_info())
+        else:
+            window.complete((tag, ip, items))
 
     @idiokit.stream
     def lookup(self, ip):
@@ -1,9 +1,12 @@
 import re
+import sys
+import struct
 import hashlib
 import inspect
 import collections
 
-from base64 import b64decode
+from itertools import izip
+from base64 import b64decode, b64encode
 
 import idiokit
 from idiokit.xmlcore import Element, Elements
@@ -16,6 +19,25 @@ def _replace_non_xml_chars(unicode_obj, replacement=u"\ufffd"):
 _NON_XML = re.compile(u"[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]", re.U)
 
 
+def _truncate_body(text, max_length=None):
+    """Return the text truncated to at most max_length characters, with a
+    trailing "..." marking the truncation when there is room for it.
+
+    >>> _truncate_body(u"abcdefgh", 5)
+    u'ab...'
+    >>> _truncate_body(u"abcdefgh", 2)
+    u'ab'
+    >>> _truncate_body(u"abc", 3)
+    u'abc'
+    """
+
+    if max_length is None or len(text) <= max_length:
+        return text
+    if max_length < 3:
+        return text[:max(max_length, 0)]
+    return text[:max_length - 3] + u"..."
+
+
 def _normalize(value):
     """Return the value converted to unicode. Raise a TypeError if the
     value is not a string.
@@ -86,9 +108,188 @@ def _unicode_parse_part(string, start):
 _UNICODE_UNQUOTE = re.compile(r'\\(.)', re.U)
 _UNICODE_PART = re.compile(r'\s*(?:(?:"((?:\\.|[^"])*)")|([^\s"=,]+)|)\s*', re.U)
 
+# A key-value pair and its trailing separator matched in one go. The
+# quoted alternative doesn't accept lone backslashes, which keeps it
+# unambiguous: Whenever the pair matches, _unicode_parse_part would
+# have parsed the same key and value. Other inputs go through the
+# part-by-part parser, which also produces the error messages.
+_UNICODE_FAST_PART = r'\s*(?:"((?:\\.|[^"\\])*)"|([^\s"=,]+)|)\s*'
+_UNICODE_PAIR = re.compile(_UNICODE_FAST_PART + u"=" + _UNICODE_FAST_PART + r"(,|\Z)", re.U)
+
+
+def _unicode_unquote(quoted, unquoted):
+    if quoted is None:
+        return unquoted
+    if u"\\" in quoted:
+        return _UNICODE_UNQUOTE.sub("\\1", quoted)
+    return quoted
+
+
+def _parse_unicode_slow(string):
+    attrs = collections.defaultdict(list)
+
+    index = 0
+    length = len(string)
+    while True:
+        key, index = _unicode_parse_part(string, index)
+        if index >= length:
+            raise ValueError("unexpected string end")
+        if string[index] != u"=":
+            raise ValueError("unexpected character %r at index %d" %
+                             (string[index], index))
+        index += 1
+
+        value, index = _unicode_parse_part(string, index)
+        attrs[key].append(value)
+
+        if index >= length:
+            return attrs
+
+        if string[index] != u",":
+            raise ValueError("unexpected character %r at index %d" %
+                             (string[index], index))
+        index += 1
+
+
+def _parse_unicode(string, _pair=_UNICODE_PAIR):
+    # Return a dict mapping the keys of the stripped event line to
+    # sets of values.
+    attrs = dict()
+
+    length = len(string)
+    scanner = _pair.scanner(string)
+    while True:
+        match = scanner.match()
+        if match is None:
+            return _parse_unicode_slow(string)
+
+        key_quoted, key, value_quoted, value, separator = match.groups()
+        key = _unicode_unquote(key_quoted, key or u"")
+        value = _unicode_unquote(value_quoted, value or u"")
+
+        values = attrs.get(key, None)
+        if values is None:
+            attrs[key] = set([value])
+        else:
+            values.add(value)
+
+        if not separator:
+            return attrs
+        if match.end() >= length:
+            # A trailing comma.
+            return _parse_unicode_slow(string)
+
+
+def _format_unicode(attrs, quoted_keys=None):
+    pieces = []
+    for key, values in attrs.iteritems():
+        if quoted_keys is None:
+            quoted_key = _unicode_quote(key) + u"="
+        else:
+            quoted_key = quoted_keys.get(key, None)
+            if quoted_key is None:
+                quoted_key = quoted_keys[key] = _unicode_quote(key) + u"="
+
+        for value in values:
+            if _UNICODE_QUOTE_CHECK.search(value):
+                value = u'"' + _UNICODE_QUOTE.sub(r'\\\g<0>', value) + u'"'
+            pieces.append(quoted_key + value)
+    return u", ".join(pieces)
+
+
+class _Interner(object):
+    def __init__(self, max_size, max_length):
+        self._strings = dict()
+        self._max_size = max_size
+        self._max_length = max_length
+
+        self.hits = 0
+        self.saved_bytes = 0
+
+    def __len__(self):
+        return len(self._strings)
+
+    def intern(self, string):
+        existing = self._strings.get(string, None)
+        if existing is not None:
+            if existing is not string:
+                self.hits += 1
+                self.saved_bytes += sys.getsizeof(string)
+            return existing
+
+        # The table only grows up to its maximum size, after which new
+        # strings are passed through as they are. Nothing gets evicted:
+        # evicting would need bookkeeping on every hit, and the strings
+        # worth sharing (feed names, types, countries) tend to show up
+        # early and keep showing up.
+        if len(string) <= self._max_length and len(self._strings) < self._max_size:
+            self._strings[string] = string
+        return string
+
+
+_interned_keys = None
+_interned_values = None
+
+
+def set_interning(max_keys=0, max_values=0, max_value_length=64):
+    """Share equal keys and values between the events that are created
+    from this point on (including unpickled and parsed events), so that
+    repeated strings are stored only once.
+
+    At most max_keys keys and max_values values are interned. The
+    tables are filled on a first come, first served basis and never
+    evict anything, so once a table is full, strings not seen before
+    pass through as they are. Values longer than max_value_length are
+    never interned, to keep high cardinality values such as URLs from
+    filling the table. Zeros disable the interning.
+
+    >>> set_interning(max_keys=16, max_values=16)
+    >>> first = Event(feed="example")
+    >>> second = Event(feed="example")
+    >>> first.values("feed")[0] is second.values("feed")[0]
+    True
+    >>> interning_stats()["values"]
+    1
+    >>> set_interning()
+    """
+
+    global _interned_keys, _interned_values
+    _interned_keys = _Interner(max_keys, sys.maxint) if max_keys > 0 else None
+    _interned_values = _Interner(max_values, max_value_length) if max_values > 0 else None
+
+
+def interning_stats():
+    """Return a dict with the number of interned keys and values, the
+    number of times an equal string was replaced with an interned one,
+    and an estimate of the memory (in bytes) that the replaced strings
+    took.
+    """
+
+    stats = {"keys": 0, "values": 0, "hits": 0, "saved bytes": 0}
+    for name, interner in [("keys", _interned_keys), ("values", _interned_values)]:
+        if interner is not None:
+            stats[name] = len(interner)
+            stats["hits"] += interner.hits
+            stats["saved bytes"] += interner.saved_bytes
+    return stats
+
+
+def _merge(attrs, key, values):
+    existing = attrs.get(key, None)
+    if existing is None:
+        attrs[key] = values
+    else:
+        attrs[key] = existing.union(values)
+
 
 class Event(object):
-    __slots__ = ["_attrs"]
+    # The value sets are copy-on-write: A frozenset may be shared with
+    # other events and gets replaced with a private set when the event
+    # is modified. A plain set is always private to the event. The
+    # _frozen flag tells that all of the value sets are frozensets.
+    # _digests memoizes the hexdigests of the event per hash function
+    # until the event is modified.
+    __slots__ = ["_attrs", "_frozen", "_digests"]
 
     _UNDEFINED = object()
 
@@ -98,11 +299,12 @@ class Event(object):
 
         for obj in args + (keys,):
             if type(obj) == Event:
-                for key, values in obj._attrs.iteritems():
-                    if key not in result:
-                        result[key] = values.copy()
-                    else:
-                        result[key].update(values)
+                if not result:
+                    result = dict(obj._shared_attrs())
+                    continue
+
+                for key, values in obj._shared_attrs().iteritems():
+                    _merge(result, key, values)
                 continue
 
             if hasattr(obj, "iteritems"):
@@ -110,20 +312,53 @@ class Event(object):
             elif hasattr(obj, "items"):
                 obj = obj.items()
 
+            interned_keys = _interned_keys
+            interned_values = _interned_values
+
             for key, values in obj:
                 if isinstance(values, basestring):
                     values = (_normalize(values),)
                 else:
                     values = (_normalize(x) for x in values)
+                if interned_values is not None:
+                    values = (interned_values.intern(x) for x in values)
 
                 key = _normalize(key)
-                if key not in result:
-                    result[key] = set(values)
-                else:
-                    result[key].update(values)
+                if interned_keys is not None:
+                    key = interned_keys.intern(key)
+                _merge(result, key, frozenset(values))
 
         return result
 
+    def _shared_attrs(self):
+        """Freeze the event's value sets so that they can be shared
+        with other events and return the attribute dict.
+
+        >>> event = Event(a="b")
+        >>> copy = Event(event)
+        >>> copy._attrs[u"a"] is event._attrs[u"a"]
+        True
+        >>> copy.add("a", "c")
+        >>> event.values("a")
+        (u'b',)
+        """
+
+        attrs = self._attrs
+        if not self._frozen:
+            for key, values in attrs.items():
+                if type(values) is not frozenset:
+                    attrs[key] = frozenset(values)
+            self._frozen = True
+        return attrs
+
+    def _private_values(self, key):
+        values = self._attrs.get(key, None)
+        if type(values) is frozenset:
+            values = set(values)
+            self._attrs[key] = values
+        self._frozen = False
+        return values
+
     @classmethod
     def from_unicode(cls, string):
         r"""
@@ -149,30 +384,16 @@ class Event(object):
         string = string.strip()
         if not string:
             return cls()
+        return cls._from_parsed(string, _parse_unicode(string))
 
-        attrs = collections.defaultdict(list)
-
-        index = 0
-        length = len(string)
-        while True:
-            key, index = _unicode_parse_part(string, index)
-            if index >= length:
-                raise ValueError("unexpected string end")
-            if string[index] != u"=":
-                raise ValueError("unexpected character %r at index %d" %
-                                 (string[index], index))
-            index += 1
-
-            value, index = _unicode_parse_part(string, index)
-            attrs[key].append(value)
-
-            if index >= length:
-                return cls(attrs)
-
-            if string[index] != u",":
-                raise ValueError("unexpected character %r at index %d" %
-                                 (string[index], index))
-            index += 1
+    @classmethod
+    def _from_parsed(cls, string, attrs):
+        # Parsing an unicode string produces normalized keys and values,
+        # unless the values still need to be interned.
+        if type(string) is unicode and _interned_keys is None and _interned_values is None:
+            if type(attrs) is dict:
+                return cls._from_normalized(attrs)
+        return cls(attrs)
 
     @classmethod
     def from_elements(self, elements):
@@ -192,24 +413,64 @@ class Event(object):
         True
         """
 
+        # The attribute dicts are built directly, so that the decoded
+        # values don't have to go through _itemize. Values that the XML
+        # parser has already produced as unicode skip _normalize.
+
+        interned_keys = _interned_keys
+        interned_values = _interned_values
+
         # Future event format
         for event_element in elements.children("e", EVENT_NS):
-            attrs = collections.defaultdict(list)
-            for key_element in event_element.children("k").with_attrs("a"):
-                key = b64decode(key_element.get_attr("a")).decode("utf-8")
-                for value_element in key_element.children("v").with_attrs("a"):
-                    value = b64decode(value_element.get_attr("a")).decode("utf-8")
-                    attrs[key].append(value)
-            yield Event(attrs)
+            attrs = dict()
+            for key_element in event_element.children("k"):
+                key = key_element.get_attr("a", None)
+                if key is None:
+                    continue
+                key = b64decode(key).decode("utf-8")
+                if interned_keys is not None:
+                    key = interned_keys.intern(key)
+
+                values = None
+                for value_element in key_element.children("v"):
+                    value = value_element.get_attr("a", None)
+                    if value is None:
+                        continue
+                    if values is None:
+                        values = attrs.get(key, None)
+                        if values is None:
+                            values = attrs[key] = set()
+                    value = b64decode(value).decode("utf-8")
+                    if interned_values is not None:
+                        value = interned_values.intern(value)
+                    values.add(value)
+            yield Event._from_normalized(attrs)
 
         # Legacy event format
         for event_element in elements.children("event", EVENT_NS):
-            attrs = collections.defaultdict(list)
-            for attr in event_element.children("attr").with_attrs("key", "value"):
-                key = attr.get_attr("key")
-                value = attr.get_attr("value")
-                attrs[key].append(value)
-            yield Event(attrs)
+            attrs = dict()
+            for attr in event_element.children("attr"):
+                key = attr.get_attr("key", None)
+                value = attr.get_attr("value", None)
+                if key is None or value is None:
+                    continue
+
+                if type(key) is not unicode:
+                    key = _normalize(key)
+                if type(value) is not unicode:
+                    value = _normalize(value)
+
+                if interned_keys is not None:
+                    key = interned_keys.intern(key)
+                if interned_values is not None:
+                    value = interned_values.intern(value)
+
+                values = attrs.get(key, None)
+                if values is None:
+                    attrs[key] = set([value])
+                else:
+                    values.add(value)
+            yield Event._from_normalized(attrs)
 
     def __init__(self, *args, **keys):
         """
@@ -221,7 +482,27 @@ class Event(object):
         ((u'\\xe4', u'\\xe4'),)
         """
 
+        # _itemize only produces frozensets.
         self._attrs = self._itemize(*args, **keys)
+        self._frozen = True
+        self._digests = None
+
+    @classmethod
+    def _from_normalized(cls, attrs):
+        """Return a new event that takes the ownership of the given dict.
+        The dict must map unicode keys to non-empty sets of unicode values,
+        as no copying or normalization is done. Frozensets get shared
+        copy-on-write like the values of unioned events.
+
+        >>> Event._from_normalized({u"a": set([u"b"])}) == Event(a="b")
+        True
+        """
+
+        event = cls.__new__(cls)
+        event._attrs = attrs
+        event._frozen = False
+        event._digests = None
+        return event
 
     def union(self, *args, **keys):
         """Return a new event that contains all key-value pairs from
@@ -244,11 +525,16 @@ class Event(object):
 
         other = self._itemize(*args, **keys)
         result = dict()
-        for key, values in self._attrs.iteritems():
-            diff = values.difference(other.get(key, ()))
+        for key, values in self._shared_attrs().iteritems():
+            removed = other.get(key, None)
+            if not removed:
+                result[key] = values
+                continue
+
+            diff = values.difference(removed)
             if diff:
                 result[key] = diff
-        return type(self)(result)
+        return type(self)._from_normalized(result)
 
     def add(self, key, value, *values):
         """Add value(s) for a key.
@@ -295,9 +581,11 @@ class Event(object):
         """
 
         key = _normalize(key)
-        if key not in self._attrs:
-            self._attrs[key] = set()
-        self._attrs[key].update(_normalize(value) for value in values)
+        self._digests = None
+        valueset = self._private_values(key)
+        if valueset is None:
+            valueset = self._attrs[key] = set()
+        valueset.update(_normalize(value) for value in values)
 
     def discard(self, key, value, *values):
         """Discard some value(s) of a key.
@@ -318,9 +606,10 @@ class Event(object):
         """
 
         key = _normalize(key)
-        if key not in self._attrs:
+        self._digests = None
+        valueset = self._private_values(key)
+        if valueset is None:
             return
-        valueset = self._attrs[key]
         valueset.difference_update(_normalize(value) for value in (value,) + values)
         if not valueset:
             del self._attrs[key]
@@ -341,6 +630,7 @@ class Event(object):
         """
 
         key = _normalize(key)
+        self._digests = None
         self._attrs.pop(key, None)
 
     def _unkeyed(self):
@@ -632,7 +922,42 @@ class Event(object):
         return tuple(key for key in self._attrs
                      if self.contains(key, parser=parser, filter=filter))
 
-    def to_elements(self, include_body=True):
+    def to_elements(self, include_body=True, compact=False, max_body_length=None):
+        """Return the event as XML element(s).
+
+        By default the event is encoded in the legacy format, in which
+        each key-value pair is an <attr> element. With compact=True the
+        event is encoded in the more compact format with base64 encoded
+        keys and values, which Event.from_elements also understands.
+
+        >>> event = Event({u"a": [u"b", u"c"]})
+        >>> element = Element("message")
+        >>> element.add(event.to_elements(compact=True))
+        >>> list(Event.from_elements(element)) == [event]
+        True
+
+        A human-readable <body> element is included unless include_body
+        is False. The body text can also be truncated to a maximum
+        length (a trailing "..." included).
+
+        >>> elements = Event(a="bcdefghijklmn").to_elements(max_body_length=8)
+        >>> [body.text for body in elements.named("body")]
+        [u'a=bcd...']
+        """
+
+        if compact:
+            element = self._to_compact_element()
+        else:
+            element = self._to_legacy_element()
+
+        if not include_body:
+            return element
+
+        body = Element("body")
+        body.text = _replace_non_xml_chars(_truncate_body(unicode(self), max_body_length))
+        return Elements(body, element)
+
+    def _to_legacy_element(self):
         element = Element("event", xmlns=EVENT_NS)
 
         for key, value in self.items():
@@ -641,12 +966,21 @@ class Event(object):
             attr = Element("attr", key=key, value=value)
             element.add(attr)
 
-        if not include_body:
-            return element
+        return element
 
-        body = Element("body")
-        body.text = _replace_non_xml_chars(unicode(self))
-        return Elements(body, element)
+    def _to_compact_element(self):
+        element = Element("e", xmlns=EVENT_NS)
+
+        for key, values in self._attrs.iteritems():
+            if not values:
+                continue
+
+            key_element = Element("k", a=b64encode(key.encode("utf-8")))
+            for value in values:
+                key_element.add(Element("v", a=b64encode(value.encode("utf-8"))))
+            element.add(key_element)
+
+        return element
 
     def __reduce__(self):
         return self.__class__, (self._attrs,)
@@ -673,8 +1007,7 @@ class Event(object):
         The specific order of the key-value pairs is undefined.
         """
 
-        return u", ".join(_unicode_quote(key) + u"=" + _unicode_quote(value)
-                          for (key, value) in self.items())
+        return _format_unicode(self._attrs)
 
     def __repr__(self):
         attrs = dict()
@@ -683,6 +1016,229 @@ class Event(object):
         return self.__class__.__name__ + "(" + repr(attrs) + ")"
 
 
+class EventBatch(object):
+    r"""A columnar batch of events sharing one table of keys. Each event
+    ("row") is stored as a tuple of values, one value per key. Missing
+    values are stored as None. The same key may appear several times
+    in the key table to give an event several values for it.
+
+    Batches let bulk producers (e.g. CSV feeds) skip building an Event
+    object per row until one is actually needed.
+
+    >>> batch = EventBatch(["ip", "port", "port"])
+    >>> batch.append(["192.0.2.1", "80", "443"])
+    >>> batch.append(["192.0.2.2", "22", None])
+    >>> len(batch)
+    2
+    >>> list(batch) == [
+    ...     Event({"ip": "192.0.2.1", "port": ["80", "443"]}),
+    ...     Event({"ip": "192.0.2.2", "port": "22"})
+    ... ]
+    True
+
+    Empty values are treated as missing.
+
+    >>> batch.append(["", "", ""])
+    >>> list(batch)[-1] == Event()
+    True
+    """
+
+    __slots__ = ["_keys", "_rows"]
+
+    def __init__(self, keys, rows=()):
+        self._keys = tuple(_normalize(key) for key in keys)
+        self._rows = []
+
+        for row in rows:
+            self.append(row)
+
+    @property
+    def keys(self):
+        return self._keys
+
+    @property
+    def rows(self):
+        return tuple(self._rows)
+
+    def append(self, row):
+        """Append a row of values, one value per key of the batch.
+
+        >>> EventBatch(["a", "b"]).append(["x"])
+        Traceback (most recent call last):
+            ...
+        ValueError: expected 2 values, got 1
+        """
+
+        row = tuple(_normalize(value) if value else None for value in row)
+        if len(row) != len(self._keys):
+            raise ValueError("expected {0} values, got {1}".format(len(self._keys), len(row)))
+        self._rows.append(row)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __nonzero__(self):
+        return bool(self._rows)
+
+    def __iter__(self):
+        keys = self._keys
+        for row in self._rows:
+            yield self._event(keys, row)
+
+    @staticmethod
+    def _event(keys, row):
+        attrs = dict()
+        for key, value in izip(keys, row):
+            if value is None:
+                continue
+
+            values = attrs.get(key, None)
+            if values is None:
+                attrs[key] = set([value])
+            else:
+                values.add(value)
+        return Event._from_normalized(attrs)
+
+    def _items(self, row):
+        return set((key, value) for key, value in izip(self._keys, row) if value is not None)
+
+    def select(self, indexes):
+        """Return a new batch that contains the rows with the given indexes.
+        The rows themselves are shared, not copied.
+
+        >>> batch = EventBatch(["a"], [["x"], ["y"], ["z"]])
+        >>> [event.value("a") for event in batch.select([0, 2])]
+        [u'x', u'z']
+        """
+
+        batch = EventBatch(())
+        batch._keys = self._keys
+        rows = self._rows
+        batch._rows = [rows[index] for index in indexes]
+        return batch
+
+    def column_values(self, key):
+        """Return a list that contains for each row a tuple of the row's
+        values for the given key.
+
+        >>> batch = EventBatch(["a", "b", "a"], [["x", "y", None], [None, "z", None]])
+        >>> batch.column_values("a")
+        [(u'x',), ()]
+        """
+
+        key = _normalize(key)
+        indexes = [index for index, other in enumerate(self._keys) if other == key]
+
+        columns = []
+        for row in self._rows:
+            columns.append(tuple(row[index] for index in indexes if row[index] is not None))
+        return columns
+
+    def hexdigests(self, func=hashlib.sha1):
+        """Return a list of the hexdigests of the batch's rows. Each one is
+        the same as the hexdigest of the corresponding event.
+
+        >>> batch = EventBatch(["a", "a"], [["b", "b"], ["b", "c"]])
+        >>> batch.hexdigests() == [hexdigest(event) for event in batch]
+        True
+        """
+
+        return [_hexdigest_data(data, func) for data in self._digest_data()]
+
+    def fingerprints(self):
+        """Return a list of the fingerprints of the batch's rows. Each one
+        is the same as the fingerprint of the corresponding event.
+
+        >>> batch = EventBatch(["b", "a"], [["x", "y"], ["x", None]])
+        >>> batch.fingerprints() == [fingerprint(event) for event in batch]
+        True
+        """
+
+        return [_fingerprint_data(data) for data in self._digest_data()]
+
+    def _digest_data(self):
+        keys = self._keys
+        if len(set(keys)) != len(keys):
+            for row in self._rows:
+                yield _digest_data(self._items(row))
+            return
+
+        # With unique keys the rows' pairs are in the same order as the
+        # keys, so the sorting and key encoding is done once per batch.
+        order = sorted(xrange(len(keys)), key=keys.__getitem__)
+        encoded = [(index, keys[index].encode("utf-8")) for index in order]
+        for row in self._rows:
+            parts = []
+            for index, key in encoded:
+                value = row[index]
+                if value is not None:
+                    parts.append(key)
+                    parts.append(value.encode("utf-8"))
+            parts.append("")
+            yield "\xc0".join(parts)
+
+    def to_elements(self, include_body=True, compact=False, max_body_length=None):
+        """Return a list with the result of Event.to_elements for each
+        row. The XML-safe and base64 encoded forms of the keys are
+        computed only once per batch.
+
+        >>> batch = EventBatch(["a", "b"], [["x", "y"], ["z", None]])
+        >>> [unicode(body.text) for elements in batch.to_elements()
+        ...  for body in elements.named("body")]
+        [u'a=x, b=y', u'a=z']
+        """
+
+        keys = self._keys
+        if len(set(keys)) != len(keys):
+            # Rows may repeat key-value pairs, so build proper events.
+            return [self._event(keys, row).to_elements(include_body, compact, max_body_length) for row in self._rows]
+
+        if compact:
+            key_attrs = [b64encode(key.encode("utf-8")) for key in keys]
+        else:
+            key_attrs = [_replace_non_xml_chars(key) for key in keys]
+        quoted_keys = dict()
+
+        results = []
+        for row in self._rows:
+            if compact:
+                element = Element("e", xmlns=EVENT_NS)
+                for key_attr, value in izip(key_attrs, row):
+                    if value is not None:
+                        key_element = Element("k", a=key_attr)
+                        key_element.add(Element("v", a=b64encode(value.encode("utf-8"))))
+                        element.add(key_element)
+            else:
+                element = Element("event", xmlns=EVENT_NS)
+                for key_attr, value in izip(key_attrs, row):
+                    if value is not None:
+                        element.add(Element("attr", key=key_attr, value=_replace_non_xml_chars(value)))
+
+            if not include_body:
+                results.append(element)
+                continue
+
+            pieces = []
+            for key, value in izip(keys, row):
+                if value is None:
+                    continue
+
+                quoted_key = quoted_keys.get(key, None)
+                if quoted_key is None:
+                    quoted_key = quoted_keys[key] = _unicode_quote(key) + u"="
+                if _UNICODE_QUOTE_CHECK.search(value):
+                    value = u'"' + _UNICODE_QUOTE.sub(r'\\\g<0>', value) + u'"'
+                pieces.append(quoted_key + value)
+
+            body = Element("body")
+            body.text = _replace_non_xml_chars(_truncate_body(u", ".join(pieces), max_body_length))
+            results.append(Elements(body, element))
+        return results
+
+    def __repr__(self):
+        return self.__class__.__name__ + "(" + repr(list(self._keys)) + ", " + repr(self._rows) + ")"
+
+
 def hexdigest(event, func=hashlib.sha1):
     """Return a hexadecimal digest string created by from the given event's
     key-value pairs.
@@ -719,22 +1275,148 @@ def hexdigest(event, func=hashlib.sha1):
     >>> import hashlib
     >>> hexdigest(Event(a="b"), hashlib.sha1)
     'edf6294fc1d3f9fe8be4a2d5626788bcfde05e62'
+
+    The digest is memoized in the event for each hashing algorithm, and
+    computed again after the event has been modified.
+
+    >>> event = Event(a="b")
+    >>> hexdigest(event) == hexdigest(event)
+    True
+    >>> event.add("x", "y")
+    >>> hexdigest(event) == hexdigest(Event(a="b", x="y"))
+    True
     """
 
-    result = func()
+    digests = event._digests
+    if digests is None:
+        digests = event._digests = dict()
+    else:
+        digest = digests.get(func, None)
+        if digest is not None:
+            return digest
+
+    digest = digests[func] = _hexdigest_data(_event_digest_data(event._attrs), func)
+    return digest
+
+
+def fingerprint(event):
+    """Return a 64-bit integer fingerprint of the given event's key-value
+    pairs, e.g. for deduplicating events. Like with hexdigest, equal
+    events have equal fingerprints regardless of the insertion order.
+
+    >>> fingerprint(Event(a="b", x="y")) == fingerprint(Event(x="y", a="b"))
+    True
+
+    The fingerprint is the 64 most significant bits of the event's MD5
+    hexdigest. It is memoized in the event like the hexdigests are.
+
+    >>> fingerprint(Event(a="b")) == int(hexdigest(Event(a="b"), hashlib.md5), 16) >> 64
+    True
+    """
+
+    digests = event._digests
+    if digests is None:
+        digests = event._digests = dict()
+    else:
+        result = digests.get(fingerprint, None)
+        if result is not None:
+            return result
+
+    result = digests[fingerprint] = _fingerprint_data(_event_digest_data(event._attrs))
+    return result
+
+
+def fingerprints(objs):
+    """Return a list of the fingerprints of the given events. The argument
+    can also be an EventBatch.
+
+    >>> fingerprints([Event(a="b"), Event()]) == [fingerprint(Event(a="b")), fingerprint(Event())]
+    True
+    """
+
+    if isinstance(objs, EventBatch):
+        return objs.fingerprints()
+    return [fingerprint(obj) for obj in objs]
+
+
+def _digest_data(items):
+    # The pairs are encoded into a single buffer so that they can be fed
+    # to the hash function in one go. The separator byte 0xc0 never
+    # appears in UTF-8.
+    parts = []
+    for key, value in sorted(items):
+        parts.append(key.encode("utf-8"))
+        parts.append(value.encode("utf-8"))
+    parts.append("")
+    return "\xc0".join(parts)
+
 
-    for key, value in sorted(event.items()):
-        result.update(key.encode("utf-8"))
-        result.update("\xc0")
-        result.update(value.encode("utf-8"))
-        result.update("\xc0")
+def _event_digest_data(attrs):
+    # Same as _digest_data(event.items()) without building the pairs.
+    parts = []
+    for key in sorted(attrs):
+        values = attrs[key]
+        if not values:
+            continue
 
+        encoded_key = key.encode("utf-8")
+        for value in sorted(values):
+            parts.append(encoded_key)
+            parts.append(value.encode("utf-8"))
+    parts.append("")
+    return "\xc0".join(parts)
+
+
+def _hexdigest_data(data, func):
+    result = func()
+    result.update(data)
     return result.hexdigest()
 
 
+_FINGERPRINT = struct.Struct("!Q")
+
+
+def _fingerprint_data(data, _md5=hashlib.md5, _unpack=_FINGERPRINT.unpack_from):
+    return _unpack(_md5(data).digest())[0]
+
+
+def parse_unicode_lines(lines):
+    r"""Yield events parsed from an iterable of lines in the format
+    produced by unicode(event). Empty lines are skipped.
+
+    >>> list(parse_unicode_lines([u"a=b, c=d\n", u"\n", u'x="y, z"']))
+    [Event({u'a': [u'b'], u'c': [u'd']}), Event({u'x': [u'y, z']})]
+    """
+
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield Event._from_parsed(line, _parse_unicode(line))
+
+
+def format_unicode_lines(events):
+    r"""Yield the unicode representations of the given events, each
+    followed by a newline. The quoted forms of keys are computed only
+    once for the whole stream.
+
+    >>> list(format_unicode_lines([Event(a="b"), Event(a="c d")]))
+    [u'a=b\n', u'a="c d"\n']
+    """
+
+    quoted_keys = dict()
+    for event in events:
+        if len(quoted_keys) > 4096:
+            quoted_keys.clear()
+        yield _format_unicode(event._attrs, quoted_keys) + u"\n"
+
+
 def stanzas_to_events():
     return idiokit.map(Event.from_elements)
 
 
-def events_to_elements():
-    return idiokit.map(lambda x: (x.to_elements(),))
+def events_to_elements(include_body=True, compact=False, max_body_length=None):
+    def _to_elements(event):
+        if isinstance(event, EventBatch):
+            return event.to_elements(include_body, compact, max_body_length)
+        return (event.to_elements(include_body, compact, max_body_length),)
+    return idiokit.map(_to_elements)
@@ -2,15 +2,20 @@ from __future__ import absolute_import
 
 import os
 import sys
+import time
 import errno
+import random
+import bisect
 import struct
+import hashlib
 import cPickle
 import idiokit
 import subprocess
 import contextlib
 import socket as native_socket
+from itertools import izip
 from idiokit import socket, select
-from . import events, rules, taskfarm, bot
+from . import events, rules, taskfarm, bot, shmring
 
 
 class _ConnectionLost(Exception):
@@ -41,20 +46,316 @@ def _recvall_blocking(conn, amount):
     return "".join(data)
 
 
-def send_encoded(conn, obj):
-    msg_bytes = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
-    data = struct.pack("!I", len(msg_bytes)) + msg_bytes
+class PickleWireFormat(object):
+    """
+    Encode messages with cPickle.
 
+    >>> wire = PickleWireFormat()
+    >>> wire.decode(wire.encode(("event", (u"room", events.Event(a="b")))))
+    ('event', (u'room', Event({u'a': [u'b']})))
+    """
+
+    def encode(self, obj):
+        return cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return cPickle.loads(str(data))
+
+
+def _unique(objs):
+    seen = set()
+    result = []
+    for obj in objs:
+        if obj not in seen:
+            seen.add(obj)
+            result.append(obj)
+    return result
+
+
+class _InternEncoder(object):
+    def __init__(self, max_size):
+        self._ids = dict()
+        self._max_size = max_size
+
+    def intern(self, objs):
+        ids = self._ids
+
+        new = [x for x in _unique(objs) if x not in ids]
+        reset = len(ids) + len(new) > self._max_size
+        if reset:
+            ids.clear()
+            new = _unique(objs)
+
+        for obj in new:
+            ids[obj] = len(ids)
+        return reset, [ids[x] for x in objs], new
+
+
+class _InternDecoder(object):
+    def __init__(self):
+        self._objs = []
+
+    def update(self, reset, new):
+        if reset:
+            del self._objs[:]
+        self._objs.extend(new)
+
+    def lookup(self, ids):
+        objs = self._objs
+        return [objs[x] for x in ids]
+
+
+_MSG_PICKLE = "p"
+_MSG_EVENT = "e"
+_MSG_RESULT = "r"
+
+_RESET_KEYS = 0x01
+_RESET_ROOMS = 0x02
+
+# Message type, flags, #new rooms, #rooms, #new keys, #key-value pairs
+_HEADER = struct.Struct("!cBIIII")
+
+
+class CompactWireFormat(object):
+    """
+    Encode the roomgraph messages that carry events, i.e.
+    ("event", (room, event)) and ("result", (src_room, event,
+    set_of_dst_rooms)), in a compact binary form. Other messages are
+    pickled.
+
+    Event keys and rooms are interned: Each one is sent only once, after
+    which it is referred to with a numeric id. The intern tables are
+    bounded, and both ends reset them in lockstep when the limit is
+    reached. Values are sent as length-prefixed UTF-8.
+
+    Intern tables are connection-specific, so each end of a connection
+    needs its own CompactWireFormat instance.
+
+    >>> wire = CompactWireFormat()
+    >>> wire.decode(wire.encode(("event", (u"room", events.Event(a="b")))))
+    ('event', (u'room', Event({u'a': [u'b']})))
+    >>> wire.decode(wire.encode(("result", (u"src", events.Event(a="b"), set([u"dst"])))))
+    ('result', (u'src', Event({u'a': [u'b']}), set([u'dst'])))
+    >>> wire.decode(wire.encode(("dec_rule", (u"src", None, u"dst"))))
+    ('dec_rule', (u'src', None, u'dst'))
+    """
+
+    def __init__(self, max_keys=4096, max_rooms=4096):
+        self._key_encoder = _InternEncoder(max_keys)
+        self._room_encoder = _InternEncoder(max_rooms)
+        self._key_decoder = _InternDecoder()
+        self._room_decoder = _InternDecoder()
+
+    def encode(self, obj):
+        if type(obj) is tuple and len(obj) == 2 and obj[0] == "event":
+            room, event = obj[1]
+            if type(event) is events.Event:
+                return self._encode_event(_MSG_EVENT, [room], event)
+        elif type(obj) is tuple and len(obj) == 2 and obj[0] == "result":
+            src, event, dsts = obj[1]
+            if type(event) is events.Event and type(dsts) is set:
+                return self._encode_event(_MSG_RESULT, [src] + list(dsts), event)
+        return _MSG_PICKLE + cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        msg_type = data[:1]
+        if msg_type == _MSG_PICKLE:
+            return cPickle.loads(data[1:])
+
+        rooms, event = self._decode_event(data)
+        if msg_type == _MSG_EVENT:
+            return "event", (rooms[0], event)
+        if msg_type == _MSG_RESULT:
+            return "result", (rooms[0], event, set(rooms[1:]))
+        raise ValueError("unknown message type {0!r}".format(msg_type))
+
+    def _encode_event(self, msg_type, rooms, event):
+        items = event.items()
+
+        key_reset, key_ids, new_keys = self._key_encoder.intern([key for key, _ in items])
+        room_reset, room_ids, new_rooms = self._room_encoder.intern(rooms)
+
+        pieces = [cPickle.dumps(x, cPickle.HIGHEST_PROTOCOL) for x in new_rooms]
+        pieces.extend(x.encode("utf-8") for x in new_keys)
+        pieces.extend(value.encode("utf-8") for _, value in items)
+
+        flags = (_RESET_KEYS if key_reset else 0) | (_RESET_ROOMS if room_reset else 0)
+        header = _HEADER.pack(msg_type, flags, len(new_rooms), len(room_ids), len(new_keys), len(items))
+
+        numbers = room_ids + key_ids + map(len, pieces)
+        pieces.insert(0, struct.pack("!{0}I".format(len(numbers)), *numbers))
+        pieces.insert(0, header)
+        return "".join(pieces)
+
+    def _decode_event(self, data):
+        _, flags, new_room_count, room_count, new_key_count, pair_count = _HEADER.unpack_from(data)
+
+        piece_count = new_room_count + new_key_count + pair_count
+        number_count = room_count + pair_count + piece_count
+        numbers = struct.unpack_from("!{0}I".format(number_count), data, _HEADER.size)
+
+        room_ids = numbers[:room_count]
+        key_ids = numbers[room_count:room_count + pair_count]
+
+        pieces = []
+        offset = _HEADER.size + 4 * number_count
+        for length in numbers[room_count + pair_count:]:
+            pieces.append(data[offset:offset + length])
+            offset += length
+
+        new_rooms = [cPickle.loads(x) for x in pieces[:new_room_count]]
+        texts = [x.decode("utf-8") for x in pieces[new_room_count:]]
+
+        self._room_decoder.update(flags & _RESET_ROOMS, new_rooms)
+        self._key_decoder.update(flags & _RESET_KEYS, texts[:new_key_count])
+
+        attrs = dict()
+        for key, value in izip(self._key_decoder.lookup(key_ids), texts[new_key_count:]):
+            values = attrs.get(key, None)
+            if values is None:
+                attrs[key] = set([value])
+            else:
+                values.add(value)
+
+        rooms = self._room_decoder.lookup(room_ids)
+        return rooms, events.Event._from_normalized(attrs)
+
+
+_LENGTH = struct.Struct("!I")
+
+
+def _frame(msg_bytes):
+    return _LENGTH.pack(len(msg_bytes)) + msg_bytes
+
+
+def encode_batch(wire_format, objs):
+    """
+    Return the given objects encoded into one batch, i.e. a concatenation
+    of length-prefixed messages.
+
+    >>> wire = PickleWireFormat()
+    >>> decode_batch(wire, encode_batch(wire, [1, 2, 3]))
+    [1, 2, 3]
+    """
+
+    return "".join(_frame(wire_format.encode(obj)) for obj in objs)
+
+
+def decode_batch(wire_format, data):
+    result = []
+
+    # Decode each message through a buffer instead of a slice, so that
+    # batches in shared memory don't get copied before decoding.
+    offset = 0
+    while offset < len(data):
+        length, = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        result.append(wire_format.decode(buffer(data, offset, length)))
+        offset += length
+    return result
+
+
+# Frames from the parent to a worker either carry a batch inline, or
+# the offset and length of a batch written to the shared memory ring.
+_FRAME_INLINE = "i"
+_FRAME_MAPPED = "m"
+_MAPPED = struct.Struct("!QI")
+
+# Frames from a worker to the parent start with the number of
+# ring batches the worker has consumed.
+_RELEASED = struct.Struct("!I")
+
+
+def _events_frame(batch_bytes, ring=None):
+    if ring is not None:
+        offset = ring.write(batch_bytes)
+        if offset is not None:
+            return _frame(_FRAME_MAPPED + _MAPPED.pack(offset, len(batch_bytes)))
+    return _frame(_FRAME_INLINE + batch_bytes)
+
+
+def _decode_events_frame(wire_format, data, ring=None):
+    frame_type = data[:1]
+    if frame_type == _FRAME_INLINE:
+        return decode_batch(wire_format, buffer(data, 1)), False
+    if frame_type == _FRAME_MAPPED:
+        if ring is None:
+            raise RuntimeError("got a shared memory frame without a shared memory ring")
+        offset, length = _MAPPED.unpack_from(data, 1)
+        return decode_batch(wire_format, ring.read(offset, length)), True
+    raise RuntimeError("unknown frame type {0!r}".format(frame_type))
+
+
+def _results_frame(batch_bytes, released=0):
+    return _frame(_RELEASED.pack(released) + batch_bytes)
+
+
+def _decode_results_frame(wire_format, data):
+    released, = _RELEASED.unpack_from(data)
+    return decode_batch(wire_format, buffer(data, _RELEASED.size)), released
+
+
+def _recv_frame_blocking(sock):
+    length_bytes = _recvall_blocking(sock, _LENGTH.size)
+    length, = _LENGTH.unpack(length_bytes)
+    return _recvall_blocking(sock, length)
+
+
+def _sendall_blocking(conn, data):
     with wrapped_socket_errnos(errno.ECONNRESET, errno.EPIPE):
         conn.sendall(data)
 
 
-def recv_decoded(sock):
-    length_bytes = _recvall_blocking(sock, 4)
-    length, = struct.unpack("!I", length_bytes)
+def send_events(conn, objs, wire_format, ring=None):
+    """
+    Send a batch of messages from the parent to a worker, through the
+    given shared memory ring (a shmring.RingWriter) when it has space.
+    """
+
+    _sendall_blocking(conn, _events_frame(encode_batch(wire_format, objs), ring))
+
+
+def recv_events(sock, wire_format, ring=None):
+    """
+    Receive a batch of messages sent with send_events. Return the
+    messages and whether they were read from the shared memory ring
+    (a shmring.RingReader).
+    """
+
+    return _decode_events_frame(wire_format, _recv_frame_blocking(sock), ring)
+
+
+def open_ring(conn, path):
+    """
+    Map the shared memory ring created by the parent for a worker, and
+    tell the parent whether that worked. Return a shmring.RingReader, or
+    None when the parent should send all batches inline.
+    """
+
+    try:
+        ring = shmring.RingReader(path)
+    except (EnvironmentError, ValueError):
+        ring = None
+    _sendall_blocking(conn, _frame(_FRAME_INLINE if ring is None else _FRAME_MAPPED))
+    return ring
+
 
-    msg_bytes = _recvall_blocking(sock, length)
-    return cPickle.loads(msg_bytes)
+def send_results(conn, objs, wire_format, released=0):
+    """
+    Send a batch of messages from a worker to the parent, along with the
+    number of consumed shared memory ring batches.
+    """
+
+    _sendall_blocking(conn, _results_frame(encode_batch(wire_format, objs), released))
+
+
+def recv_results(sock, wire_format):
+    """
+    Receive a batch of messages sent with send_results. Return the
+    messages and the number of released shared memory ring batches.
+    """
+
+    return _decode_results_frame(wire_format, _recv_frame_blocking(sock))
 
 
 @idiokit.stream
@@ -72,27 +373,157 @@ def _recvall_stream(sock, amount, timeout=None):
 
 
 @idiokit.stream
-def distribute_encode(socks):
+def _recv_ring_status(sock):
+    length_bytes = yield _recvall_stream(sock, _LENGTH.size)
+    length, = _LENGTH.unpack(length_bytes)
+    frame_bytes = yield _recvall_stream(sock, length)
+    idiokit.stop(frame_bytes == _FRAME_MAPPED)
+
+
+class HashRing(object):
+    """
+    A consistent hash ring that maps keys to nodes. Adding or removing
+    a node only remaps the keys of that node.
+
+    >>> ring = HashRing(["a", "b", "c"])
+    >>> ring.get(u"room@conference.example") == ring.get(u"room@conference.example")
+    True
+    >>> ring.get(u"room@conference.example") in ["a", "b", "c"]
+    True
+    """
+
+    @classmethod
+    def _hash(cls, key):
+        digest = hashlib.md5(unicode(key).encode("utf-8")).digest()
+        return struct.unpack("!Q", digest[:8])[0]
+
+    def __init__(self, nodes, replicas=64):
+        ring = []
+        for index, node in enumerate(nodes):
+            for replica in xrange(replicas):
+                ring.append((self._hash(u"{0}-{1}".format(index, replica)), index))
+        ring.sort()
+
+        self._hashes = [hash_ for hash_, _ in ring]
+        self._nodes = [nodes[index] for _, index in ring]
+
+    def get(self, key):
+        index = bisect.bisect(self._hashes, self._hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+def route_by_room(socks):
+    """
+    Return a routing function for distribute_encode that sends all events
+    and rules of a source room to the same socket.
+    """
+
+    ring = HashRing(socks)
+
+    def route(msg):
+        _, args = msg
+        return ring.get(args[0])
+    return route
+
+
+def route_by_key(socks, key):
+    """
+    Return a routing function for distribute_encode that sends events
+    with the same value for the given key to the same socket. Events
+    without such values, as well as rules, are not routed.
+    """
+
+    ring = HashRing(socks)
+
+    def route(msg):
+        type_id, args = msg
+        if type_id != "event":
+            return None
+
+        _, event = args
+        values = event.values(key)
+        if not values:
+            return None
+        return ring.get(min(values))
+    return route
+
+
+# A marker that can be sent to distribute_encode to make it send out
+# the events it has been coalescing.
+FLUSH = object()
+
+
+@idiokit.stream
+def distribute_encode(socks, wire_format=CompactWireFormat, batch_size=1, route=None, rings=None):
+    """
+    Send (to_all, msg) pairs to the given sockets. Messages with a true
+    to_all flag are sent to all sockets, other messages to any writable
+    socket.
+
+    An optional route function can direct a message to a specific socket
+    by returning it. Messages for which the function returns None are
+    handled normally.
+
+    Batches are written to the socket's shared memory ring (from the
+    optional rings dict) when the ring has space. Otherwise they are
+    sent inline over the socket.
+    """
+
+    if rings is None:
+        rings = {}
+
+    wire_formats = dict((sock, wire_format()) for sock in socks)
     writable = []
 
+    # Pending batches for each target socket. The target None means
+    # any writable socket.
+    pending = dict()
+
     while True:
         to_all, msg = yield idiokit.next()
-        msg_bytes = cPickle.dumps(msg, cPickle.HIGHEST_PROTOCOL)
-        data = struct.pack("!I", len(msg_bytes)) + msg_bytes
 
-        if to_all:
+        broadcast = False
+        if msg is FLUSH:
+            targets = pending.keys()
+        else:
+            target = None if route is None else route(msg)
+            if to_all and target is None:
+                # Send out the pending events before messages meant for
+                # all sockets to keep the ordering.
+                broadcast = True
+                targets = pending.keys()
+            else:
+                batch = pending.setdefault(target, [])
+                batch.append(msg)
+                if not to_all and len(batch) < batch_size:
+                    continue
+                targets = [target]
+
+        for target in targets:
+            batch = pending.pop(target)
+
+            sock = target
+            if sock is None:
+                while not writable:
+                    _, writable, _ = yield select.select((), socks, ())
+                    writable = list(writable)
+                sock = writable.pop()
+            batch_bytes = encode_batch(wire_formats[sock], batch)
+            yield sock.sendall(_events_frame(batch_bytes, rings.get(sock, None)))
+
+        if broadcast:
             for sock in socks:
-                yield sock.sendall(data)
+                batch_bytes = encode_batch(wire_formats[sock], [msg])
+                yield sock.sendall(_events_frame(batch_bytes, rings.get(sock, None)))
             writable = []
-        else:
-            while not writable:
-                _, writable, _ = yield select.select((), socks, ())
-                writable = list(writable)
-            yield writable.pop().sendall(data)
 
 
 @idiokit.stream
-def collect_decode(socks):
+def collect_decode(socks, wire_format=CompactWireFormat, rings=None):
+    if rings is None:
+        rings = {}
+
+    wire_formats = dict((sock, wire_format()) for sock in socks)
     readable = []
 
     while True:
@@ -102,11 +533,70 @@ def collect_decode(socks):
 
         sock = readable.pop()
 
-        length_bytes = yield _recvall_stream(sock, 4)
-        length, = struct.unpack("!I", length_bytes)
+        length_bytes = yield _recvall_stream(sock, _LENGTH.size)
+        length, = _LENGTH.unpack(length_bytes)
+
+        frame_bytes = yield _recvall_stream(sock, length)
+        msgs, released = _decode_results_frame(wire_formats[sock], frame_bytes)
+        if released:
+            rings[sock].release(released)
+
+        for msg in msgs:
+            yield idiokit.send(msg)
+
+
+class _MatchCache(object):
+    """
+    A bounded mapping of (event digest, classifier generation) pairs
+    to rule match result dicts, so that events that are seen again (e.g.
+    in several source rooms) don't get matched against the same rules
+    from scratch. The generation changes whenever the rules change,
+    which invalidates the older entries.
+
+    >>> cache = _MatchCache(2)
+    >>> cache.get(events.Event(a="b"), 0)
+    {}
+    >>> cache.get(events.Event(a="b"), 0) is cache.get(events.Event(a="b"), 0)
+    True
+    >>> cache.get(events.Event(a="b"), 1) is cache.get(events.Event(a="b"), 0)
+    False
+    >>> cache.hits, cache.misses
+    (3, 2)
+    """
+
+    def __init__(self, max_size):
+        # Keep two generations of at most half of max_size entries each:
+        # the recently used entries and the ones used before them. Entries
+        # used again get moved to the recent generation, and the older
+        # generation gets dropped as a whole when the recent one fills up.
+        self._generation_size = max(max_size // 2, 1)
+        self._recent = dict()
+        self._older = dict()
 
-        msg_bytes = yield _recvall_stream(sock, length)
-        yield idiokit.send(cPickle.loads(msg_bytes))
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, event, generation):
+        key = events.hexdigest(event), generation
+
+        recent = self._recent
+        match_results = recent.get(key, None)
+        if match_results is not None:
+            self.hits += 1
+            return match_results
+
+        match_results = self._older.pop(key, None)
+        if match_results is None:
+            self.misses += 1
+            match_results = dict()
+        else:
+            self.hits += 1
+
+        if len(recent) >= self._generation_size:
+            self._older = recent
+            self._recent = recent = dict()
+        recent[key] = match_results
+        return match_results
 
 
 class RoomGraphBot(bot.ServiceBot):
@@ -114,51 +604,192 @@ class RoomGraphBot(bot.ServiceBot):
         the number of worker processes used for rule matching
         (default: %default)
         """, default=1)
+    batch_size = bot.IntParam("""
+        the maximum number of events coalesced into one message
+        sent to a worker process (default: %default)
+        """, default=100)
+    batch_latency = bot.FloatParam("""
+        the maximum time (in seconds) events are held back while
+        coalescing them, 0 disables coalescing (default: %default)
+        """, default=0.05)
+    shard_by_room = bot.BoolParam("""
+        route the events of each source room to one worker process
+        (chosen with consistent hashing) and install the room's rules
+        only there
+        """)
+    shard_key = bot.Param("""
+        route events with the same value for the given key to the same
+        worker process (default: use any available worker process)
+        """, default=None)
+    shared_memory_size = bot.IntParam("""
+        the size (in bytes) of the shared memory ring used for
+        sending events to each worker process, 0 sends everything
+        over sockets (default: %default)
+        """, default=4 * 1024 * 1024)
+    compact_events = bot.FeedBot.compact_events
+    max_body_length = bot.FeedBot.max_body_length
+    match_cache_size = bot.IntParam("""
+        the number of recently seen events whose rule match results
+        each worker process remembers, 0 disables the cache
+        (default: %default)
+        """, default=0)
+    value_cache_size = bot.IntParam("""
+        the number of recently parsed IP and domain name values whose
+        parse results each worker process remembers across events,
+        0 disables the cache (default: %default)
+        """, default=0)
+    rule_sample_rate = bot.FloatParam("""
+        the fraction (between 0 and 1) of events for which the worker
+        processes measure the cost of each rule, 0 disables the
+        measurements (default: %default)
+        """, default=0.0)
+    rule_stats_top = bot.IntParam("""
+        the number of the most expensive rules included in the
+        statistics log when rule costs are measured (default: %default)
+        """, default=10)
 
     def __init__(self, *args, **keys):
         bot.ServiceBot.__init__(self, *args, **keys)
 
+        if self.shard_by_room and self.shard_key is not None:
+            raise bot.ParamError("shard_by_room and shard_key can not be used together")
+
         self._rooms = taskfarm.TaskFarm(self._handle_room, grace_period=0.0)
         self._srcs = {}
         self._ready = idiokit.Event()
         self._stats = {}
+        self._match_cache_stats = (0, 0)
+        self._rule_stats = {}
 
-    def _inc_stats(self, room, seen=0, sent=0):
-        seen_count, sent_count = self._stats.get(room, (0, 0))
-        self._stats[room] = seen_count + seen, sent_count + sent
+    def _inc_stats(self, room, seen=0, sent=0, encode_time=0.0, encode_time_saved=0.0):
+        seen_count, sent_count, encode_total, saved_total = self._stats.get(room, (0, 0, 0.0, 0.0))
+        self._stats[room] = (
+            seen_count + seen,
+            sent_count + sent,
+            encode_total + encode_time,
+            saved_total + encode_time_saved
+        )
+
+    def _inc_rule_stats(self, sampled):
+        for src, rule, calls, matches, seconds in sampled:
+            old_calls, old_matches, old_seconds = self._rule_stats.get((src, rule), (0, 0, 0.0))
+            self._rule_stats[(src, rule)] = (
+                old_calls + calls,
+                old_matches + matches,
+                old_seconds + seconds
+            )
+
+    def _log_rule_stats(self):
+        by_cost = sorted(self._rule_stats.iteritems(), key=lambda item: item[1][2], reverse=True)
+
+        for (room, rule), (calls, matches, seconds) in by_cost[:self.rule_stats_top]:
+            self.log.info(
+                u"Room {0}: rule {1} took {2:.6f}s in {3} sampled calls, matched {4}".format(
+                    room, rules.format(rule), seconds, calls, matches),
+                event=events.Event({
+                    "type": "rule",
+                    "service": self.bot_name,
+                    "sampled calls": unicode(calls),
+                    "sampled matches": unicode(matches),
+                    "match rate": u"{0:.3f}".format(float(matches) / calls),
+                    "sampled time": u"{0:.6f}".format(seconds),
+                    "time per call": u"{0:.9f}".format(seconds / calls),
+                    "rule": rules.format(rule),
+                    "room": unicode(room)
+                })
+            )
+        self._rule_stats.clear()
 
     @idiokit.stream
     def _log_stats(self, interval=15.0):
         while True:
             yield idiokit.sleep(interval)
 
-            for room, (seen, sent) in self._stats.iteritems():
+            for room, (seen, sent, encode_time, encode_time_saved) in self._stats.iteritems():
                 self.log.info(
-                    u"Room {0}: seen {1}, sent {2} events".format(room, seen, sent),
+                    u"Room {0}: seen {1}, sent {2} events (encoding took {3:.3f}s, saved {4:.3f}s)".format(
+                        room, seen, sent, encode_time, encode_time_saved),
                     event=events.Event({
                         "type": "room",
                         "service": self.bot_name,
                         "seen events": unicode(seen),
                         "sent events": unicode(sent),
+                        "encode time": u"{0:.3f}".format(encode_time),
+                        "encode time saved": u"{0:.3f}".format(encode_time_saved),
                         "room": unicode(room)
                     })
                 )
             self._stats.clear()
 
+            hits, misses = self._match_cache_stats
+            if hits or misses:
+                self.log.info(
+                    u"Match cache: {0} hits, {1} misses".format(hits, misses),
+                    event=events.Event({
+                        "type": "match cache",
+                        "service": self.bot_name,
+                        "hits": unicode(hits),
+                        "misses": unicode(misses)
+                    })
+                )
+            self._match_cache_stats = (0, 0)
+
+            self._log_rule_stats()
+
+    @idiokit.stream
+    def _flush_batches(self):
+        distributor = yield self._ready.fork()
+
+        while True:
+            yield idiokit.sleep(self.batch_latency)
+            yield distributor.send(False, FLUSH)
+
     @idiokit.stream
     def _distribute(self):
         while True:
-            src, event, dsts = yield idiokit.next()
+            type_id, args = yield idiokit.next()
+            if type_id == "match_cache":
+                hits, misses = args
+                old_hits, old_misses = self._match_cache_stats
+                self._match_cache_stats = old_hits + hits, old_misses + misses
+                continue
+            if type_id == "rule_stats":
+                self._inc_rule_stats(args)
+                continue
+            if type_id != "result":
+                raise RuntimeError("unknown type id {0!r}".format(type_id))
+            src, event, dsts = args
+
+            # Encode the event only once and send the same stanza payload
+            # to every destination room.
+            elements = None
+            encode_time = 0.0
+            encode_time_saved = 0.0
 
-            count = 0
             for dst in dsts:
                 dst_room = self._rooms.get(dst)
-                if dst_room is not None:
-                    count += 1
-                    yield dst_room.send(event.to_elements())
+                if dst_room is None:
+                    continue
 
-            if count > 0:
-                self._inc_stats(src, sent=1)
+                if elements is None:
+                    start = time.time()
+                    elements = event.to_elements(
+                        include_body=self.max_body_length != 0,
+                        compact=self.compact_events,
+                        max_body_length=self.max_body_length
+                    )
+                    encode_time = time.time() - start
+                else:
+                    encode_time_saved += encode_time
+                yield dst_room.send(elements)
+
+            if elements is not None:
+                self._inc_stats(
+                    src,
+                    sent=1,
+                    encode_time=encode_time,
+                    encode_time_saved=encode_time_saved
+                )
 
     @idiokit.stream
     def _handle_room(self, room_name):
@@ -198,9 +829,24 @@ class RoomGraphBot(bot.ServiceBot):
         finally:
             distributor.send(True, ("dec_rule", (src_room, rule, dst_room)))
 
-    def _start_worker(self):
+    def _create_ring(self):
+        if self.shared_memory_size <= 0:
+            return None
+
+        try:
+            return shmring.RingWriter(self.shared_memory_size)
+        except (OSError, EnvironmentError) as error:
+            self.log.warning(u"Could not create a shared memory ring, using sockets only: {0}".format(error))
+            return None
+
+    def _start_worker(self, ring=None):
         env = dict(os.environ)
         env["ABUSEHELPER_SUBPROCESS"] = ""
+        env["ABUSEHELPER_MATCH_CACHE_SIZE"] = str(max(self.match_cache_size, 0))
+        env["ABUSEHELPER_RULE_SAMPLE_RATE"] = repr(self.rule_sample_rate)
+        env["ABUSEHELPER_VALUE_CACHE_SIZE"] = str(max(self.value_cache_size, 0))
+        if ring is not None:
+            env["ABUSEHELPER_SHARED_MEMORY"] = ring.path
 
         # Find out the full package & module name. Don't refer to the
         # variable __loader__ directly to keep flake8 (version 2.5.0)
@@ -232,19 +878,60 @@ class RoomGraphBot(bot.ServiceBot):
     def main(self, _):
         processes = []
         connections = []
+        rings = {}
         try:
             for _ in xrange(self.concurrency):
-                process, connection = self._start_worker()
+                ring = self._create_ring()
+                try:
+                    process, connection = self._start_worker(ring)
+                except:
+                    if ring is not None:
+                        ring.close()
+                    raise
                 processes.append(process)
                 connections.append(connection)
+                if ring is not None:
+                    rings[connection] = ring
 
             if self.concurrency == 1:
                 self.log.info(u"Started 1 worker process")
             else:
                 self.log.info(u"Started {0} worker processes".format(self.concurrency))
 
-            self._ready.succeed(distribute_encode(connections))
-            yield collect_decode(connections) | self._distribute() | self._log_stats()
+            for connection, ring in rings.items():
+                mapped = yield _recv_ring_status(connection)
+                if not mapped:
+                    self.log.warning(u"A worker process could not map its shared memory ring, sending its events over the socket")
+                    del rings[connection]
+                    ring.close()
+
+            if rings:
+                self.log.info(u"Sending events to worker processes through shared memory")
+
+            if self.rule_sample_rate > 0.0:
+                self.log.info(u"Measuring the rule costs of {0:.1%} of events".format(min(self.rule_sample_rate, 1.0)))
+
+            if self.match_cache_size > 0:
+                self.log.info(u"Worker processes remember the match results of {0} events".format(self.match_cache_size))
+
+            if self.batch_latency > 0.0:
+                batch_size = max(self.batch_size, 1)
+                flusher = self._flush_batches()
+            else:
+                batch_size = 1
+                flusher = idiokit.consume()
+
+            if self.shard_by_room:
+                self.log.info(u"Routing events to worker processes by source room")
+                route = route_by_room(connections)
+            elif self.shard_key is not None:
+                self.log.info(u"Routing events to worker processes by key {0!r}".format(self.shard_key))
+                route = route_by_key(connections, self.shard_key)
+            else:
+                route = None
+
+            self._ready.succeed(distribute_encode(connections, batch_size=batch_size, route=route, rings=rings))
+            yield collect_decode(connections, rings=rings) | self._distribute() | self._log_stats() | flusher
         finally:
             for connection in connections:
                 yield connection.close()
@@ -254,31 +941,80 @@ class RoomGraphBot(bot.ServiceBot):
             for process in processes:
                 process.wait()
 
+            for ring in rings.values():
+                ring.close()
+
 
-def roomgraph(conn):
+def roomgraph(conn, wire_format=CompactWireFormat, ring=None, match_cache_size=0, rule_sample_rate=0.0, stats_interval=1.0):
+    wire = wire_format()
     srcs = {}
 
+    # The match cache entries are keyed by the rule generation, which
+    # changes every time a rule gets added or removed. Entries of older
+    # generations never get hit again and age out of the cache.
+    match_cache = _MatchCache(match_cache_size) if match_cache_size > 0 else None
+    generation = 0
+    reported = 0, 0
+
+    # Per-room rule costs of the sampled events, as rule -> [calls, matches, seconds].
+    rule_stats = {}
+    report_time = time.time()
+
     while True:
-        type_id, args = recv_decoded(conn)
-        if type_id == "event":
-            src, event = args
-            if src in srcs:
-                dsts = set(srcs[src].classify(event))
-                if dsts:
-                    send_encoded(conn, (src, event, dsts))
-        elif type_id == "inc_rule":
-            src, rule, dst = args
-            if src not in srcs:
-                srcs[src] = rules.Classifier()
-            srcs[src].inc(rule, dst)
-        elif type_id == "dec_rule":
-            src, rule, dst = args
-            if src in srcs:
-                srcs[src].dec(rule, dst)
-                if srcs[src].is_empty():
-                    del srcs[src]
-        else:
-            raise RuntimeError("unknown type id {0!r}".format(type_id))
+        # Return the classification results of each received batch as one batch.
+        results = []
+
+        msgs, mapped = recv_events(conn, wire, ring)
+        for type_id, args in msgs:
+            if type_id == "event":
+                src, event = args
+                if src in srcs:
+                    if rule_sample_rate > 0.0 and random.random() < rule_sample_rate:
+                        dsts = set(srcs[src].profile(event, rule_stats.setdefault(src, {})))
+                    else:
+                        match_results = None
+                        if match_cache is not None:
+                            match_results = match_cache.get(event, generation)
+                        dsts = set(srcs[src].classify(event, match_results))
+
+                    if dsts:
+                        results.append(("result", (src, event, dsts)))
+            elif type_id == "inc_rule":
+                src, rule, dst = args
+                if src not in srcs:
+                    srcs[src] = rules.IndexedClassifier()
+                srcs[src].inc(rule, dst)
+                generation += 1
+            elif type_id == "dec_rule":
+                src, rule, dst = args
+                if src in srcs:
+                    srcs[src].dec(rule, dst)
+                    if srcs[src].is_empty():
+                        del srcs[src]
+                generation += 1
+            else:
+                raise RuntimeError("unknown type id {0!r}".format(type_id))
+
+        now = time.time()
+        if now >= report_time + stats_interval:
+            report_time = now
+
+            if match_cache is not None:
+                counts = match_cache.hits, match_cache.misses
+                if counts != reported:
+                    results.append(("match_cache", (counts[0] - reported[0], counts[1] - reported[1])))
+                    reported = counts
+
+            if rule_stats:
+                sampled = []
+                for src, stats in rule_stats.iteritems():
+                    for rule, (calls, matches, seconds) in stats.iteritems():
+                        sampled.append((src, rule, calls, matches, seconds))
+                results.append(("rule_stats", sampled))
+                rule_stats = {}
+
+        if results or mapped:
+            send_results(conn, results, wire, released=1 if mapped else 0)
 
 
 if __name__ == "__main__":
@@ -290,8 +1026,16 @@ if __name__ == "__main__":
             os.close(rfd)
             os.close(wfd)
 
+            match_cache_size = int(os.environ.get("ABUSEHELPER_MATCH_CACHE_SIZE", "0"))
+            rule_sample_rate = float(os.environ.get("ABUSEHELPER_RULE_SAMPLE_RATE", "0"))
+            rules.atoms.set_value_cache_size(int(os.environ.get("ABUSEHELPER_VALUE_CACHE_SIZE", "0")))
+
             conn.setblocking(True)
-            roomgraph(conn)
+
+            ring = None
+            if os.environ.get("ABUSEHELPER_SHARED_MEMORY"):
+                ring = open_ring(conn, os.environ["ABUSEHELPER_SHARED_MEMORY"])
+            roomgraph(conn, ring=ring, match_cache_size=match_cache_size, rule_sample_rate=rule_sample_rate)
         except _ConnectionLost:
             pass
         finally:
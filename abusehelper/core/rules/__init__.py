@@ -1,11 +1,11 @@
 from .atoms import String, RegExp, IP, DomainName
 from .rules import Rule, And, Or, No, Match, NonMatch, Fuzzy, Anything
-from .classifier import Classifier
+from .classifier import Classifier, IndexedClassifier
 from .rulelang import rule, parse, format
 
 __all__ = [
     "String", "RegExp", "IP", "DomainName",
     "Rule", "And", "Or", "No", "Match", "NonMatch", "Fuzzy", "Anything",
-    "Classifier",
+    "Classifier", "IndexedClassifier",
     "rule", "parse", "format"
 ]
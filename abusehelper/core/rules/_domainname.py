@@ -204,6 +204,17 @@ class Pattern(object):
         self._labels = tuple(labels)
         self._length = self._free + len(self._labels)
 
+    @property
+    def labels(self):
+        r"""
+        Return the non-wildcard labels of the pattern.
+
+        >>> Pattern(1, ["domain", "example"]).labels
+        ('domain', 'example')
+        """
+
+        return self._labels
+
     def __hash__(self):
         r"""
         >>> s = set([Pattern(0, ["a", "b"])])
@@ -7,8 +7,123 @@ from . import iprange
 from . import _domainname
 
 
+_MISSING = object()
+
+
+class _ParsedValues(object):
+    r"""
+    Remember up to max_size recently used parse results. The results are
+    kept in two generations: the recently used ones and the ones used
+    before them. The older generation gets dropped when the recent one
+    fills up.
+
+    >>> values = _ParsedValues(2)
+    >>> values.set("a", 1)
+    >>> values.set("b", 2)
+    >>> values.get("a")
+    1
+    >>> values.set("c", 3)
+    >>> values.get("b") is _MISSING
+    True
+    """
+
+    def __init__(self, max_size):
+        self._generation_size = max(max_size // 2, 1)
+        self._recent = dict()
+        self._older = dict()
+
+    def get(self, key):
+        result = self._recent.get(key, _MISSING)
+        if result is _MISSING:
+            result = self._older.pop(key, _MISSING)
+            if result is not _MISSING:
+                self.set(key, result)
+        return result
+
+    def set(self, key, result):
+        if len(self._recent) >= self._generation_size:
+            self._older = self._recent
+            self._recent = dict()
+        self._recent[key] = result
+
+
+_hot_values = None
+
+
+def set_value_cache_size(max_size):
+    r"""
+    Remember the parse results of the given number of recently parsed
+    IP and domain name values across classifications. 0 (the default)
+    only shares the parse results within one classification.
+    """
+
+    global _hot_values
+    _hot_values = _ParsedValues(max_size) if max_size > 0 else None
+
+
+def _parsed(parse, value, cache):
+    key = parse, value
+
+    if cache is not None:
+        result = cache.get(key, _MISSING)
+        if result is not _MISSING:
+            return result
+
+    hot_values = _hot_values
+    if hot_values is None:
+        result = parse(value)
+    else:
+        result = hot_values.get(key)
+        if result is _MISSING:
+            result = parse(value)
+            hot_values.set(key, result)
+
+    if cache is not None:
+        cache[key] = result
+    return result
+
+
+def _parse_ip(value):
+    try:
+        return iprange.IPRange.from_autodetected(value)
+    except ValueError:
+        return None
+
+
+def parse_ip(value, cache=None):
+    r"""
+    Return the IP range parsed from the given value, or None if the value
+    is not a valid IP address or range.
+
+    The parse result is stored in the optional cache dict (e.g. the one
+    passed to Rule.match) so that all atoms matching the same value
+    during a classification share it.
+
+    >>> cache = {}
+    >>> parse_ip("192.0.2.0/24", cache) is parse_ip("192.0.2.0/24", cache)
+    True
+    >>> parse_ip("not an ip", cache) is None
+    True
+    """
+
+    return _parsed(_parse_ip, value, cache)
+
+
+def parse_domain_name(value, cache=None):
+    r"""
+    Return the domain name parsed from the given value as a tuple of
+    labels, or None if the value is not a valid domain name. Parse
+    results are cached like with parse_ip.
+
+    >>> parse_domain_name("domain.example", {})
+    (u'domain', u'example')
+    """
+
+    return _parsed(_domainname.parse_name, value, cache)
+
+
 class Atom(core.Matcher):
-    def match(self, value):
+    def match(self, value, cache=None):
         return False
 
 
@@ -28,7 +143,7 @@ class String(Atom):
     def value(self):
         return self._value
 
-    def match(self, value):
+    def match(self, value, cache=None):
         return self._value == value
 
     def dump(self):
@@ -82,7 +197,7 @@ class RegExp(Atom):
             return Atom.__repr__(self, pattern, ignore_case=True)
         return Atom.__repr__(self, pattern)
 
-    def match(self, value):
+    def match(self, value, cache=None):
         return self._regexp.search(value)
 
     def dump(self):
@@ -117,10 +232,9 @@ class IP(Atom):
     def __unicode__(self):
         return unicode(self._range)
 
-    def match(self, value):
-        try:
-            range = iprange.IPRange.from_autodetected(value)
-        except ValueError:
+    def match(self, value, cache=None):
+        range = parse_ip(value, cache)
+        if range is None:
             return False
         return self._range.contains(range)
 
@@ -153,8 +267,8 @@ class DomainName(Atom):
     def __unicode__(self):
         return unicode(self._pattern)
 
-    def match(self, value):
-        name = _domainname.parse_name(value)
+    def match(self, value, cache=None):
+        name = parse_domain_name(value, cache)
         if name is None:
             return False
         return self._pattern.contains(name)
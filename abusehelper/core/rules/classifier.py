@@ -1,3 +1,11 @@
+from __future__ import absolute_import
+
+import time
+
+from . import atoms
+from . import rules
+
+
 class Classifier(object):
     def __init__(self):
         self._rules = dict()
@@ -22,9 +30,28 @@ class Classifier(object):
             if not classes:
                 self._rules.pop(rule, None)
 
-    def classify(self, obj):
+    def classify(self, obj, cache=None):
+        r"""
+        Return the set of class ids whose rules match the given object.
+
+        The optional cache dict holds the rule match results for the
+        object. It can be shared between classifiers, and between
+        classifications of objects that are equal, to avoid matching
+        the same rule against the same object twice.
+
+        >>> from ..events import Event
+        >>> c = Classifier()
+        >>> c.inc(rules.Match("a", "b"), "X")
+        >>> cache = dict()
+        >>> c.classify(Event(a="b"), cache)
+        set(['X'])
+        >>> cache[rules.Match("a", "b")]
+        True
+        """
+
         result = set()
-        cache = dict()
+        if cache is None:
+            cache = dict()
 
         for rule, classes in self._rules.iteritems():
             if result.issuperset(classes):
@@ -35,5 +62,240 @@ class Classifier(object):
 
         return result
 
+    def candidates(self, obj, cache=None):
+        r"""
+        Return the set of rules that have to be matched against the given
+        object to classify it.
+        """
+
+        return set(self._rules)
+
+    def profile(self, obj, stats):
+        r"""
+        Classify the given object like classify does, but match every
+        candidate rule separately and record the cost of each one.
+
+        The stats dict maps rules to [calls, matches, seconds] lists that
+        get updated in place. Rules are matched without sharing a cache
+        and without skipping rules whose classes are already known, so
+        that each rule pays for its own subrules.
+
+        >>> from ..events import Event
+        >>> c = Classifier()
+        >>> c.inc(rules.Match("a", "b"), "X")
+        >>> stats = dict()
+        >>> c.profile(Event(a="b"), stats)
+        set(['X'])
+        >>> calls, matches, seconds = stats[rules.Match("a", "b")]
+        >>> calls, matches
+        (1, 1)
+        """
+
+        result = set()
+
+        for rule in self.candidates(obj):
+            start = time.time()
+            matched = rule.match(obj)
+            elapsed = time.time() - start
+
+            rule_stats = stats.get(rule, None)
+            if rule_stats is None:
+                rule_stats = stats[rule] = [0, 0, 0.0]
+            rule_stats[0] += 1
+            rule_stats[2] += elapsed
+
+            if matched:
+                rule_stats[1] += 1
+                result.update(self._rules[rule])
+
+        return result
+
     def is_empty(self):
         return not self._rules
+
+
+def _probes(rule):
+    r"""
+    Return a frozenset of probes so that the rule can only match events
+    that satisfy at least one of the probes. Return None when no such
+    set can be deduced from the rule's structure.
+
+    A probe is one of:
+      * ("value", key, value): the event contains the exact key-value pair
+      * ("key", key): the event contains at least one value for the key
+      * ("domain", key, label): the event contains a domain name value for
+        the key, and the domain name's top-level label is the given label
+
+    >>> sorted(_probes(rules.Match("a", "b")))
+    [(u'value', u'a', u'b')]
+    >>> sorted(_probes(rules.Match("a", atoms.IP("192.0.2.0/24"))))
+    [(u'key', u'a')]
+    >>> sorted(_probes(rules.Match("a", atoms.DomainName("*.example"))))
+    [(u'domain', u'a', u'example')]
+    >>> sorted(_probes(rules.Or(rules.Match("a", "b"), rules.Match("a", "c"))))
+    [(u'value', u'a', u'b'), (u'value', u'a', u'c')]
+    >>> sorted(_probes(rules.And(rules.Match("a"), rules.Match("b", "c"))))
+    [(u'value', u'b', u'c')]
+    >>> _probes(rules.No(rules.Match("a", "b"))) is None
+    True
+    >>> _probes(rules.Or(rules.Match("a", "b"), rules.Fuzzy(atoms.String("c")))) is None
+    True
+    """
+
+    if isinstance(rule, rules.Match):
+        key = rule.key
+        if not isinstance(key, atoms.String):
+            return None
+
+        value = rule.value
+        if type(rule) is rules.Match:
+            if isinstance(value, atoms.String):
+                return frozenset([(u"value", key.value, value.value)])
+            if isinstance(value, atoms.DomainName):
+                return frozenset([(u"domain", key.value, value.pattern.labels[-1])])
+        return frozenset([(u"key", key.value)])
+
+    if isinstance(rule, rules.Or):
+        result = set()
+        for subrule in rule.subrules:
+            probes = _probes(subrule)
+            if probes is None:
+                return None
+            result.update(probes)
+        return frozenset(result)
+
+    if isinstance(rule, rules.And):
+        best = None
+        for subrule in rule.subrules:
+            probes = _probes(subrule)
+            if probes is None:
+                continue
+            if best is None or _selectivity(probes) < _selectivity(best):
+                best = probes
+        return best
+
+    return None
+
+
+def _selectivity(probes):
+    # Exact value probes are the most selective, key probes the least.
+    # Prefer probe sets with stronger probes, and then smaller sets.
+    weights = {u"value": 1, u"domain": 2, u"key": 3}
+    return max(weights[probe[0]] for probe in probes), len(probes)
+
+
+class IndexedClassifier(Classifier):
+    r"""
+    A drop-in replacement for Classifier that indexes the rules by
+    exact (key, value) pairs, keys and domain name top-level labels,
+    so that each event is only matched against the rules that could
+    possibly match it.
+
+    >>> from ..events import Event
+    >>> c = IndexedClassifier()
+    >>> c.inc(rules.Match("feed", "a"), "X")
+    >>> c.inc(rules.Match("feed", "b"), "Y")
+    >>> sorted(c.classify(Event(feed="a")))
+    ['X']
+    >>> sorted(c.classify(Event(feed=["a", "b"])))
+    ['X', 'Y']
+    """
+
+    def __init__(self):
+        Classifier.__init__(self)
+
+        self._index = dict()
+        self._unindexed = set()
+        self._domain_keys = dict()
+
+    def inc(self, rule, class_id):
+        is_new = rule not in self._rules
+        Classifier.inc(self, rule, class_id)
+        if is_new:
+            self._add_to_index(rule)
+
+    def dec(self, rule, class_id):
+        Classifier.dec(self, rule, class_id)
+        if rule not in self._rules:
+            self._remove_from_index(rule)
+
+    def _add_to_index(self, rule):
+        probes = _probes(rule)
+        if probes is None:
+            self._unindexed.add(rule)
+            return
+
+        for probe in probes:
+            self._index.setdefault(probe, set()).add(rule)
+            if probe[0] == u"domain":
+                key = probe[1]
+                self._domain_keys[key] = self._domain_keys.get(key, 0) + 1
+
+    def _remove_from_index(self, rule):
+        if rule in self._unindexed:
+            self._unindexed.discard(rule)
+            return
+
+        probes = _probes(rule)
+        if probes is None:
+            return
+
+        for probe in probes:
+            indexed = self._index.get(probe, None)
+            if indexed is None or rule not in indexed:
+                continue
+
+            indexed.discard(rule)
+            if not indexed:
+                del self._index[probe]
+
+            if probe[0] == u"domain":
+                key = probe[1]
+                count = self._domain_keys.get(key, 0) - 1
+                if count > 0:
+                    self._domain_keys[key] = count
+                else:
+                    self._domain_keys.pop(key, None)
+
+    def _event_probes(self, obj, cache=None):
+        domain_keys = self._domain_keys
+
+        for key in obj.keys():
+            yield u"key", key
+
+        for key, value in obj.items():
+            yield u"value", key, value
+
+            if key in domain_keys:
+                name = atoms.parse_domain_name(value, cache)
+                if name is not None:
+                    yield u"domain", key, name[-1]
+
+    def candidates(self, obj, cache=None):
+        r"""
+        Return the set of rules that have to be matched against the given
+        object to classify it.
+        """
+
+        index = self._index
+        result = set(self._unindexed)
+        for probe in self._event_probes(obj, cache):
+            indexed = index.get(probe, None)
+            if indexed is not None:
+                result.update(indexed)
+        return result
+
+    def classify(self, obj, cache=None):
+        result = set()
+        if cache is None:
+            cache = dict()
+
+        for rule in self.candidates(obj, cache):
+            classes = self._rules[rule]
+            if result.issuperset(classes):
+                continue
+
+            if rule.match(obj, cache):
+                result.update(classes)
+
+        return result
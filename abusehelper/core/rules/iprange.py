@@ -1,5 +1,6 @@
 import re
 import math
+import bisect
 import struct
 from socket import inet_ntop, inet_pton, AF_INET, AF_INET6, error
 
@@ -234,3 +235,67 @@ class IPRange(object):
             return first_str + u"/" + unicode(repr(bits))
 
         return first_str + u"-" + unicode(self._version.format(self._last))
+
+
+class IPRangeSet(object):
+    r"""
+    An immutable collection of IP ranges that can tell in logarithmic
+    time whether any one of them fully contains a given range.
+
+    >>> ranges = IPRangeSet([
+    ...     IPRange.from_autodetected("192.0.2.0/24"),
+    ...     IPRange.from_autodetected("198.51.100.0/24"),
+    ...     IPRange.from_autodetected("2001:db8::/32")
+    ... ])
+    >>> ranges.contains(IPRange.from_autodetected("198.51.100.1"))
+    True
+    >>> ranges.contains(IPRange.from_autodetected("2001:db8::1"))
+    True
+    >>> ranges.contains(IPRange.from_autodetected("203.0.113.1"))
+    False
+
+    Like with IPRange.contains, a range must fit inside a single member
+    range. Adjacent or overlapping ranges are not merged.
+
+    >>> ranges = IPRangeSet([
+    ...     IPRange.from_autodetected("192.0.2.0/25"),
+    ...     IPRange.from_autodetected("192.0.2.128/25")
+    ... ])
+    >>> ranges.contains(IPRange.from_autodetected("192.0.2.0/24"))
+    False
+    """
+
+    def __init__(self, ranges):
+        bounds_by_version = dict()
+        for ip_range in ranges:
+            bounds = bounds_by_version.setdefault(ip_range._version, [])
+            bounds.append((ip_range._first, ip_range._last))
+
+        # For each version keep the sorted first addresses and the running
+        # maximum of the last addresses. A range [first, last] is contained
+        # in some member iff the members starting at or before first reach
+        # to at least last.
+        self._index = dict()
+        for version, bounds in bounds_by_version.iteritems():
+            bounds.sort()
+
+            firsts = []
+            max_lasts = []
+            max_last = -1
+            for first, last in bounds:
+                max_last = max(max_last, last)
+                firsts.append(first)
+                max_lasts.append(max_last)
+            self._index[version] = firsts, max_lasts
+
+    def contains(self, other):
+        if not isinstance(other, IPRange):
+            return False
+
+        index = self._index.get(other._version, None)
+        if index is None:
+            return False
+
+        firsts, max_lasts = index
+        position = bisect.bisect_right(firsts, other._first)
+        return position > 0 and max_lasts[position - 1] >= other._last
@@ -4,6 +4,7 @@ import re
 
 from . import core
 from . import atoms
+from . import iprange
 
 
 class Rule(core.Matcher):
@@ -52,8 +53,52 @@ class And(Rule):
 
 
 class Or(And):
+    def init(self, first, *rest):
+        And.init(self, first, *rest)
+
+        self._compiled = None
+
+    def _compile(self):
+        # Collect the IP range matches with the same key into one
+        # IPRangeSet, so that large sets of netblocks can be checked
+        # with one lookup instead of one match per subrule.
+        ip_matches = dict()
+        for rule in self._rules:
+            if type(rule) is not Match or not isinstance(rule.value, atoms.IP):
+                continue
+            if rule.key is not None and not isinstance(rule.key, atoms.String):
+                continue
+
+            key = None if rule.key is None else rule.key.value
+            ip_matches.setdefault(key, []).append(rule)
+
+        ip_sets = []
+        other_rules = set(self._rules)
+        for key, matches in ip_matches.iteritems():
+            if len(matches) < 2:
+                continue
+            ip_sets.append((key, iprange.IPRangeSet(rule.value.range for rule in matches)))
+            other_rules.difference_update(matches)
+
+        return ip_sets, other_rules
+
     def match_with_cache(self, obj, cache):
-        for rule in self.subrules:
+        if self._compiled is None:
+            self._compiled = self._compile()
+        ip_sets, other_rules = self._compiled
+
+        for key, ip_set in ip_sets:
+            def filter(value, ip_set=ip_set):
+                ip_range = atoms.parse_ip(value, cache)
+                return ip_range is not None and ip_set.contains(ip_range)
+
+            if key is None:
+                if obj.contains(filter=filter):
+                    return True
+            elif obj.contains(key, filter=filter):
+                return True
+
+        for rule in other_rules:
             if rule.match(obj, cache):
                 return True
         return False
@@ -137,12 +182,15 @@ class Match(Rule):
         return self._value
 
     def match_with_cache(self, event, cache):
+        def filter(value):
+            return self.filter(value, cache)
+
         if self._key is None:
-            return event.contains(filter=self.filter)
-        return event.contains(self._key.value, filter=self.filter)
+            return event.contains(filter=filter)
+        return event.contains(self._key.value, filter=filter)
 
-    def filter(self, value):
-        return self._value is None or self._value.match(value)
+    def filter(self, value, cache=None):
+        return self._value is None or self._value.match(value, cache)
 
     def dump(self):
         return (self._key, self._value)
@@ -153,8 +201,8 @@ class Match(Rule):
 
 
 class NonMatch(Match):
-    def filter(self, value):
-        return self._value is None or not self._value.match(value)
+    def filter(self, value, cache=None):
+        return self._value is None or not self._value.match(value, cache)
 
 
 class Fuzzy(Rule):
@@ -179,9 +227,12 @@ class Fuzzy(Rule):
         return Rule.__repr__(self, self._atom)
 
     def match_with_cache(self, event, cache):
-        if any(self._matcher.match(x) for x in event.keys()):
+        def filter(value):
+            return self._matcher.match(value, cache)
+
+        if any(filter(x) for x in event.keys()):
             return True
-        if event.contains(filter=self._matcher.match):
+        if event.contains(filter=filter):
             return True
         return False
 
@@ -4,6 +4,7 @@ import re
 import pickle
 import unittest
 
+from .. import atoms
 from ..atoms import String, RegExp, IP, DomainName
 
 
@@ -165,3 +166,30 @@ class TestDomainName(unittest.TestCase):
     def test_repr(self):
         for option in self._options:
             self.assertEqual(option, eval(repr(option)))
+
+
+class TestParsedValues(unittest.TestCase):
+    def tearDown(self):
+        atoms.set_value_cache_size(0)
+
+    def test_atoms_share_parse_results_through_the_cache(self):
+        cache = {}
+        self.assertTrue(IP("192.0.2.0/24").match("192.0.2.1", cache))
+        parsed = atoms.parse_ip("192.0.2.1", cache)
+        self.assertFalse(IP("198.51.100.0/24").match("192.0.2.1", cache))
+        self.assertTrue(atoms.parse_ip("192.0.2.1", cache) is parsed)
+
+        self.assertTrue(DomainName("*.example").match("domain.example", cache))
+        self.assertEqual(
+            (atoms._domainname.parse_name, "domain.example"),
+            [key for key in cache if key[1] == "domain.example"][0]
+        )
+
+    def test_hot_values_are_kept_across_classifications(self):
+        atoms.set_value_cache_size(2)
+        parsed = atoms.parse_ip("192.0.2.1")
+        self.assertTrue(atoms.parse_ip("192.0.2.1") is parsed)
+
+        atoms.parse_ip("192.0.2.2")
+        atoms.parse_ip("192.0.2.3")
+        self.assertFalse(atoms.parse_ip("192.0.2.1") is parsed)
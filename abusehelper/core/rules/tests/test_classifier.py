@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 import unittest
 from ...events import Event
 
+from .. import atoms
 from .. import rules
 from .. import classifier
 
@@ -31,3 +32,94 @@ class TestClassifier(unittest.TestCase):
         c.dec(rules.Match("a", "b"), "Y")
         self.assertEqual([], sorted(c.classify(Event(a="b"))))
         self.assertTrue(c.is_empty())
+
+
+class TestIndexedClassifier(unittest.TestCase):
+    def _classifier(self):
+        return classifier.IndexedClassifier()
+
+    def test_inc(self):
+        c = self._classifier()
+        c.inc(rules.Match("a", "b"), "X")
+        self.assertEqual(["X"], sorted(c.classify(Event(a="b"))))
+        self.assertFalse(c.is_empty())
+
+        c.inc(rules.Or(rules.Match("a", "b"), rules.Match("a", "c")), "Y")
+        self.assertEqual(["X", "Y"], sorted(c.classify(Event(a="b"))))
+        self.assertEqual(["Y"], sorted(c.classify(Event(a="c"))))
+        self.assertFalse(c.is_empty())
+
+    def test_dec(self):
+        c = self._classifier()
+        c.inc(rules.Match("a", "b"), "X")
+        c.inc(rules.Match("a", "b"), "Y")
+
+        c.dec(rules.Match("a", "b"), "X")
+        self.assertEqual(["Y"], sorted(c.classify(Event(a="b"))))
+        self.assertFalse(c.is_empty())
+
+        c.dec(rules.Match("a", "b"), "Y")
+        self.assertEqual([], sorted(c.classify(Event(a="b"))))
+        self.assertTrue(c.is_empty())
+
+    def test_only_candidate_rules_get_matched(self):
+        c = self._classifier()
+        c.inc(rules.Match("feed", "a"), "X")
+        c.inc(rules.Match("feed", "b"), "Y")
+        c.inc(rules.And(rules.Match("cc", "FI"), rules.Match("type")), "Z")
+        c.inc(rules.No(rules.Match("feed", "a")), "W")
+
+        self.assertEqual(
+            set([rules.Match("feed", "a"), rules.No(rules.Match("feed", "a"))]),
+            c.candidates(Event(feed="a", type="x")))
+        self.assertEqual(["W", "Z"], sorted(c.classify(Event(cc="FI", type="x"))))
+
+    def test_index_gets_cleaned_up(self):
+        c = self._classifier()
+        c.inc(rules.Match("a", atoms.DomainName("*.example")), "X")
+        c.inc(rules.Fuzzy(atoms.String("zzz")), "Y")
+        self.assertEqual(["X"], sorted(c.classify(Event(a="domain.example"))))
+
+        c.dec(rules.Match("a", atoms.DomainName("*.example")), "X")
+        c.dec(rules.Fuzzy(atoms.String("zzz")), "Y")
+        self.assertTrue(c.is_empty())
+        self.assertEqual(set(), c.candidates(Event(a="domain.example")))
+
+    _rules = [
+        rules.Match("a", "b"),
+        rules.Match("a", atoms.IP("192.0.2.0/24")),
+        rules.Match("a", atoms.DomainName("*.example")),
+        rules.Match("a"),
+        rules.Match(value="b"),
+        rules.NonMatch("a", "b"),
+        rules.And(rules.Match("a", "b"), rules.Match("c", "d")),
+        rules.And(rules.No(rules.Match("a", "b")), rules.Match("c")),
+        rules.Or(rules.Match("a", "b"), rules.Match("c", "d")),
+        rules.Or(rules.Match("a", "b"), rules.No(rules.Match("c", "d"))),
+        rules.Fuzzy(atoms.String("b")),
+        rules.Anything()
+    ]
+
+    _events = [
+        Event(),
+        Event(a="b"),
+        Event(a=["b", "x"]),
+        Event(a="192.0.2.1"),
+        Event(a="198.51.100.1"),
+        Event(a="sub.domain.example"),
+        Event(a="domain.test"),
+        Event(a="b", c="d"),
+        Event(c="d"),
+        Event(c="x"),
+        Event(x="b")
+    ]
+
+    def test_results_equal_unindexed_classifier(self):
+        plain = classifier.Classifier()
+        indexed = self._classifier()
+        for class_id, rule in enumerate(self._rules):
+            plain.inc(rule, class_id)
+            indexed.inc(rule, class_id)
+
+        for event in self._events:
+            self.assertEqual(plain.classify(event), indexed.classify(event))
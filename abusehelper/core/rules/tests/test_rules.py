@@ -63,8 +63,35 @@ class TestOr(unittest.TestCase):
         a = Match("a", "a")
         self.assertEqual(Or(a, a), Or(a))
 
+    def test_ip_matches_with_the_same_key(self):
+        rule = Or(
+            Match("ip", IP("192.0.2.0/24")),
+            Match("ip", IP("198.51.100.0/24")),
+            Match("ip", IP("2001:db8::/32")),
+            Match("other", IP("203.0.113.0/24")),
+            Match("a", "b")
+        )
+        self.assertTrue(rule.match(Event(ip="198.51.100.1")))
+        self.assertTrue(rule.match(Event(ip=["x", "2001:db8::1"])))
+        self.assertTrue(rule.match(Event(other="203.0.113.1")))
+        self.assertTrue(rule.match(Event(a="b")))
+        self.assertFalse(rule.match(Event(ip="203.0.113.1")))
+        self.assertFalse(rule.match(Event(ip="192.0.2.0/23")))
+        self.assertFalse(rule.match(Event(other="192.0.2.1")))
+
+    def test_ip_matches_without_key(self):
+        rule = Or(Match(None, IP("192.0.2.0/24")), Match(None, IP("198.51.100.0/24")))
+        self.assertTrue(rule.match(Event(x="198.51.100.1")))
+        self.assertFalse(rule.match(Event(x="203.0.113.1")))
+
+    def test_ip_non_matches_are_not_combined(self):
+        rule = Or(NonMatch("ip", IP("192.0.2.0/24")), NonMatch("ip", IP("198.51.100.0/24")))
+        self.assertTrue(rule.match(Event(ip="192.0.2.1")))
+        self.assertFalse(rule.match(Event()))
+
     _options = [
-        Or(Match("a"), Match("b"))
+        Or(Match("a"), Match("b")),
+        Or(Match("ip", IP("192.0.2.0/24")), Match("ip", IP("198.51.100.0/24")))
     ]
 
     def test_pickling_and_unpickling(self):
@@ -0,0 +1,151 @@
+"""
+Single-producer/single-consumer rings of shared memory for passing
+messages between processes without copying them through the kernel.
+
+The ring only manages the shared memory. The producer has to tell the
+consumer where each written message is (e.g. over a socket), and the
+consumer has to tell the producer how many messages it has consumed.
+These notifications double as the wakeups and memory barriers between
+the processes. Messages are consumed in the order they were written.
+"""
+
+import os
+import mmap
+import errno
+import tempfile
+import collections
+
+
+def _shm_dir():
+    # Prefer a memory-backed filesystem when one is available.
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return None
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+
+class RingWriter(object):
+    """
+    The producer end of a ring. Creates the shared memory that the
+    consumer then maps by opening RingReader(writer.path).
+
+    >>> writer = RingWriter(16)
+    >>> reader = RingReader(writer.path)
+    >>> offset = writer.write("abc")
+    >>> str(reader.read(offset, 3))
+    'abc'
+
+    Writing returns None when the ring doesn't have enough free space.
+    Releasing consumed messages frees their space.
+
+    >>> writer.write("x" * 16) is None
+    True
+    >>> writer.release(1)
+    >>> writer.write("x" * 16)
+    0
+
+    >>> reader.close()
+    >>> writer.close()
+    """
+
+    def __init__(self, size):
+        fd, path = tempfile.mkstemp(prefix="abusehelper-ring-", dir=_shm_dir())
+        try:
+            os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        except:
+            os.close(fd)
+            _unlink(path)
+            raise
+        os.close(fd)
+
+        self._path = path
+        self._size = size
+
+        # Monotonically increasing write and release positions, and the
+        # end positions of the written but not yet released messages.
+        self._head = 0
+        self._tail = 0
+        self._ends = collections.deque()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def size(self):
+        return self._size
+
+    def write(self, data):
+        """
+        Copy the data to the ring as one contiguous message and return its
+        offset. Return None if there is not enough free space.
+        """
+
+        length = len(data)
+
+        if not self._ends:
+            # The ring is empty, so start again from the beginning.
+            self._head = 0
+            self._tail = 0
+
+        start = self._head % self._size
+        padding = 0
+        if start + length > self._size:
+            # Skip the end of the buffer to keep the message contiguous.
+            padding = self._size - start
+            start = 0
+
+        if self._head + padding + length - self._tail > self._size:
+            return None
+
+        self._mmap[start:start + length] = data
+        self._head += padding + length
+        self._ends.append(self._head)
+        return start
+
+    def release(self, count):
+        """
+        Free the space of the given number of oldest consumed messages.
+        """
+
+        for _ in xrange(count):
+            self._tail = self._ends.popleft()
+
+    def close(self):
+        self._mmap.close()
+        _unlink(self._path)
+
+
+class RingReader(object):
+    """
+    The consumer end of a ring. The file backing the shared memory gets
+    removed once it has been mapped, as both ends then have their own
+    mapping.
+    """
+
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDWR)
+        try:
+            self._mmap = mmap.mmap(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+        _unlink(path)
+
+    def read(self, offset, length):
+        """
+        Return a read-only buffer that refers to a message in the shared
+        memory without copying it.
+        """
+
+        return buffer(self._mmap, offset, length)
+
+    def close(self):
+        self._mmap.close()
@@ -0,0 +1,355 @@
+import os
+import unittest
+import tempfile
+
+import idiokit
+from idiokit import dns
+
+from .. import utils, cymruwhois
+
+
+class _Cancel(Exception):
+    pass
+
+
+class _FakeDNS(object):
+    """
+    A stand-in for the idiokit.dns module whose TXT queries get answered
+    only when the test says so.
+    """
+
+    DNSError = dns.DNSError
+
+    def __init__(self):
+        self.queries = []
+
+    def txt(self, name, resolver=None):
+        answer = idiokit.Event()
+        self.queries.append((name, answer))
+        return answer
+
+
+@idiokit.stream
+def _spin(rounds=10):
+    # Give the other running streams a chance to proceed.
+    for _ in xrange(rounds):
+        yield idiokit.sleep(0.0)
+
+
+@idiokit.stream
+def _collect():
+    results = []
+    while True:
+        try:
+            item = yield idiokit.next()
+        except StopIteration:
+            idiokit.stop(results)
+        else:
+            results.append(item)
+
+
+class TestLimiter(unittest.TestCase):
+    def _acquirer(self, limiter, name, log):
+        @idiokit.stream
+        def _acquire():
+            try:
+                yield limiter.acquire()
+            except _Cancel:
+                log.append("cancelled " + name)
+            else:
+                log.append(name)
+        return _acquire()
+
+    def test_running_operations_are_capped(self):
+        limiter = cymruwhois._Limiter(2)
+        log = []
+
+        @idiokit.stream
+        def test():
+            for name in ["a", "b", "c"]:
+                self._acquirer(limiter, name, log)
+                yield _spin()
+
+            self.assertEqual(["a", "b"], log)
+            self.assertEqual(2, limiter.running)
+            self.assertEqual(1, limiter.waiting)
+
+            limiter.release()
+            yield _spin()
+            self.assertEqual(["a", "b", "c"], log)
+            self.assertEqual(2, limiter.running)
+            self.assertEqual(0, limiter.waiting)
+            self.assertEqual(2, limiter.peak)
+        idiokit.main_loop(test())
+
+    def test_turns_are_handed_off_in_fifo_order(self):
+        limiter = cymruwhois._Limiter(1)
+        log = []
+
+        @idiokit.stream
+        def test():
+            for name in ["a", "b", "c", "d"]:
+                self._acquirer(limiter, name, log)
+                yield _spin()
+            self.assertEqual(["a"], log)
+
+            for expected in [["a", "b"], ["a", "b", "c"], ["a", "b", "c", "d"]]:
+                limiter.release()
+                yield _spin()
+                self.assertEqual(expected, log)
+                self.assertEqual(1, limiter.running)
+        idiokit.main_loop(test())
+
+    def test_cancelled_waiters_lose_their_turn(self):
+        limiter = cymruwhois._Limiter(1)
+        log = []
+
+        @idiokit.stream
+        def test():
+            self._acquirer(limiter, "a", log)
+            yield _spin()
+            waiter = self._acquirer(limiter, "b", log)
+            yield _spin()
+            self._acquirer(limiter, "c", log)
+            yield _spin()
+
+            waiter.throw(_Cancel())
+            yield _spin()
+            self.assertEqual(["a", "cancelled b"], log)
+            self.assertEqual(1, limiter.waiting)
+
+            limiter.release()
+            yield _spin()
+            self.assertEqual(["a", "cancelled b", "c"], log)
+            self.assertEqual(1, limiter.running)
+            self.assertEqual(0, limiter.waiting)
+        idiokit.main_loop(test())
+
+
+class TestCoalescedLookups(unittest.TestCase):
+    def setUp(self):
+        self._original_dns = cymruwhois.dns
+        self.dns = cymruwhois.dns = _FakeDNS()
+
+    def tearDown(self):
+        cymruwhois.dns = self._original_dns
+
+    def test_concurrent_lookups_share_one_query(self):
+        lookup = cymruwhois.ASNameLookup()
+
+        @idiokit.stream
+        def test():
+            first = lookup.lookup(64496)
+            second = lookup.lookup("64496")
+            yield _spin()
+
+            self.assertEqual(1, len(self.dns.queries))
+            name, answer = self.dns.queries[0]
+            self.assertEqual("AS64496.asn.cymru.com", name)
+            answer.succeed([("64496 | ZZ | test | 2000-01-01 | EXAMPLE",)])
+
+            first_results = yield first
+            second_results = yield second
+            self.assertEqual(first_results, second_results)
+            self.assertEqual(
+                {"as allocated": u"2000-01-01", "as name": u"EXAMPLE"},
+                dict(first_results[0]))
+            self.assertEqual(1, lookup.misses)
+            self.assertEqual(1, lookup.coalesced)
+
+            # The answer is cached from now on.
+            third_results = yield lookup.lookup(64496)
+            self.assertEqual(first_results, third_results)
+            self.assertEqual(1, len(self.dns.queries))
+            self.assertEqual(1, lookup.hits)
+        idiokit.main_loop(test())
+
+    def test_concurrent_lookups_share_one_failure(self):
+        lookup = cymruwhois.ASNameLookup(catch_error=False)
+        failures = []
+
+        @idiokit.stream
+        def _lookup():
+            try:
+                yield lookup.lookup(64496)
+            except dns.DNSError:
+                failures.append(True)
+
+        @idiokit.stream
+        def test():
+            first = _lookup()
+            second = _lookup()
+            yield _spin()
+
+            self.assertEqual(1, len(self.dns.queries))
+            _, answer = self.dns.queries[0]
+            answer.fail(dns.DNSError, dns.DNSError("failed"), None)
+
+            yield first
+            yield second
+            self.assertEqual([True, True], failures)
+
+            # Failures are not cached.
+            lookup.lookup(64496)
+            yield _spin()
+            self.assertEqual(2, len(self.dns.queries))
+        idiokit.main_loop(test())
+
+
+class TestPrefixCaching(unittest.TestCase):
+    def setUp(self):
+        self._original_dns = cymruwhois.dns
+        self.dns = cymruwhois.dns = _FakeDNS()
+
+    def tearDown(self):
+        cymruwhois.dns = self._original_dns
+
+    def _lookup(self, lookup, ip, *answers):
+        @idiokit.stream
+        def _run():
+            count = len(self.dns.queries)
+            results = lookup.lookup(ip)
+            yield _spin()
+
+            for _, answer in self.dns.queries[count:]:
+                answer.succeed([(x,) for x in answers])
+            results = yield results
+            idiokit.stop(results)
+        return idiokit.main_loop(_run())
+
+    def test_answers_agreeing_on_a_prefix_get_cached_by_prefix(self):
+        lookup = cymruwhois.OriginLookup()
+        self._lookup(lookup, "192.0.2.1", "64496 64497 | 192.0.2.0/24 | ZZ | test | 2000-01-01")
+
+        results = self._lookup(lookup, "192.0.2.2")
+        self.assertEqual(1, len(self.dns.queries))
+        self.assertEqual(1, lookup.prefix_hits)
+        self.assertEqual(set(["64496", "64497"]), set(dict(x)["asn"] for x in results))
+
+    def test_answers_with_different_prefixes_are_not_cached_by_prefix(self):
+        lookup = cymruwhois.OriginLookup()
+        self._lookup(
+            lookup, "192.0.2.1",
+            "64496 | 192.0.2.0/24 | ZZ | test | 2000-01-01",
+            "64497 | 192.0.2.0/25 | ZZ | test | 2000-01-01")
+
+        self._lookup(lookup, "192.0.2.2")
+        self.assertEqual(2, len(self.dns.queries))
+        self.assertEqual(0, lookup.prefix_hits)
+
+    def test_prefixes_not_containing_the_ip_are_not_cached(self):
+        lookup = cymruwhois.OriginLookup()
+        self._lookup(lookup, "192.0.2.1", "64496 | 198.51.100.0/24 | ZZ | test | 2000-01-01")
+
+        self._lookup(lookup, "198.51.100.1")
+        self.assertEqual(2, len(self.dns.queries))
+        self.assertEqual(0, lookup.prefix_hits)
+
+    def test_ipv6_answers_get_cached_by_prefix(self):
+        lookup = cymruwhois.OriginLookup()
+        self._lookup(lookup, "2001:db8::1", "64496 | 2001:db8::/32 | ZZ | test | 2000-01-01")
+
+        results = self._lookup(lookup, "2001:db8:1::1")
+        self.assertEqual(1, len(self.dns.queries))
+        self.assertEqual(1, lookup.prefix_hits)
+        self.assertEqual(u"2001:db8::/32", dict(results[0])["bgp prefix"])
+
+    def test_prefix_caching_can_be_disabled(self):
+        lookup = cymruwhois.OriginLookup(prefix_cache=False)
+        self._lookup(lookup, "192.0.2.1", "64496 | 192.0.2.0/24 | ZZ | test | 2000-01-01")
+
+        self._lookup(lookup, "192.0.2.2")
+        self.assertEqual(2, len(self.dns.queries))
+        self.assertEqual(0, lookup.prefix_hits)
+
+
+class TestPersistentCaching(unittest.TestCase):
+    def setUp(self):
+        self._original_dns = cymruwhois.dns
+        self.dns = cymruwhois.dns = _FakeDNS()
+
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        cymruwhois.dns = self._original_dns
+
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_answers_from_disk_get_cached_in_memory(self):
+        results = ((("as name", u"EXAMPLE"),),)
+
+        cache = utils.PersistentCache(self.path, "test", 60.0)
+        cache.set(64496, results)
+        cache.close()
+
+        cache = utils.PersistentCache(self.path, "test", 60.0)
+        lookup = cymruwhois.ASNameLookup(persistent_cache=cache)
+
+        @idiokit.stream
+        def test():
+            answer = yield lookup.lookup(64496)
+            self.assertEqual(results, answer)
+        idiokit.main_loop(test())
+
+        self.assertEqual([], self.dns.queries)
+        self.assertEqual(1, lookup.cache_stats()["size"])
+        cache.close()
+
+    def test_closing_writes_the_buffered_answers(self):
+        first = cymruwhois.CymruWhois(cache_file=self.path)
+
+        @idiokit.stream
+        def test():
+            result = first.lookup("192.0.2.1")
+            yield _spin()
+            self.dns.queries[-1][1].succeed([("64496 | 192.0.2.0/24 | ZZ | test | 2000-01-01",)])
+            yield _spin()
+            self.dns.queries[-1][1].succeed([("64496 | ZZ | test | 2000-01-01 | EXAMPLE",)])
+            result = yield result
+            idiokit.stop(result)
+        result = idiokit.main_loop(test())
+        first.close()
+        self.assertEqual(2, len(self.dns.queries))
+
+        second = cymruwhois.CymruWhois(cache_file=self.path)
+        self.assertEqual(result, idiokit.main_loop(second.lookup("192.0.2.1")))
+        self.assertEqual(2, len(self.dns.queries))
+        second.close()
+
+
+class TestWindow(unittest.TestCase):
+    def test_reordering_is_bounded_and_closing_drains(self):
+        window = cymruwhois._Window(2)
+        acquired = []
+
+        @idiokit.stream
+        def feed():
+            try:
+                for name in ["a", "b", "c"]:
+                    yield window.acquire()
+                    acquired.append(name)
+            finally:
+                window.close()
+
+        @idiokit.stream
+        def test():
+            output = idiokit.pipe(window.output(), _collect())
+            feed()
+            yield _spin()
+
+            # Only two items fit the window until one of them completes.
+            self.assertEqual(["a", "b"], acquired)
+            window.complete("b")
+            yield _spin()
+            self.assertEqual(["a", "b", "c"], acquired)
+
+            # The window has been closed, but the output keeps going
+            # until the items still in progress complete.
+            window.complete("c")
+            window.complete("a")
+            results = yield output
+            self.assertEqual(["b", "c", "a"], results)
+        idiokit.main_loop(test())
@@ -1,3 +1,4 @@
+import hashlib
 import pickle
 import unittest
 
@@ -8,3 +9,173 @@ class TestEvent(unittest.TestCase):
     def test_pickling(self):
         e = events.Event({"a": "b"})
         self.assertEqual(e, pickle.loads(pickle.dumps(e)))
+
+    def test_union_shares_unchanged_values(self):
+        original = events.Event({"a": "b", "x": "y"})
+        union = original.union(a="c")
+
+        self.assertTrue(union._attrs[u"x"] is original._attrs[u"x"])
+        self.assertEqual(events.Event({"a": ["b", "c"], "x": "y"}), union)
+        self.assertEqual(events.Event({"a": "b", "x": "y"}), original)
+
+    def test_modifications_do_not_leak_to_shared_values(self):
+        original = events.Event({"a": ["b", "c"]})
+        copy = events.Event(original)
+        copy.add("a", "d")
+        copy.discard("a", "b")
+        original.add("a", "e")
+
+        self.assertEqual(events.Event({"a": ["c", "d"]}), copy)
+        self.assertEqual(events.Event({"a": ["b", "c", "e"]}), original)
+
+    def test_hexdigest_and_pickling_ignore_sharing(self):
+        original = events.Event({"a": "b"})
+        shared = original.union()
+
+        self.assertEqual(events.hexdigest(events.Event({"a": "b"})), events.hexdigest(shared))
+        self.assertEqual(shared, pickle.loads(pickle.dumps(shared)))
+        self.assertEqual(original, original.difference(a="x"))
+
+    def test_compact_elements_keep_non_xml_characters(self):
+        event = events.Event({u"\uffff": [u"\x05", u"b"]})
+        element = events.Element("message")
+        element.add(event.to_elements(compact=True))
+        self.assertEqual([event], list(events.Event.from_elements(element)))
+
+    def test_body_truncation(self):
+        event = events.Event(a="b" * 100)
+        bodies = event.to_elements(max_body_length=10).named("body")
+        self.assertEqual([u"a=bbbbb..."], [body.text for body in bodies])
+
+        bodies = event.to_elements(max_body_length=1000).named("body")
+        self.assertEqual([u"a=" + u"b" * 100], [body.text for body in bodies])
+
+    def test_body_truncation_never_exceeds_the_limit(self):
+        event = events.Event(a="b" * 100)
+        batch = events.EventBatch(["a"], [["b" * 100]])
+
+        for max_body_length in [1, 2, 3, 4]:
+            bodies = event.to_elements(max_body_length=max_body_length).named("body")
+            self.assertEqual([max_body_length], [len(body.text) for body in bodies])
+
+            [elements] = batch.to_elements(max_body_length=max_body_length)
+            self.assertEqual([max_body_length], [len(body.text) for body in elements.named("body")])
+
+    def test_from_elements_skips_incomplete_attributes(self):
+        event_element = events.Element("event", xmlns=events.EVENT_NS)
+        event_element.add(events.Element("attr", key="a", value="b"))
+        event_element.add(events.Element("attr", key="a", value="c"))
+        event_element.add(events.Element("attr", key="x"))
+        event_element.add(events.Element("attr", value="y"))
+
+        message = events.Element("message")
+        message.add(event_element)
+        self.assertEqual(
+            [events.Event({"a": ["b", "c"]})],
+            list(events.Event.from_elements(message))
+        )
+
+    def test_hexdigest_is_recomputed_after_modifications(self):
+        event = events.Event(a="b")
+        events.hexdigest(event)
+        md5 = events.hexdigest(event, hashlib.md5)
+
+        for modify in [
+            lambda: event.add("c", "d"),
+            lambda: event.update("e", ["f"]),
+            lambda: event.discard("c", "d"),
+            lambda: event.pop("e"),
+            lambda: event.clear("a")
+        ]:
+            before = events.hexdigest(event)
+            modify()
+            self.assertEqual(events.hexdigest(events.Event(event)), events.hexdigest(event))
+            self.assertNotEqual(before, events.hexdigest(event))
+        self.assertNotEqual(md5, events.hexdigest(event, hashlib.md5))
+
+    def test_interning_is_bounded(self):
+        events.set_interning(max_keys=2, max_values=2, max_value_length=5)
+        try:
+            first = pickle.loads(pickle.dumps(events.Event({"a": ["b", "long value"], "c": "d"})))
+            second = events.Event({"a": ["b", "long value"], "c": "d", "e": "f"})
+            self.assertEqual(first, pickle.loads(pickle.dumps(first)))
+
+            self.assertTrue(first.values("a", filter=lambda x: x == "b")[0] is second.values("a", filter=lambda x: x == "b")[0])
+            self.assertFalse(
+                first.values("a", filter=lambda x: x == "long value")[0] is
+                second.values("a", filter=lambda x: x == "long value")[0]
+            )
+
+            stats = events.interning_stats()
+            self.assertEqual(2, stats["keys"])
+            self.assertEqual(2, stats["values"])
+            self.assertTrue(stats["saved bytes"] > 0)
+        finally:
+            events.set_interning()
+
+    def test_unicode_lines_roundtrip(self):
+        original = [
+            events.Event({u"a\"\\": [u"x, \"\\y", u"", u" "], u"": u"="}),
+            events.Event(a="b")
+        ]
+        lines = list(events.format_unicode_lines(original))
+        self.assertEqual(original, list(events.parse_unicode_lines(lines)))
+
+    def test_from_unicode_errors(self):
+        self.assertRaises(ValueError, events.Event.from_unicode, u"a=b,")
+        self.assertRaises(ValueError, events.Event.from_unicode, u"a=\"b\"c")
+        self.assertRaises(ValueError, events.Event.from_unicode, u"a")
+
+
+class TestEventBatch(unittest.TestCase):
+    def _batch(self):
+        batch = events.EventBatch([u"a", u"b\x00", u"c"])
+        batch.append([u"x", u"y", None])
+        batch.append([u"z\x00", None, u"\"long value\""])
+        batch.append([None, None, None])
+        return batch
+
+    def test_to_elements_matches_events(self):
+        batch = self._batch()
+        for compact in [False, True]:
+            element = events.Element("message")
+            for elements in batch.to_elements(compact=compact, max_body_length=10):
+                element.add(elements)
+
+            expected = events.Element("message")
+            for event in batch:
+                expected.add(event.to_elements(compact=compact, max_body_length=10))
+
+            self.assertEqual(
+                list(events.Event.from_elements(expected)),
+                list(events.Event.from_elements(element)))
+            self.assertEqual(
+                sorted(len(body.text) for body in expected.children("body")),
+                sorted(len(body.text) for body in element.children("body")))
+
+    def test_duplicate_keys_merge_values(self):
+        batch = events.EventBatch(["a", "a"], [["x", "x"], ["x", "y"]])
+        self.assertEqual([events.Event(a="x"), events.Event(a=["x", "y"])], list(batch))
+        self.assertEqual([events.hexdigest(event) for event in batch], batch.hexdigests())
+
+        element = events.Element("message")
+        for elements in batch.to_elements(include_body=False):
+            element.add(elements)
+        self.assertEqual(list(batch), list(events.Event.from_elements(element)))
+
+    def test_select_shares_keys(self):
+        batch = self._batch()
+        selected = batch.select([2, 0])
+        self.assertEqual(batch.keys, selected.keys)
+        self.assertEqual([batch.rows[2], batch.rows[0]], list(selected.rows))
+        self.assertEqual([(u"x",), ()], selected.column_values("a")[::-1])
+
+    def test_fingerprints_match_md5_hexdigests(self):
+        for batch in [
+            events.EventBatch(["b", "a", "c"], [["x", u"\xe4", None], [None, None, None]]),
+            events.EventBatch(["a", "b", "a"], [["y", "x", "y"], ["z", None, "y"]])
+        ]:
+            expected = [int(events.hexdigest(event, hashlib.md5), 16) >> 64 for event in batch]
+            self.assertEqual(expected, batch.fingerprints())
+            self.assertEqual(expected, events.fingerprints(list(batch)))
+            self.assertEqual([events.hexdigest(event, hashlib.md5) for event in batch], batch.hexdigests(hashlib.md5))
@@ -0,0 +1,240 @@
+import socket
+import unittest
+
+from .. import events, rules, roomgraph, shmring
+
+
+class TestCompactWireFormat(unittest.TestCase):
+    def _roundtrip(self, encoder, decoder, obj):
+        return decoder.decode(encoder.encode(obj))
+
+    def test_event_roundtrip(self):
+        encoder = roomgraph.CompactWireFormat()
+        decoder = roomgraph.CompactWireFormat()
+
+        event = events.Event({
+            u"a": [u"b", u"c"],
+            u"\xe4": u"\x00\uffff",
+            u"empty": u""
+        })
+        self.assertEqual(
+            ("event", (u"room", event)),
+            self._roundtrip(encoder, decoder, ("event", (u"room", event))))
+
+    def test_result_roundtrip(self):
+        encoder = roomgraph.CompactWireFormat()
+        decoder = roomgraph.CompactWireFormat()
+
+        event = events.Event(a="b")
+        obj = (u"src", event, set([u"x", u"y"]))
+        self.assertEqual(obj, self._roundtrip(encoder, decoder, obj))
+        self.assertEqual(obj, self._roundtrip(encoder, decoder, obj))
+
+    def test_other_messages_get_pickled(self):
+        encoder = roomgraph.CompactWireFormat()
+        decoder = roomgraph.CompactWireFormat()
+
+        obj = ("inc_rule", (u"src", rules.Match("a", "b"), u"dst"))
+        self.assertEqual(obj, self._roundtrip(encoder, decoder, obj))
+
+    def test_interned_keys_and_rooms_are_sent_only_once(self):
+        encoder = roomgraph.CompactWireFormat()
+
+        msg = ("event", (u"room", events.Event({u"long key " * 10: u"value"})))
+        first = encoder.encode(msg)
+        second = encoder.encode(msg)
+        self.assertTrue(len(second) < len(first))
+
+    def test_intern_tables_get_reset_when_full(self):
+        encoder = roomgraph.CompactWireFormat(max_keys=2, max_rooms=2)
+        decoder = roomgraph.CompactWireFormat()
+
+        for index in range(10):
+            event = events.Event({
+                u"key " + unicode(index): u"a",
+                u"other " + unicode(index % 3): u"b"
+            })
+            obj = ("result", (u"src " + unicode(index % 4), event, set([u"dst"])))
+            self.assertEqual(obj, self._roundtrip(encoder, decoder, obj))
+
+
+class TestPickleWireFormat(unittest.TestCase):
+    def test_roundtrip(self):
+        wire = roomgraph.PickleWireFormat()
+
+        obj = ("result", (u"src", events.Event(a="b"), set([u"dst"])))
+        self.assertEqual(obj, wire.decode(wire.encode(obj)))
+
+
+class TestBatches(unittest.TestCase):
+    def test_batch_roundtrip(self):
+        encoder = roomgraph.CompactWireFormat()
+        decoder = roomgraph.CompactWireFormat()
+
+        objs = [
+            ("inc_rule", (u"src", rules.Match("a", "b"), u"dst")),
+            ("event", (u"src", events.Event(a="b"))),
+            ("event", (u"src", events.Event(a="c")))
+        ]
+        self.assertEqual(objs, roomgraph.decode_batch(decoder, roomgraph.encode_batch(encoder, objs)))
+
+    def test_worker_returns_results_in_batches(self):
+        parent, worker = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            wire = roomgraph.CompactWireFormat()
+            roomgraph.send_events(parent, [
+                ("inc_rule", (u"src", rules.Match("a", "b"), u"dst")),
+                ("event", (u"src", events.Event(a="b"))),
+                ("event", (u"src", events.Event(a="c"))),
+                ("event", (u"src", events.Event(a="b", x="y")))
+            ], wire)
+            parent.shutdown(socket.SHUT_WR)
+
+            self.assertRaises(roomgraph._ConnectionLost, roomgraph.roomgraph, worker)
+
+            self.assertEqual(([
+                ("result", (u"src", events.Event(a="b"), set([u"dst"]))),
+                ("result", (u"src", events.Event(a="b", x="y"), set([u"dst"])))
+            ], 0), roomgraph.recv_results(parent, wire))
+        finally:
+            parent.close()
+            worker.close()
+
+    def test_worker_reports_match_cache_stats(self):
+        parent, worker = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            wire = roomgraph.CompactWireFormat()
+            roomgraph.send_events(parent, [
+                ("inc_rule", (u"a", rules.Match("x", "y"), u"dst")),
+                ("inc_rule", (u"b", rules.Match("x", "y"), u"dst")),
+                ("event", (u"a", events.Event(x="y"))),
+                ("event", (u"b", events.Event(x="y")))
+            ], wire)
+            parent.shutdown(socket.SHUT_WR)
+
+            self.assertRaises(
+                roomgraph._ConnectionLost,
+                roomgraph.roomgraph, worker, match_cache_size=16, stats_interval=0.0
+            )
+
+            self.assertEqual(([
+                ("result", (u"a", events.Event(x="y"), set([u"dst"]))),
+                ("result", (u"b", events.Event(x="y"), set([u"dst"]))),
+                ("match_cache", (1, 1))
+            ], 0), roomgraph.recv_results(parent, wire))
+        finally:
+            parent.close()
+            worker.close()
+
+    def test_worker_reports_sampled_rule_stats(self):
+        parent, worker = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            wire = roomgraph.CompactWireFormat()
+            roomgraph.send_events(parent, [
+                ("inc_rule", (u"src", rules.Match("x", "y"), u"dst")),
+                ("event", (u"src", events.Event(x="y"))),
+                ("event", (u"src", events.Event(x="z")))
+            ], wire)
+            parent.shutdown(socket.SHUT_WR)
+
+            self.assertRaises(
+                roomgraph._ConnectionLost,
+                roomgraph.roomgraph, worker, rule_sample_rate=1.0, stats_interval=0.0
+            )
+
+            results, _ = roomgraph.recv_results(parent, wire)
+            self.assertEqual(("result", (u"src", events.Event(x="y"), set([u"dst"]))), results[0])
+
+            type_id, sampled = results[1]
+            self.assertEqual("rule_stats", type_id)
+            [(src, rule, calls, matches, seconds)] = sampled
+            self.assertEqual((u"src", rules.Match("x", "y"), 1, 1), (src, rule, calls, matches))
+        finally:
+            parent.close()
+            worker.close()
+
+    def test_worker_releases_shared_memory_batches(self):
+        ring_writer = shmring.RingWriter(4096)
+        ring_reader = shmring.RingReader(ring_writer.path)
+
+        parent, worker = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            wire = roomgraph.CompactWireFormat()
+            roomgraph.send_events(parent, [
+                ("inc_rule", (u"src", rules.Match("a", "b"), u"dst"))
+            ], wire, ring_writer)
+            roomgraph.send_events(parent, [
+                ("event", (u"src", events.Event(a="b")))
+            ], wire, ring_writer)
+            parent.shutdown(socket.SHUT_WR)
+
+            self.assertRaises(roomgraph._ConnectionLost, roomgraph.roomgraph, worker, ring=ring_reader)
+
+            self.assertEqual(([], 1), roomgraph.recv_results(parent, wire))
+            self.assertEqual(([
+                ("result", (u"src", events.Event(a="b"), set([u"dst"])))
+            ], 1), roomgraph.recv_results(parent, wire))
+        finally:
+            parent.close()
+            worker.close()
+            ring_reader.close()
+            ring_writer.close()
+
+    def test_worker_reports_whether_it_could_map_the_ring(self):
+        ring_writer = shmring.RingWriter(4096)
+
+        parent, worker = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            ring_reader = roomgraph.open_ring(worker, ring_writer.path)
+            self.assertNotEqual(None, ring_reader)
+            ring_reader.close()
+            self.assertEqual(roomgraph._FRAME_MAPPED, roomgraph._recv_frame_blocking(parent))
+
+            # The path is gone after the first worker has mapped it.
+            self.assertEqual(None, roomgraph.open_ring(worker, ring_writer.path))
+            self.assertEqual(roomgraph._FRAME_INLINE, roomgraph._recv_frame_blocking(parent))
+        finally:
+            parent.close()
+            worker.close()
+            ring_writer.close()
+
+
+class TestHashRing(unittest.TestCase):
+    def test_keys_get_spread_over_nodes(self):
+        ring = roomgraph.HashRing(range(4))
+
+        counts = dict()
+        for index in range(4000):
+            node = ring.get(u"room{0}".format(index))
+            counts[node] = counts.get(node, 0) + 1
+
+        self.assertEqual(sorted(counts), range(4))
+        self.assertTrue(min(counts.values()) > 500)
+
+    def test_adding_a_node_remaps_only_some_keys(self):
+        old = roomgraph.HashRing(range(4))
+        new = roomgraph.HashRing(range(5))
+
+        keys = [u"room{0}".format(index) for index in range(4000)]
+        moved = [key for key in keys if old.get(key) != new.get(key)]
+        self.assertTrue(len(moved) < len(keys) / 2)
+        for key in moved:
+            self.assertEqual(4, new.get(key))
+
+
+class TestRouting(unittest.TestCase):
+    def test_route_by_room(self):
+        route = roomgraph.route_by_room(["a", "b", "c"])
+
+        target = route(("inc_rule", (u"src", rules.Match("a", "b"), u"dst")))
+        self.assertEqual(target, route(("event", (u"src", events.Event(a="b")))))
+        self.assertEqual(target, route(("dec_rule", (u"src", rules.Match("a", "b"), u"dst"))))
+
+    def test_route_by_key(self):
+        route = roomgraph.route_by_key(["a", "b", "c"], "ip")
+
+        self.assertEqual(None, route(("inc_rule", (u"src", rules.Match("a", "b"), u"dst"))))
+        self.assertEqual(None, route(("event", (u"src", events.Event(a="b")))))
+        self.assertEqual(
+            route(("event", (u"x", events.Event(ip="192.0.2.1")))),
+            route(("event", (u"y", events.Event(ip="192.0.2.1", a="b")))))
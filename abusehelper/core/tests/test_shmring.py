@@ -0,0 +1,38 @@
+import os
+import unittest
+
+from .. import shmring
+
+
+class TestRing(unittest.TestCase):
+    def setUp(self):
+        self.writer = shmring.RingWriter(16)
+        self.reader = shmring.RingReader(self.writer.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+
+    def test_reader_removes_the_file(self):
+        self.assertFalse(os.path.exists(self.writer.path))
+
+    def test_messages_wrap_around_contiguously(self):
+        first = self.writer.write("a" * 6)
+        second = self.writer.write("b" * 6)
+        self.writer.release(1)
+
+        # The message doesn't fit in the 4 bytes left at the end of the ring.
+        third = self.writer.write("c" * 6)
+        self.assertEqual(0, third)
+        self.assertEqual("b" * 6, str(self.reader.read(second, 6)))
+        self.assertEqual("c" * 6, str(self.reader.read(third, 6)))
+        self.assertNotEqual(first, second)
+
+    def test_write_fails_until_space_is_released(self):
+        self.writer.write("a" * 6)
+        self.writer.write("b" * 6)
+        self.assertEqual(None, self.writer.write("c" * 6))
+
+        self.writer.release(1)
+        self.assertEqual(0, self.writer.write("c" * 6))
+        self.assertEqual(None, self.writer.write("d" * 6))
@@ -1,5 +1,8 @@
+import os
 import sys
+import time
 import socket
+import calendar
 import pickle
 import urllib2
 import unittest
@@ -237,3 +240,204 @@ class TestCompressedCollection(unittest.TestCase):
 
         original.append("cd")
         self.assertEqual(["ab", "cd"], list(original))
+
+
+@idiokit.stream
+def _collect():
+    results = []
+    while True:
+        try:
+            item = yield idiokit.next()
+        except StopIteration:
+            idiokit.stop(results)
+        else:
+            results.append(item)
+
+
+class TestCsvToEventBatches(unittest.TestCase):
+    def test_batches_match_csv_to_events(self):
+        lines = ["a,b,c", "1,2,3", "4,,6", "7", "8,9,10,11"]
+
+        expected = idiokit.main_loop(utils.csv_to_events(lines, columns=None) | _collect())
+        batches = idiokit.main_loop(utils.csv_to_event_batches(lines, batch_size=3) | _collect())
+
+        self.assertEqual([3, 1], [len(batch) for batch in batches])
+        self.assertEqual(expected, [event for batch in batches for event in batch])
+
+    def test_none_columns_are_skipped(self):
+        lines = ["1|2|3"]
+        batches = idiokit.main_loop(utils.csv_to_event_batches(lines, delimiter="|", columns=[None, "b", "c"]) | _collect())
+        self.assertEqual([(u"b", u"c")], [batch.keys for batch in batches])
+
+
+class TestTimeParser(unittest.TestCase):
+    def test_results_match_strptime(self):
+        parser = utils.TimeParser("%Y-%m-%d %H:%M:%SZ", cache_size=4)
+        for string in [
+            "2016-02-29 23:59:61Z",
+            "2017-2-3 4:05:06Z",
+            "2017-02-03 04:05:06z",
+            "2017-02-29 00:00:00Z",
+            "2017-13-01 00:00:00Z",
+            "0000-01-01 00:00:00Z",
+            "2017-01-01 24:00:00Z",
+            "2017-01-01 00:00:00"
+        ]:
+            for _ in range(2):
+                try:
+                    expected = calendar.timegm(time.strptime(string, "%Y-%m-%d %H:%M:%SZ"))
+                except ValueError:
+                    self.assertRaises(ValueError, parser.parse, string)
+                else:
+                    self.assertEqual(expected, parser.parse(string))
+
+
+class TestFingerprintSet(unittest.TestCase):
+    def test_items_can_be_added_after_unpickling(self):
+        original = utils.FingerprintSet([2 ** 64 - 1, 0])
+        original.add(2 ** 32)
+
+        unpickled = pickle.loads(pickle.dumps(original))
+        unpickled.add(1)
+        unpickled.add(2 ** 32)
+
+        self.assertEqual([0, 1, 2 ** 32, 2 ** 64 - 1], list(unpickled))
+        self.assertEqual(4, len(unpickled))
+        self.assertFalse(2 in unpickled)
+
+    def test_additions_get_merged_in_bounded_steps(self):
+        class _SmallFingerprintSet(utils.FingerprintSet):
+            _PENDING_MIN = 4
+            _PENDING_RATIO = 2
+            _MERGE_CHUNK = 4
+
+        items = [(x * 7919) % 101 for x in xrange(300)]
+        fingerprints = _SmallFingerprintSet()
+        for item in items:
+            fingerprints.add(item)
+            self.assertTrue(item in fingerprints)
+
+        self.assertEqual(sorted(set(items)), list(fingerprints))
+        self.assertEqual(len(set(items)), len(fingerprints))
+        self.assertFalse(101 in fingerprints)
+
+    def test_pickled_items_are_packed_big_endian(self):
+        self.assertEqual("\x00" * 7 + "\x01" + "\x01" + "\x00" * 7, utils._pack_fingerprints([1, 2 ** 56]))
+        self.assertEqual([1, 2 ** 56], list(utils._unpack_fingerprints("\x00" * 7 + "\x01" + "\x01" + "\x00" * 7)))
+
+
+class TestPersistentCache(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_caches_see_each_others_writes(self):
+        first = utils.PersistentCache(self.path, "test", 60.0)
+        second = utils.PersistentCache(self.path, "test", 60.0)
+
+        first.set(1, "a")
+        first.flush()
+        self.assertEqual("a", second.get(1))
+        second.set(1, "b")
+        second.flush()
+        self.assertEqual("b", first.get(1))
+
+        first.close()
+        second.close()
+
+    def test_expired_entries_get_purged(self):
+        cache = utils.PersistentCache(self.path, "test", -1.0)
+        for index in xrange(cache._PURGE_INTERVAL):
+            cache.set(index, index)
+
+        count, = cache._connect().execute("SELECT COUNT(*) FROM cache").fetchone()
+        self.assertEqual(0, count)
+        cache.close()
+
+    def test_writes_are_flushed_on_close(self):
+        cache = utils.PersistentCache(self.path, "test", 60.0)
+        cache.set(1, "a")
+        cache.close()
+
+        other = utils.PersistentCache(self.path, "test", 60.0)
+        self.assertEqual("a", other.get(1))
+        other.close()
+
+    def test_unreadable_values_are_misses(self):
+        cache = utils.PersistentCache(self.path, "test", 60.0)
+        cache.set(1, "a")
+        cache.flush()
+        cache._connect().execute("UPDATE cache SET value = ?", (buffer("\x80\x02garbage"),))
+
+        self.assertEqual("default", cache.get(1, "default"))
+        cache.close()
+
+
+class TestTimedCache(unittest.TestCase):
+    def test_expired_entries_get_dropped(self):
+        cache = utils.TimedCache(-1.0)
+        cache.set("a", 1)
+        self.assertEqual(None, cache.get("a", None))
+        self.assertEqual(0, len(cache))
+        self.assertEqual(1, cache.stats()["expirations"])
+
+    def test_entries_can_have_their_own_cache_time(self):
+        cache = utils.TimedCache(60.0)
+        cache.set("a", 1, cache_time=-1.0)
+        cache.set("b", 2)
+        self.assertEqual(None, cache.get("a", None))
+        self.assertEqual(2, cache.get("b", None))
+        self.assertEqual(1, len(cache))
+
+    def test_resetting_keeps_one_entry_per_key(self):
+        cache = utils.TimedCache(60.0, max_size=2)
+        for index in xrange(1000):
+            cache.set("a", index)
+        cache.set("b", "b")
+
+        self.assertEqual(2, len(cache))
+        self.assertEqual(999, cache.get("a", None))
+        self.assertEqual("b", cache.get("b", None))
+        self.assertEqual(0, cache.stats()["evictions"])
+
+    def test_oldest_entries_get_evicted(self):
+        cache = utils.TimedCache(60.0, max_size=3)
+        for key in "abcd":
+            cache.set(key, key)
+
+        self.assertEqual(3, len(cache))
+        self.assertEqual(None, cache.get("a", None))
+        self.assertEqual(["b", "c", "d"], [cache.get(key, None) for key in "bcd"])
+
+        stats = cache.stats()
+        self.assertEqual(1, stats["evictions"])
+        self.assertEqual(3, stats["hits"])
+        self.assertEqual(1, stats["misses"])
+
+    def test_least_recently_used_entries_get_evicted(self):
+        cache = utils.TimedCache(60.0, max_size=3)
+        for key in "abc":
+            cache.set(key, key)
+
+        # Reading and resetting both count as using an entry.
+        self.assertEqual("a", cache.get("a", None))
+        cache.set("b", "b")
+        cache.set("d", "d")
+
+        self.assertEqual(None, cache.get("c", None))
+        self.assertEqual(["a", "b", "d"], [cache.get(key, None) for key in "abd"])
+
+    def test_expired_entries_get_swept_without_lookups(self):
+        cache = utils.TimedCache(60.0)
+        for index in xrange(1000):
+            cache.set(index, index, cache_time=-1.0)
+        cache.set("a", "a")
+
+        self.assertTrue(len(cache) < 100)
+        self.assertEqual("a", cache.get("a", None))
+        self.assertEqual(1000 - len(cache) + 1, cache.stats()["expirations"])
@@ -1,15 +1,25 @@
 from __future__ import absolute_import
 
+import re
+import sys
 import csv
 import ssl
 import gzip
+import array
+import bisect
+import struct
 import time
+import calendar
+import datetime
 import socket
+import sqlite3
 import httplib
 import inspect
+import operator
 import urllib2
 import traceback
 import functools
+import itertools
 import collections
 import email.parser
 import cPickle as pickle
@@ -393,37 +403,588 @@ def csv_to_events(fileobj, delimiter=",", columns=None, charset=None):
         yield idiokit.send(event)
 
 
+@idiokit.stream
+def csv_to_event_batches(fileobj, delimiter=",", columns=None, charset=None, batch_size=1000):
+    """
+    Like csv_to_events, but send the rows as events.EventBatch objects of
+    at most batch_size rows each.
+    """
+
+    indexes = None
+    batch = None
+
+    for row in _CSVReader(fileobj, charset=charset, delimiter=delimiter):
+        if columns is None:
+            columns = row
+            continue
+
+        if indexes is None:
+            indexes = [index for index, key in enumerate(columns) if key is not None]
+            keys = [columns[index] for index in indexes]
+
+        if batch is None:
+            batch = events.EventBatch(keys)
+
+        length = len(row)
+        batch.append([row[index] if index < length else None for index in indexes])
+
+        if len(batch) >= batch_size:
+            yield idiokit.send(batch)
+            batch = None
+
+    if batch is not None:
+        yield idiokit.send(batch)
+
+
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def _month_number(name, _months=dict((name, index) for index, name in enumerate(
+        ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], 1))):
+    month = _months.get(name.lower(), None)
+    if month is None:
+        raise ValueError("unknown month name")
+    return month
+
+
+class TimeParser(object):
+    r"""
+    Parse time strings of a fixed time.strptime format to UTC epoch
+    seconds. The common directives (%Y, %m, %b, %d, %H, %M and %S) are
+    matched with a precompiled regular expression. Everything else is
+    passed to time.strptime, so the results are the same as with
+    calendar.timegm(time.strptime(string, format)).
+
+    >>> parser = TimeParser("%Y-%m-%d %H:%M:%SZ")
+    >>> parser.parse("1970-01-02 00:00:01Z")
+    86401
+    >>> parser = TimeParser("%d/%b/%Y:%H:%M:%S")
+    >>> parser.parse("01/Feb/1970:00:00:00")
+    2678400
+
+    Raise ValueError for strings time.strptime wouldn't accept either.
+
+    >>> parser.parse("30/Feb/1970:00:00:00")
+    Traceback (most recent call last):
+        ...
+    ValueError: ...
+
+    The results (and failures) for up to cache_size most recently
+    parsed distinct strings are cached.
+
+    >>> parser = TimeParser("%Y-%m-%d %H:%M:%SZ", cache_size=2)
+    >>> parser.parse("1970-01-01 00:00:00Z")
+    0
+    >>> parser.parse("1970-01-01 00:00:00Z")
+    0
+    >>> parser.hits, parser.misses
+    (1, 1)
+    """
+
+    _DIRECTIVES = {
+        "Y": (0, r"(\d{4})", int),
+        "m": (1, r"(\d{1,2})", int),
+        "b": (1, r"([a-zA-Z]{3})", _month_number),
+        "d": (2, r"(\d{1,2})", int),
+        "H": (3, r"(\d{1,2})", int),
+        "M": (4, r"(\d{1,2})", int),
+        "S": (5, r"(\d{1,2})", int)
+    }
+
+    def __init__(self, format, cache_size=0):
+        self._format = format
+        self._converts = None
+        self._select = None
+        self._rex = None
+
+        self._cache_size = cache_size
+        self._cache = dict()
+        self._cache_order = collections.deque()
+        self.hits = 0
+        self.misses = 0
+
+        parts = format.split("%")
+        pieces = [re.escape(parts[0])]
+        fields = []
+        for part in parts[1:]:
+            if not part or part[0] not in self._DIRECTIVES:
+                # Leave unsupported formats to time.strptime.
+                return
+            index, rex, convert = self._DIRECTIVES[part[0]]
+            fields.append((index, convert))
+            pieces.append(rex + re.escape(part[1:]))
+
+        indexes = [index for index, _ in fields]
+        if len(set(indexes)) != len(indexes) or not set([0, 1, 2]).issubset(indexes):
+            return
+
+        # Pick the year, month, day, hour, minute and second from the
+        # converted groups, defaulting to the 0 appended after them.
+        order = [indexes.index(index) if index in indexes else len(indexes) for index in range(6)]
+        self._select = operator.itemgetter(*order)
+
+        converts = [convert for _, convert in fields]
+        if all(convert is int for convert in converts):
+            converts = None
+        self._converts = converts
+        self._rex = re.compile("".join(pieces) + r"\Z")
+
+    def _parse(self, string):
+        match = self._rex and self._rex.match(string)
+        if not match:
+            return calendar.timegm(time.strptime(string, self._format))
+
+        if self._converts is None:
+            values = map(int, match.groups())
+        else:
+            values = [convert(value) for convert, value in zip(self._converts, match.groups())]
+        values.append(0)
+
+        year, month, day, hour, minute, second = self._select(values)
+        if hour > 23 or minute > 59 or second > 61:
+            raise ValueError("time out of range")
+
+        # The date constructor checks the year, month and day ranges.
+        days = datetime.date(year, month, day).toordinal() - _EPOCH_ORDINAL
+        return ((days * 24 + hour) * 60 + minute) * 60 + second
+
+    def parse(self, string):
+        if self._cache_size <= 0:
+            return self._parse(string)
+
+        cache = self._cache
+        result = cache.get(string, None)
+        if result is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            try:
+                result = self._parse(string), None
+            except ValueError as error:
+                result = None, error
+
+            # Evict the oldest entries first. Timestamps in feeds mostly
+            # move forward, so this is almost as good as an LRU order
+            # without the cost of keeping the order up to date on hits.
+            if len(cache) >= self._cache_size:
+                del cache[self._cache_order.popleft()]
+            cache[string] = result
+            self._cache_order.append(string)
+
+        timestamp, error = result
+        if error is not None:
+            raise error
+        return timestamp
+
+
+# The fields of the linked list nodes used by TimedCache.
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRE_TIME = range(5)
+
+
 class TimedCache(object):
-    def __init__(self, cache_time):
-        self.cache = dict()
-        self.queue = collections.deque()
+    r"""
+    A cache whose entries expire cache_time seconds after they have been
+    set. When max_size is given, the least recently used entries are
+    evicted to keep at most max_size entries in the cache.
+
+    >>> cache = TimedCache(60.0, max_size=2)
+    >>> cache.set("a", 1)
+    >>> cache.set("b", 2)
+    >>> cache.get("a", None)
+    1
+    >>> cache.set("c", 3)
+    >>> cache.get("b", None) is None
+    True
+    >>> cache.get("a", None), len(cache)
+    (1, 2)
+
+    Setting an existing key replaces the entry and restarts its expiry
+    time. An entry can also be given its own cache time. The cache
+    counts its hits, misses, evictions and expirations.
+
+    >>> cache.set("a", 4, cache_time=-1.0)
+    >>> cache.get("a", None) is None
+    True
+    >>> sorted(cache.stats().items())
+    [('evictions', 1), ('expirations', 1), ('hits', 2), ('misses', 2), ('size', 1)]
+
+    Expired entries are dropped when they are looked up, evicted or swept
+    away by a periodic pass over the cache, so len() can include some
+    expired entries.
+    """
+
+    def __init__(self, cache_time, max_size=None):
+        # Each key maps to a node [prev, next, key, value, expire_time]
+        # of a circular doubly linked list that goes from the least to
+        # the most recently used entry. The list keeps its ends linked
+        # to the root node, so a node can be moved or removed without
+        # looking anything up.
+        root = []
+        root[:] = [root, root, None, None, None]
+        self._root = root
+        self._nodes = dict()
+
         self.cache_time = cache_time
+        self.max_size = max_size
 
-    def _expire(self):
-        current_time = time.time()
+        # Sweep the expired entries after about as many sets as there are
+        # entries, so that each set pays for a constant amount of sweeping.
+        self._sets_until_sweep = 64
 
-        while self.queue:
-            expire_time, key = self.queue[0]
-            if expire_time > current_time:
-                break
-            self.queue.popleft()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
-            other_time, _ = self.cache[key]
-            if other_time == expire_time:
-                del self.cache[key]
+    def __len__(self):
+        return len(self._nodes)
+
+    def _remove(self, node):
+        prev, next = node[_PREV], node[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+        del self._nodes[node[_KEY]]
+
+    def _touch(self, node):
+        # Move the node to the most recently used end of the list.
+        prev, next = node[_PREV], node[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+
+        root = self._root
+        last = root[_PREV]
+        node[_PREV] = last
+        node[_NEXT] = root
+        last[_NEXT] = root[_PREV] = node
+
+    def _sweep(self, current_time):
+        root = self._root
+
+        node = root[_NEXT]
+        while node is not root:
+            next = node[_NEXT]
+            if node[_EXPIRE_TIME] <= current_time:
+                self._remove(node)
+                self.expirations += 1
+            node = next
+
+        self._sets_until_sweep = len(self._nodes) + 64
+
+    def _evict(self, current_time):
+        root = self._root
+
+        while len(self._nodes) > self.max_size:
+            node = root[_NEXT]
+            self._remove(node)
+            if node[_EXPIRE_TIME] <= current_time:
+                self.expirations += 1
+            else:
+                self.evictions += 1
 
     def get(self, key, default):
-        self._expire()
-        if key not in self.cache:
+        node = self._nodes.get(key, None)
+        if node is None:
+            self.misses += 1
+            return default
+
+        if node[_EXPIRE_TIME] <= time.time():
+            self._remove(node)
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        # Inline the hot path of _touch.
+        root = self._root
+        last = root[_PREV]
+        if node is not last:
+            prev, next = node[_PREV], node[_NEXT]
+            prev[_NEXT] = next
+            next[_PREV] = prev
+
+            node[_PREV] = last
+            node[_NEXT] = root
+            last[_NEXT] = root[_PREV] = node
+
+        self.hits += 1
+        return node[_VALUE]
+
+    def get_first(self, keys, default):
+        r"""
+        Return the value of the first of the given keys found in the
+        cache. The whole lookup counts as one hit or miss.
+
+        >>> cache = TimedCache(60.0)
+        >>> cache.set("b", 2)
+        >>> cache.get_first(["a", "b"], None)
+        2
+        >>> cache.get_first(["a", "c"], None) is None
+        True
+        >>> cache.hits, cache.misses
+        (1, 1)
+        """
+
+        current_time = time.time()
+
+        nodes = self._nodes
+        for key in keys:
+            node = nodes.get(key, None)
+            if node is None:
+                continue
+
+            if node[_EXPIRE_TIME] <= current_time:
+                self._remove(node)
+                self.expirations += 1
+                continue
+
+            self._touch(node)
+            self.hits += 1
+            return node[_VALUE]
+
+        self.misses += 1
+        return default
+
+    def set(self, key, value, cache_time=None):
+        current_time = time.time()
+        if cache_time is None:
+            cache_time = self.cache_time
+        expire_time = current_time + cache_time
+
+        node = self._nodes.get(key, None)
+        if node is not None:
+            node[_VALUE] = value
+            node[_EXPIRE_TIME] = expire_time
+            self._touch(node)
+        else:
+            root = self._root
+            last = root[_PREV]
+            node = [last, root, key, value, expire_time]
+            last[_NEXT] = root[_PREV] = node
+            self._nodes[key] = node
+
+            if self.max_size is not None and len(self._nodes) > self.max_size:
+                self._evict(current_time)
+
+        self._sets_until_sweep -= 1
+        if self._sets_until_sweep <= 0:
+            self._sweep(current_time)
+
+    def stats(self):
+        return {
+            "size": len(self._nodes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+
+class PersistentCache(object):
+    r"""
+    A cache of picklable values kept in an SQLite database file, so that
+    the values survive restarts and can be shared by several processes
+    on the same host. Each value expires cache_time seconds after it has
+    been set. Several caches can share one file by using different
+    namespaces.
+
+    >>> import os
+    >>> import tempfile
+    >>> fd, path = tempfile.mkstemp()
+    >>> os.close(fd)
+    >>> cache = PersistentCache(path, "test", 60.0)
+    >>> cache.set("key", (u"value",))
+    >>> cache.get("key")
+    (u'value',)
+
+    Writes are buffered and written to the database in batches, so other
+    caches see them only after a flush.
+
+    >>> PersistentCache(path, "test", 60.0).get("key") is None
+    True
+    >>> cache.flush()
+    >>> PersistentCache(path, "test", 60.0).get("key")
+    (u'value',)
+    >>> PersistentCache(path, "other", 60.0).get("key") is None
+    True
+
+    Expired values are not returned.
+
+    >>> cache.set("expired", 1, cache_time=-1.0)
+    >>> cache.get("expired", "default")
+    'default'
+    >>> cache.close()
+    >>> os.remove(path)
+
+    The database is opened lazily on first use. The cache is best
+    effort: database errors (e.g. another process holding a lock for too
+    long) and unreadable values cause misses and skipped writes instead
+    of exceptions. Buffered writes not yet flushed are lost if the
+    process dies, so owners of a cache should call flush() about every
+    FLUSH_INTERVAL seconds (for writes that no later write triggers the
+    flush for) and close() when shutting down.
+    """
+
+    # Write the buffered values after this many writes, or at the next
+    # write after this many seconds since the previous flush.
+    _FLUSH_SIZE = 100
+    FLUSH_INTERVAL = 5.0
+
+    # Remove expired entries after every this many written values.
+    _PURGE_INTERVAL = 1000
+
+    def __init__(self, path, namespace, cache_time, timeout=1.0):
+        self._path = path
+        self._namespace = unicode(namespace)
+        self._cache_time = cache_time
+        self._timeout = timeout
+
+        self._db = None
+        self._writes = 0
+
+        # Values set but not yet written to the database.
+        self._pending = dict()
+        self._flush_time = time.time() + self.FLUSH_INTERVAL
+
+    def _connect(self):
+        if self._db is not None:
+            return self._db
+
+        db = sqlite3.connect(self._path, timeout=self._timeout, isolation_level=None)
+        try:
+            # Let readers in other processes proceed while one writes, and
+            # don't wait for the disk on every commit. A crash may lose the
+            # latest writes, which is fine for a cache.
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "namespace TEXT NOT NULL, "
+                "key TEXT NOT NULL, "
+                "value BLOB NOT NULL, "
+                "expires REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+        except:
+            db.close()
+            raise
+        self._db = db
+        return db
+
+    def get_entry(self, key):
+        """
+        Return a (value, expire time) pair for the given key, or None if
+        the key has no value that is still valid.
+        """
+
+        key = unicode(key)
+        current_time = time.time()
+
+        entry = self._pending.get(key, None)
+        if entry is not None:
+            value, expires = entry
+            if expires <= current_time:
+                return None
+            return entry
+
+        try:
+            row = self._connect().execute(
+                "SELECT value, expires FROM cache WHERE namespace = ? AND key = ?",
+                (self._namespace, key)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+
+        if row is None:
+            return None
+
+        data, expires = row
+        if expires <= current_time:
+            return None
+
+        try:
+            value = pickle.loads(str(data))
+        except Exception:
+            # A corrupt or truncated value is just a miss.
+            return None
+        return value, expires
+
+    def get(self, key, default=None):
+        entry = self.get_entry(key)
+        if entry is None:
             return default
-        _, value = self.cache[key]
+        value, _ = entry
         return value
 
-    def set(self, key, value):
-        self._expire()
-        expire_time = time.time() + self.cache_time
-        self.queue.append((expire_time, key))
-        self.cache[key] = expire_time, value
+    def set(self, key, value, cache_time=None):
+        if cache_time is None:
+            cache_time = self._cache_time
+
+        current_time = time.time()
+        self._pending[unicode(key)] = value, current_time + cache_time
+
+        if len(self._pending) >= self._FLUSH_SIZE or current_time >= self._flush_time:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered values to the database in one transaction.
+        """
+
+        pending = self._pending
+        self._pending = dict()
+        self._flush_time = time.time() + self.FLUSH_INTERVAL
+        if not pending:
+            return
+
+        rows = []
+        for key, (value, expires) in pending.iteritems():
+            data = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            rows.append((self._namespace, key, data, expires))
+
+        try:
+            db = self._connect()
+            db.execute("BEGIN")
+            try:
+                db.executemany(
+                    "INSERT OR REPLACE INTO cache (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+
+                self._writes += len(rows)
+                if self._writes >= self._PURGE_INTERVAL:
+                    self._writes = 0
+                    db.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+            except:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        self.flush()
+
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class Waiter(object):
+    """
+    Let a stream wait until another one wakes it up. Waking up when no
+    stream is waiting does nothing.
+    """
+
+    def __init__(self):
+        self._event = None
+
+    def wait(self):
+        self._event = idiokit.Event()
+        return self._event
+
+    def wake(self):
+        event, self._event = self._event, None
+        if event is not None:
+            event.succeed()
 
 
 class WaitQueue(object):
@@ -575,3 +1136,139 @@ class CompressedCollection(object):
             self._gz = gzip.GzipFile(None, "ab", fileobj=self._stringio)
         self._gz.write(pickle.dumps(obj))
         self._count += 1
+
+
+# Use arrays for storing 64-bit fingerprints when the platform's
+# unsigned long is wide enough.
+_FINGERPRINT_TYPECODE = "L" if array.array("L").itemsize == 8 else None
+
+
+class FingerprintSet(object):
+    FORMAT = 1
+
+    # Merge the added items into the sorted array once there are this
+    # many of them, or more for large arrays so that the array doesn't
+    # get copied too often.
+    _PENDING_MIN = 65536
+    _PENDING_RATIO = 8
+    _MERGE_CHUNK = 65536
+
+    def __init__(self, iterable=(), _state=None):
+        """
+        A set of 64-bit unsigned integers (e.g. event fingerprints) that
+        keeps its items in a sorted array instead of a set of Python
+        objects. Additions are collected to a regular set until the next
+        call to compact(), or until there are enough of them to be worth
+        merging to the array.
+
+        >>> s = FingerprintSet([3, 1])
+        >>> s.add(2)
+        >>> 2 in s, 4 in s
+        (True, False)
+        >>> s.compact()
+        >>> list(s) == [1, 2, 3]
+        True
+        >>> len(s)
+        3
+
+        The pickled form contains the items as a single string of packed
+        integers.
+
+        >>> list(pickle.loads(pickle.dumps(s))) == [1, 2, 3]
+        True
+        """
+
+        self._pending = set()
+        if _FINGERPRINT_TYPECODE is None:
+            self._sorted = []
+        else:
+            self._sorted = array.array(_FINGERPRINT_TYPECODE)
+
+        if _state:
+            _format, data = _state
+            self._sorted = _unpack_fingerprints(data)
+
+        if self._sorted:
+            for item in iterable:
+                self.add(item)
+        else:
+            self._pending.update(iterable)
+
+    def __contains__(self, item):
+        if item in self._pending:
+            return True
+
+        items = self._sorted
+        index = bisect.bisect_left(items, item)
+        return index < len(items) and items[index] == item
+
+    def __len__(self):
+        self.compact()
+        return len(self._sorted)
+
+    def __iter__(self):
+        self.compact()
+        return iter(self._sorted)
+
+    def add(self, item):
+        # Items already in the sorted array get weeded out when merging.
+        pending = self._pending
+        pending.add(item)
+        if len(pending) >= max(self._PENDING_MIN, len(self._sorted) // self._PENDING_RATIO):
+            self.compact()
+
+    def compact(self):
+        if not self._pending:
+            return
+
+        pending = sorted(self._pending)
+        old = self._sorted
+        if _FINGERPRINT_TYPECODE is None:
+            merged = []
+        else:
+            merged = array.array(_FINGERPRINT_TYPECODE)
+
+        # Merge the pending items to the sorted items one chunk at a time,
+        # so that only a chunk at a time gets expanded to Python objects.
+        start = 0
+        for offset in xrange(0, len(old), self._MERGE_CHUNK):
+            chunk = old[offset:offset + self._MERGE_CHUNK]
+            end = bisect.bisect_right(pending, chunk[-1], start)
+            if end > start:
+                new_items = set(pending[start:end]).difference(chunk)
+                if new_items:
+                    chunk = sorted(itertools.chain(chunk, new_items))
+                start = end
+            merged.extend(chunk)
+        merged.extend(pending[start:])
+
+        self._sorted = merged
+        self._pending = set()
+
+    def __reduce__(self):
+        self.compact()
+        data = _pack_fingerprints(self._sorted)
+        return self.__class__, ((), (self.FORMAT, data))
+
+
+def _pack_fingerprints(items):
+    # The items are packed as big-endian integers so that the pickled
+    # data can be loaded on platforms with a different byte order.
+    if _FINGERPRINT_TYPECODE is None:
+        return struct.pack(">{0}Q".format(len(items)), *items)
+
+    items = array.array(_FINGERPRINT_TYPECODE, items)
+    if sys.byteorder == "little":
+        items.byteswap()
+    return items.tostring()
+
+
+def _unpack_fingerprints(data):
+    if _FINGERPRINT_TYPECODE is None:
+        return list(struct.unpack(">{0}Q".format(len(data) // 8), data))
+
+    items = array.array(_FINGERPRINT_TYPECODE)
+    items.fromstring(data)
+    if sys.byteorder == "little":
+        items.byteswap()
+    return items
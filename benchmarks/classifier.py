@@ -0,0 +1,76 @@
+"""
+Compare the per-event classification cost of rules.Classifier and
+rules.IndexedClassifier with a growing number of roomgraph-style
+session rules.
+"""
+
+import time
+import random
+
+from abusehelper.core import events, rules
+
+
+def build_rules(count):
+    ccs = ["FI", "SE", "NO", "DK", "EE"]
+
+    result = []
+    for index in xrange(count):
+        if index % 3 == 0:
+            rule = rules.Match("feed", "feed {0}".format(index))
+        elif index % 3 == 1:
+            rule = rules.And(
+                rules.Match("feed", "feed {0}".format(index)),
+                rules.Match("cc", ccs[index % len(ccs)])
+            )
+        else:
+            rule = rules.Or(
+                rules.Match("feed", "feed {0}".format(index)),
+                rules.Match("asn", unicode(index))
+            )
+        result.append(rule)
+    return result
+
+
+def build_events(count, rule_count, seed=0):
+    rand = random.Random(seed)
+
+    result = []
+    for _ in xrange(count):
+        result.append(events.Event({
+            "feed": "feed {0}".format(rand.randrange(rule_count)),
+            "cc": rand.choice(["FI", "SE", "US"]),
+            "asn": unicode(rand.randrange(rule_count)),
+            "ip": "192.0.2.{0}".format(rand.randrange(256)),
+            "type": "malware"
+        }))
+    return result
+
+
+def measure(classifier, event_list, rounds=3):
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        for event in event_list:
+            classifier.classify(event)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(event_list)
+
+
+def main(rule_counts=(10, 100, 1000, 5000), event_count=200):
+    for rule_count in rule_counts:
+        rule_list = build_rules(rule_count)
+        event_list = build_events(event_count, rule_count)
+
+        for cls in [rules.Classifier, rules.IndexedClassifier]:
+            classifier = cls()
+            for index, rule in enumerate(rule_list):
+                classifier.inc(rule, "room {0}".format(index))
+
+            per_event = measure(classifier, event_list)
+            print "{0:>18} rules={1:<6} {2:10.2f} us/event".format(
+                cls.__name__, rule_count, per_event * 1e6)
+
+
+if __name__ == "__main__":
+    main()
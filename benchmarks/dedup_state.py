@@ -0,0 +1,39 @@
+"""
+Compare the pickled size and the pickling and unpickling times of
+PollingBot deduplication state kept as a set of integers and as a
+utils.FingerprintSet.
+"""
+
+import time
+import random
+import cPickle as pickle
+
+from abusehelper.core import utils
+
+
+def build_items(count, seed=0):
+    rand = random.Random(seed)
+    return [rand.getrandbits(64) for _ in xrange(count)]
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main(item_count=1000000):
+    items = build_items(item_count)
+
+    fingerprint_set = utils.FingerprintSet(items)
+    fingerprint_set.compact()
+
+    for name, obj in [("set", set(items)), ("FingerprintSet", fingerprint_set)]:
+        data, dump_time = timed(pickle.dumps, obj, pickle.HIGHEST_PROTOCOL)
+        _, load_time = timed(pickle.loads, data)
+        print "{0:>15} {1:8.1f} MB {2:8.3f} s dump {3:8.3f} s load".format(
+            name, len(data) / 1e6, dump_time, load_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Compare the per-row cost of the feed pipeline steps (building events,
+dedup digests and stanza conversion) for rows sent as individual events
+and as columnar events.EventBatch objects.
+"""
+
+import time
+import random
+import hashlib
+
+from abusehelper.core import events
+
+
+KEYS = ["ip", "time", "category", "feed", "description"]
+
+
+def build_rows(count, seed=0):
+    rand = random.Random(seed)
+    return [
+        [
+            u"192.0.2.{0}".format(rand.randrange(256)),
+            u"2017-09-04 12:{0:02d}:00Z".format(rand.randrange(60)),
+            u"sshpwauth",
+            u"dataplane",
+            u"row number {0}".format(index)
+        ]
+        for index in xrange(count)
+    ]
+
+
+def build_events(rows):
+    result = []
+    for row in rows:
+        event = events.Event()
+        for key, value in zip(KEYS, row):
+            event.add(key, value)
+        result.append(event)
+    return result
+
+
+def build_batch(rows):
+    return events.EventBatch(KEYS, rows)
+
+
+def measure(func, rows, rounds=3):
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        func(rows)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(rows)
+
+
+def main(row_count=10000):
+    rows = build_rows(row_count)
+    evs = build_events(rows)
+    batch = build_batch(rows)
+
+    configurations = [
+        ("build events", build_events, rows),
+        ("build batch", build_batch, rows),
+        ("event digests", lambda x: [events.hexdigest(events.Event(e), hashlib.md5) for e in evs], rows),
+        ("batch digests", lambda x: batch.hexdigests(hashlib.md5), rows),
+        ("event elements", lambda x: [e.to_elements() for e in evs], rows),
+        ("batch elements", lambda x: batch.to_elements(), rows)
+    ]
+    for name, func, items in configurations:
+        print "{0:>16} {1:10.2f} us/row".format(name, measure(func, items) * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Compare the per-event cost of computing PollingBot deduplication keys:
+the earlier integer conversion of MD5 hexdigests against the 64-bit
+fingerprints of individual events and of events.EventBatch rows.
+"""
+
+import time
+import random
+import hashlib
+
+from abusehelper.core import events
+
+
+KEYS = ["ip", "time", "category", "feed", "description"]
+
+
+def build_rows(count, seed=0):
+    rand = random.Random(seed)
+    return [
+        [
+            u"192.0.2.{0}".format(rand.randrange(256)),
+            u"2017-09-04 12:{0:02d}:00Z".format(rand.randrange(60)),
+            u"sshpwauth",
+            u"dataplane",
+            u"row number {0}".format(index)
+        ]
+        for index in xrange(count)
+    ]
+
+
+def reference_key(event):
+    result = hashlib.md5()
+    for key, value in sorted(event.items()):
+        result.update(key.encode("utf-8"))
+        result.update("\xc0")
+        result.update(value.encode("utf-8"))
+        result.update("\xc0")
+    return int(result.hexdigest(), 16)
+
+
+def measure(func, count, rounds=3):
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / count
+
+
+def main(row_count=20000):
+    rows = build_rows(row_count)
+    batch = events.EventBatch(KEYS, rows)
+
+    # The events are built again for each round, as event fingerprints
+    # are memoized.
+    configurations = [
+        ("build events only", lambda: list(batch)),
+        ("reference md5 keys", lambda: [reference_key(event) for event in batch]),
+        ("event fingerprints", lambda: [events.fingerprint(event) for event in batch]),
+        ("batch fingerprints", lambda: batch.fingerprints())
+    ]
+    for name, func in configurations:
+        print "{0:>20} {1:10.2f} us/event".format(name, measure(func, row_count) * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Compare Event.from_elements against the earlier implementation that
+collected the values of each event into lists and then normalized them
+through the Event constructor.
+"""
+
+import time
+import random
+import collections
+from base64 import b64decode
+
+from idiokit.xmlcore import Element
+
+from abusehelper.core import events
+
+
+def reference_from_elements(elements):
+    for event_element in elements.children("e", events.EVENT_NS):
+        attrs = collections.defaultdict(list)
+        for key_element in event_element.children("k").with_attrs("a"):
+            key = b64decode(key_element.get_attr("a")).decode("utf-8")
+            for value_element in key_element.children("v").with_attrs("a"):
+                value = b64decode(value_element.get_attr("a")).decode("utf-8")
+                attrs[key].append(value)
+        yield events.Event(attrs)
+
+    for event_element in elements.children("event", events.EVENT_NS):
+        attrs = collections.defaultdict(list)
+        for attr in event_element.children("attr").with_attrs("key", "value"):
+            key = attr.get_attr("key")
+            value = attr.get_attr("value")
+            attrs[key].append(value)
+        yield events.Event(attrs)
+
+
+def build_messages(count, compact, seed=0):
+    rand = random.Random(seed)
+
+    result = []
+    for index in xrange(count):
+        event = events.Event({
+            "feed": "feed {0}".format(rand.randrange(50)),
+            "feeder": "feeder",
+            "type": "malware",
+            "cc": rand.choice(["FI", "SE", "US"]),
+            "ip": "192.0.2.{0}".format(rand.randrange(256)),
+            "asn": unicode(rand.randrange(65536)),
+            "source time": "2017-09-04 12:{0:02d}:00Z".format(rand.randrange(60)),
+            "description": "event number {0}".format(index)
+        })
+        message = Element("message")
+        message.add(event.to_elements(compact=compact))
+        result.append(message)
+    return result
+
+
+def measure(func, messages, rounds=3):
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        for message in messages:
+            list(func(message))
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(messages)
+
+
+def main(event_count=10000):
+    for compact in [False, True]:
+        messages = build_messages(event_count, compact)
+        for name, func in [("reference", reference_from_elements), ("from_elements", events.Event.from_elements)]:
+            print "{0:>8} {1:>14} {2:10.2f} us/event".format(
+                "compact" if compact else "legacy", name, measure(func, messages) * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Compare the size and the build cost of the XML elements produced by
+Event.to_elements for the legacy and compact event formats, with and
+without the human-readable body.
+"""
+
+import time
+import random
+
+from abusehelper.core import events
+
+
+def build_events(count, seed=0):
+    rand = random.Random(seed)
+    return [
+        events.Event({
+            "feed": "feed {0}".format(rand.randrange(50)),
+            "feeder": "feeder",
+            "type": "malware",
+            "cc": rand.choice(["FI", "SE", "US"]),
+            "ip": "192.0.2.{0}".format(rand.randrange(256)),
+            "asn": unicode(rand.randrange(65536)),
+            "source time": "2017-09-04 12:{0:02d}:00Z".format(rand.randrange(60)),
+            "url": "http://www.example.com/path/{0}?query=value".format(index),
+            "description": "event number {0}".format(index)
+        })
+        for index in xrange(count)
+    ]
+
+
+def measure(evs, options, rounds=3):
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        built = [event.to_elements(**options) for event in evs]
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    size = sum(len(element.serialize()) for elements in built for element in elements)
+    return best / len(evs), size / float(len(evs))
+
+
+def main(event_count=5000):
+    evs = build_events(event_count)
+
+    configurations = [
+        ("legacy", dict()),
+        ("legacy, no body", dict(include_body=False)),
+        ("compact", dict(compact=True)),
+        ("compact, body 64", dict(compact=True, max_body_length=64)),
+        ("compact, no body", dict(compact=True, include_body=False))
+    ]
+    for name, options in configurations:
+        per_event, size = measure(evs, options)
+        print "{0:>18} {1:10.2f} us/event {2:8.1f} bytes/event".format(name, per_event * 1e6, size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Compare the unicode event line codec (Event.from_unicode, unicode(event)
+and the line stream helpers) against copies of the earlier token by
+token implementations.
+"""
+
+import time
+import random
+import collections
+
+from abusehelper.core import events
+
+
+def reference_from_unicode(string):
+    string = string.strip()
+    if not string:
+        return events.Event()
+
+    attrs = collections.defaultdict(list)
+
+    index = 0
+    length = len(string)
+    while True:
+        key, index = events._unicode_parse_part(string, index)
+        if index >= length:
+            raise ValueError("unexpected string end")
+        if string[index] != u"=":
+            raise ValueError("unexpected character")
+        index += 1
+
+        value, index = events._unicode_parse_part(string, index)
+        attrs[key].append(value)
+
+        if index >= length:
+            return events.Event(attrs)
+
+        if string[index] != u",":
+            raise ValueError("unexpected character")
+        index += 1
+
+
+def reference_to_unicode(event):
+    return u", ".join(events._unicode_quote(key) + u"=" + events._unicode_quote(value)
+                      for (key, value) in event.items())
+
+
+def build_events(count, seed=0):
+    rand = random.Random(seed)
+    return [
+        events.Event({
+            "feed": "feed {0}".format(rand.randrange(50)),
+            "type": "malware",
+            "ip": "192.0.2.{0}".format(rand.randrange(256)),
+            "source time": "2017-09-04 12:{0:02d}:00Z".format(rand.randrange(60)),
+            "url": "http://www.example.com/path?a={0}&b=c".format(index),
+            "description": "event \"number\" {0}".format(index)
+        })
+        for index in xrange(count)
+    ]
+
+
+def measure(func, items, rounds=3):
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        func(items)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(items)
+
+
+def main(event_count=10000):
+    evs = build_events(event_count)
+    lines = [unicode(event) + u"\n" for event in evs]
+
+    configurations = [
+        ("reference encode", lambda x: [reference_to_unicode(event) for event in x], evs),
+        ("unicode(event)", lambda x: [unicode(event) for event in x], evs),
+        ("format lines", lambda x: list(events.format_unicode_lines(x)), evs),
+        ("reference decode", lambda x: [reference_from_unicode(line) for line in x], lines),
+        ("from_unicode", lambda x: [events.Event.from_unicode(line) for line in x], lines),
+        ("parse lines", lambda x: list(events.parse_unicode_lines(x)), lines)
+    ]
+    for name, func, items in configurations:
+        print "{0:>18} {1:10.2f} us/event".format(name, measure(func, items) * 1e6)
+
+
+if __name__ == "__main__":
+    main()
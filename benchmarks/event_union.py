@@ -0,0 +1,50 @@
+"""
+Measure the cost of the augmentation steps of an expert pipeline, where
+each step adds a few key-value pairs to an event with Event.union.
+"""
+
+import time
+
+from abusehelper.core import events
+
+
+def build_event(key_count):
+    return events.Event(dict(("key {0}".format(x), "value {0}".format(x)) for x in xrange(key_count)))
+
+
+def copied_sets(parent, child):
+    # Count the value sets of the child that are not shared with the parent.
+    shared = set(id(x) for x in parent._attrs.itervalues())
+    return sum(1 for x in child._attrs.itervalues() if id(x) not in shared)
+
+
+def augment(event, steps):
+    chain = [event]
+    for step in xrange(steps):
+        chain.append(chain[-1].union({"augment": "step {0}".format(step)}))
+    return chain
+
+
+def measure(key_count, steps=5, rounds=2000):
+    originals = [build_event(key_count) for _ in xrange(rounds)]
+
+    start = time.time()
+    chains = [augment(event, steps) for event in originals]
+    elapsed = time.time() - start
+
+    copies = 0
+    for chain in chains:
+        for parent, child in zip(chain, chain[1:]):
+            copies += copied_sets(parent, child)
+    return elapsed / (rounds * steps), copies / float(rounds * steps)
+
+
+def main():
+    for key_count in [5, 20, 50]:
+        per_step, copies = measure(key_count)
+        print "{0:>3} keys {1:10.2f} us/step {2:6.1f} value sets allocated/step".format(
+            key_count, per_step * 1e6, copies)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Measure the per-event matching cost of "ip in A or ip in B or ..." rules
+as the number of netblocks grows.
+"""
+
+import time
+import random
+
+from abusehelper.core import events, rules
+
+
+def build_rule(netblock_count, seed=0):
+    rand = random.Random(seed)
+    subrules = []
+    for _ in xrange(netblock_count):
+        ip = "{0}.{1}.{2}.0".format(rand.randrange(1, 224), rand.randrange(256), rand.randrange(256))
+        subrules.append(rules.Match("ip", rules.IP(ip + "/24")))
+    return rules.Or(*subrules)
+
+
+def build_events(count, seed=1):
+    rand = random.Random(seed)
+    return [
+        events.Event(ip="{0}.{1}.{2}.{3}".format(*[rand.randrange(256) for _ in xrange(4)]))
+        for _ in xrange(count)
+    ]
+
+
+def measure(rule, evs, rounds=3):
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        for event in evs:
+            rule.match(event)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(evs)
+
+
+def main(event_count=2000):
+    evs = build_events(event_count)
+
+    for netblock_count in [10, 100, 1000, 10000]:
+        rule = build_rule(netblock_count)
+        print "{0:>6} netblocks {1:10.2f} us/event".format(netblock_count, measure(rule, evs) * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Compare the throughput of sending events from the roomgraph parent process
+to its workers over plain sockets and through shared memory rings.
+"""
+
+import os
+import sys
+import time
+import socket
+import subprocess
+
+from abusehelper.core import events, rules, roomgraph, shmring
+
+
+def start_worker(ring=None):
+    env = dict(os.environ)
+    env["ABUSEHELPER_SUBPROCESS"] = ""
+    if ring is not None:
+        env["ABUSEHELPER_SHARED_MEMORY"] = ring.path
+
+    own_conn, other_conn = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "abusehelper.core.roomgraph"],
+            stdin=other_conn.fileno(),
+            close_fds=True,
+            env=env
+        )
+    finally:
+        other_conn.close()
+    return process, own_conn
+
+
+def build_batches(event_count, batch_size):
+    batch = []
+    for index in xrange(event_count):
+        event = events.Event({
+            "feed": "feed {0}".format(index % 50),
+            "type": "malware",
+            "ip": "192.0.2.{0}".format(index % 256),
+            "description": "event number {0}".format(index)
+        })
+        batch.append(("event", (u"src", event)))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def measure(worker_count, use_ring, event_count, batch_size, ring_size, window=4):
+    rings = []
+    workers = []
+    try:
+        for _ in xrange(worker_count):
+            ring = shmring.RingWriter(ring_size) if use_ring else None
+            process, conn = start_worker(ring)
+            if ring is not None:
+                # Skip the worker's report on mapping the ring.
+                roomgraph._recv_frame_blocking(conn)
+            workers.append((process, conn, ring, roomgraph.CompactWireFormat()))
+            rings.append(ring)
+
+        # Make every event match, so that each batch gets a reply. The rule
+        # is sent inline to keep it from needing a reply of its own.
+        for _, conn, _, wire in workers:
+            roomgraph.send_events(conn, [("inc_rule", (u"src", rules.Anything(), u"dst"))], wire)
+
+        start = time.time()
+        pending = []
+        batches = build_batches(event_count, batch_size)
+        for index, batch in enumerate(batches):
+            process, conn, ring, wire = workers[index % worker_count]
+            roomgraph.send_events(conn, batch, wire, ring)
+            pending.append(index % worker_count)
+
+            while len(pending) >= window * worker_count:
+                _, conn, ring, wire = workers[pending.pop(0)]
+                _, released = roomgraph.recv_results(conn, wire)
+                if released:
+                    ring.release(released)
+
+        for worker_index in pending:
+            _, conn, ring, wire = workers[worker_index]
+            _, released = roomgraph.recv_results(conn, wire)
+            if released:
+                ring.release(released)
+        return event_count / (time.time() - start)
+    finally:
+        for process, conn, _, _ in workers:
+            conn.close()
+            process.wait()
+        for ring in rings:
+            if ring is not None:
+                ring.close()
+
+
+def main(event_count=100000, batch_size=100, ring_size=4 * 1024 * 1024):
+    for worker_count in [1, 2, 4, 8]:
+        for use_ring in [False, True]:
+            rate = measure(worker_count, use_ring, event_count, batch_size, ring_size)
+            print "{0:>2} worker(s) {1:>8} {2:12.0f} events/s".format(
+                worker_count, "ring" if use_ring else "socket", rate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Compare the cPickle and compact wire formats used between the roomgraph
+parent process and its workers.
+"""
+
+import time
+import random
+
+from idiokit.xmpp.jid import JID
+
+from abusehelper.core import events, roomgraph
+
+
+def build_messages(count, seed=0):
+    rand = random.Random(seed)
+    rooms = [JID("room{0}@conference.example.com".format(x)) for x in xrange(20)]
+
+    result = []
+    for index in xrange(count):
+        event = events.Event({
+            "feed": "feed {0}".format(rand.randrange(50)),
+            "feeder": "feeder",
+            "type": "malware",
+            "cc": rand.choice(["FI", "SE", "US"]),
+            "ip": "192.0.2.{0}".format(rand.randrange(256)),
+            "asn": unicode(rand.randrange(65536)),
+            "source time": "2017-09-04 12:{0:02d}:00Z".format(rand.randrange(60)),
+            "description": "event number {0}".format(index)
+        })
+        src = rand.choice(rooms)
+        dsts = set(rand.sample(rooms, 3))
+        result.append((("event", (src, event)), ("result", (src, event, dsts))))
+    return result
+
+
+def measure(wire_format, messages, rounds=3):
+    best = None
+    size = 0
+    for _ in xrange(rounds):
+        # Each direction of the link has its own end-specific state.
+        parent, worker = wire_format(), wire_format()
+
+        size = 0
+        start = time.time()
+        for to_worker, to_parent in messages:
+            data = parent.encode(to_worker)
+            size += len(data)
+            worker.decode(data)
+
+            data = worker.encode(to_parent)
+            size += len(data)
+            parent.decode(data)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(messages), size / float(len(messages))
+
+
+def main(event_count=20000):
+    messages = build_messages(event_count)
+
+    for wire_format in [roomgraph.PickleWireFormat, roomgraph.CompactWireFormat]:
+        per_event, size = measure(wire_format, messages)
+        print "{0:>18} {1:10.2f} us/event {2:8.1f} bytes/event".format(
+            wire_format.__name__, per_event * 1e6, size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Compare the per-value cost of parsing "source time" style timestamps to
+epoch seconds with calendar.timegm(time.strptime(...)) and with
+utils.TimeParser, with and without its cache of parsed values.
+"""
+
+import time
+import random
+import calendar
+
+from abusehelper.core import utils
+
+
+FORMAT = "%Y-%m-%d %H:%M:%SZ"
+
+
+def build_values(count, distinct, seed=0):
+    rand = random.Random(seed)
+    times = [
+        time.strftime(FORMAT, time.gmtime(1500000000 + rand.randrange(86400)))
+        for _ in xrange(distinct)
+    ]
+    return [rand.choice(times) for _ in xrange(count)]
+
+
+def measure(func, values, rounds=3):
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        for value in values:
+            func(value)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(values)
+
+
+def main(value_count=20000):
+    for distinct in [10, 10000]:
+        values = build_values(value_count, distinct)
+
+        configurations = [
+            ("strptime", lambda x: calendar.timegm(time.strptime(x, FORMAT))),
+            ("TimeParser", utils.TimeParser(FORMAT).parse),
+            ("cached TimeParser", utils.TimeParser(FORMAT, cache_size=1024).parse)
+        ]
+        for name, func in configurations:
+            print "{0:>5} distinct {1:>18} {2:10.2f} us/value".format(
+                distinct, name, measure(func, values) * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Measure the per-operation cost of utils.TimedCache gets and sets, with
+and without a size bound, for a key stream that repeatedly sets the same
+keys again. The earlier implementation without the size bound and the
+counters is included for comparison.
+"""
+
+import time
+import random
+import collections
+
+from abusehelper.core import utils
+
+
+class OldTimedCache(object):
+    def __init__(self, cache_time):
+        self.cache = dict()
+        self.queue = collections.deque()
+        self.cache_time = cache_time
+
+    def _expire(self):
+        current_time = time.time()
+
+        while self.queue:
+            expire_time, key = self.queue[0]
+            if expire_time > current_time:
+                break
+            self.queue.popleft()
+
+            other_time, _ = self.cache[key]
+            if other_time == expire_time:
+                del self.cache[key]
+
+    def get(self, key, default):
+        self._expire()
+        if key not in self.cache:
+            return default
+        _, value = self.cache[key]
+        return value
+
+    def set(self, key, value):
+        self._expire()
+        expire_time = time.time() + self.cache_time
+        self.queue.append((expire_time, key))
+        self.cache[key] = expire_time, value
+
+
+def build_keys(count, distinct, seed=0):
+    rand = random.Random(seed)
+    return [rand.randrange(distinct) for _ in xrange(count)]
+
+
+def measure(cache, keys):
+    start = time.time()
+    for key in keys:
+        if cache.get(key, None) is None:
+            cache.set(key, key)
+    return (time.time() - start) / len(keys)
+
+
+def main(key_count=200000, distinct=50000):
+    keys = build_keys(key_count, distinct)
+
+    per_key = measure(OldTimedCache(60.0), keys)
+    print "{0:>15} {1:8.2f} us/key".format("old", per_key * 1e6)
+
+    for name, max_size in [("unbounded", None), ("max_size=10000", 10000)]:
+        cache = utils.TimedCache(60.0, max_size)
+        per_key = measure(cache, keys)
+        stats = cache.stats()
+        print "{0:>15} {1:8.2f} us/key {2:7d} entries {3:7d} evictions".format(
+            name, per_key * 1e6, stats["size"], stats["evictions"])
+
+
+if __name__ == "__main__":
+    main()